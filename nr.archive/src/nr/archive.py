@@ -28,11 +28,13 @@ files using the same interface. It also allows you to register your own opener.
 """
 
 from functools import partial
+from multiprocessing.pool import ThreadPool
 import datetime
 import os
 import shutil
 import sys
 import tarfile
+import threading
 import time
 import zipfile
 
@@ -41,6 +43,11 @@ try:
 except ImportError:
   import __builtin__ as builtins
 
+try:
+  from queue import Queue
+except ImportError:
+  from Queue import Queue
+
 openers = {}
 
 
@@ -145,13 +152,23 @@ def open(filename=None, file=None, mode='r', suffix=None, options=None):
 
 
 def extract(archive, directory, suffix=None, unpack_single_dir=False,
-    check_extract_file=None, progress_callback=None, default_mode='755'):
+    check_extract_file=None, progress_callback=None, default_mode='755',
+    workers=None):
   """
   Extract the contents of *archive* to the specified *directory*. This
   function ensures that no file is extracted outside of the target directory
   (which can theoretically happen if the arcname is not relative or points
   to a parent directory).
 
+  With *workers*, the members of ZIP archives are decompressed and written
+  by that many threads, each with its own handle for the archive file. For
+  TAR archives, which can only be read sequentially, the members are read
+  in the calling thread while *workers* threads write the files. The
+  *progress_callback* is still called in the order of the members, but
+  for ZIP archives only after the member was extracted. Other archives
+  (and ZIP archives that were not opened from a file) are extracted
+  sequentially.
+
   # Parameters
   archive (str, archive-like): The filename of an archive or an already
     opened archive.
@@ -159,12 +176,13 @@ def extract(archive, directory, suffix=None, unpack_single_dir=False,
   unpack_single_dir (bool): If this is True and if the archive contains only
     a single top-level directory, its contents will be placed directly into
     the target *directory*.
+  workers (int): The number of threads to extract the members with.
   """
 
   if isinstance(archive, str):
     with open(archive, suffix=suffix) as archive:
       return extract(archive, directory, None, unpack_single_dir,
-          check_extract_file, progress_callback, default_mode)
+          check_extract_file, progress_callback, default_mode, workers)
 
   if isinstance(default_mode, str):
     default_mode = int(default_mode, 8)
@@ -184,41 +202,180 @@ def extract(archive, directory, suffix=None, unpack_single_dir=False,
   else:
     stripdir = None
 
-  for index, name in enumerate(names):
-    if progress_callback:
-      progress_callback(index + 1, len(names), name)
+  def target(name):
+    # Returns the path to extract the member *name* to, or None.
     if name.startswith('..') or name.startswith('/') or os.path.isabs(name):
-      continue
+      return None
     if check_extract_file and not check_extract_file(name):
-      continue
+      return None
     if name.endswith('/'):
-      continue
+      return None
     if stripdir:
       filename = name[len(stripdir):]
       if not filename:
-        continue
+        return None
     else:
       filename = name
+    return os.path.join(directory, filename)
 
-    info = archive.getmember(name)
-    src = archive.extractfile(name)
-    if not src:
-      continue
+  if workers and isinstance(archive, zipfile.ZipFile) and archive.filename \
+      and os.path.isfile(archive.filename):
+    _extract_zip_parallel(archive, names, target, progress_callback, default_mode, workers)
+  elif workers and isinstance(archive, tarfile.TarFile):
+    _extract_tar_pipelined(archive, names, target, progress_callback, default_mode, workers)
+  else:
+    for index, name in enumerate(names):
+      if progress_callback:
+        progress_callback(index + 1, len(names), name)
+      filename = target(name)
+      if not filename:
+        continue
+      info = archive.getmember(name)
+      src = archive.extractfile(name)
+      if not src:
+        continue
+      try:
+        _makedirs(os.path.dirname(filename))
+        with builtins.open(filename, 'wb') as dst:
+          shutil.copyfileobj(src, dst)
+        _apply_info(filename, info, default_mode)
+      finally:
+        src.close()
 
-    try:
-      filename = os.path.join(directory, filename)
-      dirname = os.path.dirname(filename)
-      if not os.path.exists(dirname):
-        os.makedirs(dirname)
+  if progress_callback:
+    progress_callback(len(names), len(names), None)
+
+
+def _extract_zip_parallel(archive, names, target, progress_callback, default_mode, workers):
+  # The members of a ZIP archive are compressed independently, so every
+  # worker can decompress a different one with its own #zipfile.ZipFile.
+  local = threading.local()
+  handles = []
+  lock = threading.Lock()
+
+  def init():
+    local.zip = zipfile.ZipFile(archive.filename)
+    with lock:
+      handles.append(local.zip)
+
+  def job(item):
+    name, filename = item
+    info = archive.getmember(name)
+    with local.zip.open(name) as src:
+      _makedirs(os.path.dirname(filename))
       with builtins.open(filename, 'wb') as dst:
         shutil.copyfileobj(src, dst)
-      os.chmod(filename, info.mode or default_mode)
-      os.utime(filename, (-1, info.mtime))
-    finally:
-      src.close()
+    _apply_info(filename, info, default_mode)
+
+  # Members with the same name (or the same target) are only extracted
+  # once, from the last one, otherwise two threads could write to the same
+  # file at the same time. The result is the same as sequentially.
+  targets = [(name, target(name)) for name in names]
+  last = {}
+  for index, (name, filename) in enumerate(targets):
+    if filename:
+      last[os.path.normpath(filename)] = index
+  jobs = [targets[index] for index in sorted(last.values())]
+
+  pool = ThreadPool(workers, init)
+  try:
+    results = pool.imap(job, jobs)
+    for index, (name, filename) in enumerate(targets):
+      if filename and last[os.path.normpath(filename)] == index:
+        next(results)  # Raises the exception of the job, if any.
+      if progress_callback:
+        progress_callback(index + 1, len(names), name)
+    pool.close()
+    pool.join()
+  finally:
+    pool.terminate()
+    for handle in handles:
+      handle.close()
+
+
+def _extract_tar_pipelined(archive, names, target, progress_callback, default_mode, workers):
+  # The members of a (compressed) TAR archive can only be read in order,
+  # but the files can be written while the next member is decompressed.
+  # All chunks of a file go to the same writer.
+  queues = [Queue(maxsize=32) for _ in range(workers)]
+  errors = []
+
+  def writer(queue):
+    dst = None
+    while True:
+      item = queue.get()
+      if item is None:
+        break
+      if errors:
+        continue  # Keep draining the queue so that the reader never blocks.
+      try:
+        if item[0] == 'open':
+          filename, info = item[1:]
+          _makedirs(os.path.dirname(filename))
+          dst = builtins.open(filename, 'wb')
+        elif item[0] == 'data':
+          dst.write(item[1])
+        else:
+          dst.close()
+          dst = None
+          _apply_info(filename, info, default_mode)
+      except Exception as exc:
+        errors.append(exc)
+    if dst is not None:
+      dst.close()
+
+  threads = [threading.Thread(target=writer, args=(q,)) for q in queues]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  try:
+    for index, member in enumerate(archive.getmembers()):
+      name = names[index]
+      if progress_callback:
+        progress_callback(index + 1, len(names), name)
+      filename = target(name)
+      if not filename:
+        continue
+      src = archive.extractfile(member)
+      if not src:
+        continue
+      queue = queues[hash(filename) % workers]
+      try:
+        queue.put(('open', filename, member))
+        while not errors:
+          chunk = src.read(_CHUNK_SIZE)
+          if not chunk:
+            break
+          queue.put(('data', chunk))
+        queue.put(('close',))
+      finally:
+        src.close()
+      if errors:
+        break
+  finally:
+    for queue in queues:
+      queue.put(None)
+    for thread in threads:
+      thread.join()
+  if errors:
+    raise errors[0]
+
+
+_CHUNK_SIZE = 256 * 1024
+
+
+def _makedirs(dirname):
+  if not os.path.exists(dirname):
+    try:
+      os.makedirs(dirname)
+    except OSError:
+      if not os.path.isdir(dirname):  # Another thread may have created it.
+        raise
 
-  if progress_callback:
-    progress_callback(len(names), len(names), None)
+
+def _apply_info(filename, info, default_mode):
+  os.chmod(filename, info.mode or default_mode)
+  os.utime(filename, (-1, info.mtime))
 
 
 class Error(Exception):
@@ -280,10 +437,13 @@ def main(argv=None, prog=None):
   parser.add_argument('-s', '--single-unpack', action='store_true',
     help='Skip over the top directory in the archive if it is the only '
       'member in the archive root directory.')
+  parser.add_argument('-j', '--workers', type=int, help='Extract with the '
+    'specified number of threads.')
   args = parser.parse_args(argv)
 
   if args.extract:
-    extract(args.filename, args.extract, unpack_single_dir=args.single_unpack)
+    extract(args.filename, args.extract, unpack_single_dir=args.single_unpack,
+      workers=args.workers)
     return 0
   else:
     parser.error('no operation specified')
@@ -0,0 +1,133 @@
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import warnings
+import zipfile
+from nose.tools import *
+from nr import archive
+
+
+MEMBERS = [('top/file{0}.txt'.format(i), ('x' * (i * 997 % 5000) + str(i)).encode('ascii'))
+           for i in range(60)]
+MEMBERS += [('top/sub/a.bin', os.urandom(70000)), ('top/sub/deep/b.txt', b'b'),
+            ('top/skip.me', b'skip'), ('../evil.txt', b'evil')]
+
+
+def _make_zip(filename, members):
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore')  # Duplicate names.
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as zf:
+      for name, data in members:
+        info = zipfile.ZipInfo(name, (2018, 11, 16, 12, 0, 0))
+        info.external_attr = 0o640 << 16
+        zf.writestr(info, data)
+
+
+def _make_tar(filename, members):
+  with tarfile.open(filename, 'w:gz') as tf:
+    for name, data in members:
+      info = tarfile.TarInfo(name)
+      info.size = len(data)
+      info.mode = 0o640
+      info.mtime = 1542369600
+      tf.addfile(info, io.BytesIO(data))
+
+
+def _read_tree(directory):
+  result = {}
+  for root, dirs, files in os.walk(directory):
+    for name in files:
+      path = os.path.join(root, name)
+      with open(path, 'rb') as fp:
+        data = fp.read()
+      st = os.stat(path)
+      rel = os.path.relpath(path, directory).replace(os.sep, '/')
+      result[rel] = (data, st.st_mode & 0o777, int(st.st_mtime))
+  return result
+
+
+def _extract(filename, tempdir, **kwargs):
+  directory = tempfile.mkdtemp(dir=tempdir)
+  calls = []
+  archive.extract(filename, directory, progress_callback=lambda *a: calls.append(a),
+    check_extract_file=lambda name: not name.endswith('.me'), **kwargs)
+  return _read_tree(directory), calls
+
+
+def _extract_in_thread(filename, directory, **kwargs):
+  # Returns the exception raised by #archive.extract(), or None. Fails if
+  # it does not return in time.
+  errors = []
+  def run():
+    try:
+      archive.extract(filename, directory, **kwargs)
+    except Exception as exc:
+      errors.append(exc)
+  thread = threading.Thread(target=run)
+  thread.daemon = True
+  thread.start()
+  thread.join(10)
+  assert not thread.is_alive(), 'extract() hangs'
+  return errors[0] if errors else None
+
+
+def test_parallel_extract_matches_sequential():
+  tempdir = tempfile.mkdtemp()
+  try:
+    for suffix, make in [('.zip', _make_zip), ('.tar.gz', _make_tar)]:
+      filename = os.path.join(tempdir, 'archive' + suffix)
+      for unpack_single_dir in [False, True]:
+        # The '../' member counts as another top-level directory.
+        members = MEMBERS[:-1] if unpack_single_dir else MEMBERS
+        make(filename, members)
+        expected, expected_calls = _extract(filename, tempdir, unpack_single_dir=unpack_single_dir)
+        prefix = '' if unpack_single_dir else 'top/'
+        assert_equals(len(expected), len(MEMBERS) - 2)
+        assert prefix + 'sub/deep/b.txt' in expected
+        assert prefix + 'skip.me' not in expected
+        assert not any('evil' in name for name in expected)
+        assert not os.path.exists(os.path.join(tempdir, 'evil.txt'))
+        assert_equals(len(expected_calls), len(members) + 2)
+        assert_equals(expected_calls[0], (-1, 0, None))
+        assert_equals(expected_calls[-1], (len(members), len(members), None))
+        for workers in [1, 3]:
+          tree, calls = _extract(filename, tempdir, unpack_single_dir=unpack_single_dir,
+            workers=workers)
+          assert tree == expected, (suffix, unpack_single_dir, workers)
+          assert_equals(calls, expected_calls)
+  finally:
+    shutil.rmtree(tempdir)
+
+
+def test_parallel_extract_duplicate_names():
+  tempdir = tempfile.mkdtemp()
+  try:
+    members = [('dup.txt', b'first' * 10000)] + MEMBERS[:20] + [('dup.txt', b'last')]
+    for suffix, make in [('.zip', _make_zip), ('.tar.gz', _make_tar)]:
+      filename = os.path.join(tempdir, 'archive' + suffix)
+      make(filename, members)
+      for workers in [None, 4]:
+        tree, calls = _extract(filename, tempdir, workers=workers)
+        assert_equals(tree['dup.txt'][0], b'last')
+        assert_equals(len(calls), len(members) + 2)
+  finally:
+    shutil.rmtree(tempdir)
+
+
+def test_parallel_extract_propagates_errors():
+  # 'a' is extracted as a file, so the directory for 'a/b' can not be created.
+  tempdir = tempfile.mkdtemp()
+  try:
+    members = MEMBERS[:20] + [('a', b'file'), ('a/b', b'x')] + MEMBERS[20:40]
+    for suffix, make in [('.zip', _make_zip), ('.tar.gz', _make_tar)]:
+      filename = os.path.join(tempdir, 'archive' + suffix)
+      make(filename, members)
+      for workers in [1, 3]:
+        directory = tempfile.mkdtemp(dir=tempdir)
+        error = _extract_in_thread(filename, directory, workers=workers)
+        assert isinstance(error, OSError), (suffix, workers, error)
+  finally:
+    shutil.rmtree(tempdir)
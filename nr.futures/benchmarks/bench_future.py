@@ -0,0 +1,75 @@
+"""
+Measures the memory footprint of pending #nr.futures.Future objects in
+bytes per future and the number of futures that can be created (and
+completed) per second.
+
+    $ python benchmarks/bench_future.py --count 100000
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+from nr.futures import Future
+
+
+def noop():
+  pass
+
+
+def bytes_per_future(count, factory=None):
+  # Returns the memory allocated per future created by *factory* (an
+  # unstarted #Future by default), or None without #tracemalloc.
+  if tracemalloc is None:
+    return None
+  if factory is None:
+    factory = lambda: Future(noop)
+  gc.collect()
+  futures = [None] * count  # Don't count the list itself.
+  tracemalloc.start()
+  try:
+    for i in range(count):
+      futures[i] = factory()
+    return tracemalloc.get_traced_memory()[0] / float(count)
+  finally:
+    tracemalloc.stop()
+
+
+def creation_rate(count):
+  tstart = time.time()
+  futures = [Future(noop) for _ in range(count)]
+  return len(futures) / (time.time() - tstart)
+
+
+def completion_rate(count):
+  futures = [Future(noop) for _ in range(count)]
+  tstart = time.time()
+  for future in futures:
+    future.set_result(None)
+    future.result()
+  return count / (time.time() - tstart)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--count', type=int, default=100000)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args(argv)
+
+  size = bytes_per_future(args.count)
+  print('{:>24}  {}'.format('bytes per future', 'n/a' if size is None else '{:.0f}'.format(size)))
+  rate = max(creation_rate(args.count) for _ in range(args.repeat))
+  print('{:>24}  {:.0f}'.format('created per second', rate))
+  rate = max(completion_rate(args.count) for _ in range(args.repeat))
+  print('{:>24}  {:.0f}'.format('completed per second', rate))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,45 @@
+"""
+Measures the throughput of #nr.futures.ThreadPool in tasks per second for
+each scheduler and a range of worker counts. The tasks are tiny so that the
+numbers reflect the scheduling overhead rather than the work itself.
+
+    $ python benchmarks/bench_scheduler.py --tasks 20000 --workers 1 2 4 8 16 32
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from nr.futures import ThreadPool
+
+
+def noop():
+  pass
+
+
+def run(scheduler, workers, tasks):
+  pool = ThreadPool(workers, scheduler=scheduler)
+  tstart = time.time()
+  for _ in range(tasks):
+    pool.submit(noop)
+  pool.shutdown()
+  return tasks / (time.time() - tstart)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--tasks', type=int, default=20000)
+  parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args(argv)
+
+  print('{:>8}  {}'.format('workers', '  '.join('{:>14}'.format(s) for s in ThreadPool.SCHEDULERS)))
+  for workers in args.workers:
+    rates = [max(run(s, workers, args.tasks) for _ in range(args.repeat))
+             for s in ThreadPool.SCHEDULERS]
+    print('{:>8}  {}'.format(workers, '  '.join('{:>10.0f} t/s'.format(r) for r in rates)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,243 @@
+"""
+Runs a set of workloads against #nr.futures and the standard library's
+#concurrent.futures and prints the results as a table, or as JSON with
+`--json` so that they can be compared across releases.
+
+    $ python benchmarks/bench_suite.py --json results.json
+    $ python benchmarks/bench_suite.py --quick --only noop callbacks
+
+Workloads:
+
+* `noop`: Submit tiny tasks and wait for all of them (tasks per second).
+* `fanout`: Submit tasks that do a little work and collect their results in
+  order (tasks per second).
+* `bounded`: Several producer threads submit into a bounded queue that is
+  much smaller than the number of tasks (tasks per second). The standard
+  library has no bounded executor, it is emulated with the usual semaphore
+  that is released in a done callback.
+* `callbacks`: Complete futures that have several done callbacks each
+  (callbacks per second).
+* `memory`: The memory allocated per pending future (bytes, lower is
+  better). Requires #tracemalloc.
+
+Every value is the best of `--repeat` runs.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+
+try:
+  import concurrent.futures as cf
+except ImportError:
+  cf = None
+
+from bench_future import bytes_per_future
+import nr.futures
+from nr.futures import Future, ThreadPool
+
+
+def noop():
+  pass
+
+
+def work(x):
+  return sum(range(x))
+
+
+class Nr(object):
+  name = 'nr.futures'
+
+  @staticmethod
+  def executor(workers, bounded=None):
+    if bounded is None:
+      return ThreadPool(workers)
+    return ThreadPool(workers, bounded=True, bounded_allowance=bounded - workers)
+
+  @staticmethod
+  def results(futures):
+    return [f.result() for f in futures]
+
+  @staticmethod
+  def shutdown(executor):
+    executor.shutdown()
+
+  @staticmethod
+  def future():
+    return Future(noop)
+
+  @staticmethod
+  def complete(future):
+    future.set_result(None)
+
+
+class Stdlib(object):
+  name = 'concurrent.futures'
+
+  class _BoundedExecutor(object):
+    def __init__(self, workers, bound):
+      self._executor = cf.ThreadPoolExecutor(workers)
+      self._semaphore = threading.BoundedSemaphore(bound)
+
+    def submit(self, fn, *args):
+      self._semaphore.acquire()
+      future = self._executor.submit(fn, *args)
+      future.add_done_callback(lambda _: self._semaphore.release())
+      return future
+
+    def shutdown(self):
+      self._executor.shutdown()
+
+  @classmethod
+  def executor(cls, workers, bounded=None):
+    if bounded is None:
+      return cf.ThreadPoolExecutor(workers)
+    return cls._BoundedExecutor(workers, bounded)
+
+  @staticmethod
+  def results(futures):
+    return [f.result() for f in futures]
+
+  @staticmethod
+  def shutdown(executor):
+    executor.shutdown()
+
+  @staticmethod
+  def future():
+    return cf.Future()
+
+  @staticmethod
+  def complete(future):
+    future.set_result(None)
+
+
+def bench_noop(impl, args):
+  executor = impl.executor(args.workers)
+  tstart = time.time()
+  futures = [executor.submit(noop) for _ in range(args.tasks)]
+  impl.results(futures)
+  elapsed = time.time() - tstart
+  impl.shutdown(executor)
+  return args.tasks / elapsed
+
+
+def bench_fanout(impl, args):
+  executor = impl.executor(args.workers)
+  tstart = time.time()
+  futures = [executor.submit(work, i % 100) for i in range(args.tasks)]
+  results = impl.results(futures)
+  elapsed = time.time() - tstart
+  impl.shutdown(executor)
+  assert results[99] == work(99)
+  return args.tasks / elapsed
+
+
+def bench_bounded(impl, args):
+  executor = impl.executor(args.workers, bounded=args.workers * 2)
+  producers = 4
+  per_producer = args.tasks // producers
+  def produce():
+    for _ in range(per_producer):
+      executor.submit(noop)
+  threads = [threading.Thread(target=produce) for _ in range(producers)]
+  tstart = time.time()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  impl.shutdown(executor)
+  return per_producer * producers / (time.time() - tstart)
+
+
+def bench_callbacks(impl, args):
+  callbacks_per_future = 4
+  count = [0]
+  def callback(future):
+    count[0] += 1
+  futures = [impl.future() for _ in range(args.tasks)]
+  tstart = time.time()
+  for future in futures:
+    for _ in range(callbacks_per_future):
+      future.add_done_callback(callback)
+  for future in futures:
+    impl.complete(future)
+  elapsed = time.time() - tstart
+  assert count[0] == args.tasks * callbacks_per_future
+  return count[0] / elapsed
+
+
+def bench_memory(impl, args):
+  return bytes_per_future(args.tasks, impl.future)
+
+
+BENCHMARKS = [
+  ('noop', bench_noop, 'tasks/s', max),
+  ('fanout', bench_fanout, 'tasks/s', max),
+  ('bounded', bench_bounded, 'tasks/s', max),
+  ('callbacks', bench_callbacks, 'callbacks/s', max),
+  ('memory', bench_memory, 'bytes/future', min),
+]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--tasks', type=int, default=20000)
+  parser.add_argument('--workers', type=int, default=4)
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--quick', action='store_true', help='fewer tasks and a single run')
+  parser.add_argument('--only', nargs='+', choices=[x[0] for x in BENCHMARKS])
+  parser.add_argument('--json', metavar='FILE', help='write the results as JSON ("-" for stdout)')
+  args = parser.parse_args(argv)
+  if args.quick:
+    args.tasks, args.repeat = 2000, 1
+
+  impls = [Nr] + ([Stdlib] if cf is not None else [])
+  results = []
+  for name, func, unit, best in BENCHMARKS:
+    if args.only and name not in args.only:
+      continue
+    for impl in impls:
+      values = [func(impl, args) for _ in range(args.repeat)]
+      values = [x for x in values if x is not None]
+      results.append({
+        'benchmark': name,
+        'implementation': impl.name,
+        'value': best(values) if values else None,
+        'unit': unit,
+      })
+
+  if args.json:
+    data = {
+      'meta': {
+        'nr.futures': nr.futures.__version__,
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'tasks': args.tasks,
+        'workers': args.workers,
+        'repeat': args.repeat,
+      },
+      'results': results,
+    }
+    if args.json == '-':
+      json.dump(data, sys.stdout, indent=2)
+      print()
+      return
+    with open(args.json, 'w') as fp:
+      json.dump(data, fp, indent=2)
+
+  print('{:>10}  {:>20}  {:>14}  {}'.format('benchmark', 'implementation', 'value', 'unit'))
+  for result in results:
+    value = 'n/a' if result['value'] is None else '{:.0f}'.format(result['value'])
+    print('{:>10}  {:>20}  {:>14}  {}'.format(result['benchmark'],
+      result['implementation'], value, result['unit']))
+
+
+if __name__ == '__main__':
+  main()
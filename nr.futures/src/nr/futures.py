@@ -22,28 +22,44 @@
 
 from __future__ import print_function
 from six import reraise
+from six.moves import cPickle as pickle
+from six.moves import queue as _queue
 
 import collections
 import functools
+import heapq
+import itertools
+import math
+import multiprocessing
 import time
 import threading
 import traceback
 import sys
 
+try:
+  import asyncio
+except ImportError:
+  asyncio = None
+
 __author__ = 'Niklas Rosenstein <rosensteinniklas@gmail.com>'
 __version__ = '1.0.1'
 
+try:
+  _clock = time.monotonic
+except AttributeError:
+  _clock = time.time
+
 
 def _get_timeout_begin(timeout):
   if timeout is None:
     return None
-  return time.clock()
+  return _clock()
 
 
 def _get_timeout_remainder(tbegin, timeout):
   if timeout is None:
     return None
-  return timeout - (time.clock() - tbegin)
+  return timeout - (_clock() - tbegin)
 
 
 class Cancelled(Exception):
@@ -55,6 +71,74 @@ class Timeout(Exception):
 class Unavailable(Exception):
   " This exception is raised by #Future.get() if the result is not available. "
 
+class Overloaded(Exception):
+  " This exception is raised by #ThreadPool.enqueue() if the pool sheds load. "
+
+class RemoteError(Exception):
+  """
+  This exception is set in a #Future of a #ProcessPool if the worker raised
+  an exception in the child process that could not be sent back to the
+  parent process. The message contains the formatted remote traceback.
+  """
+
+class BrokenPool(Exception):
+  " This exception is set in the futures of a #ProcessPool if a child process died. "
+
+class _RemoteTraceback(Exception):
+  # Set as the `__cause__` of exceptions sent from a child process so the
+  # remote traceback is displayed with the exception.
+
+  def __init__(self, tb):
+    self.tb = tb
+
+  def __str__(self):
+    return self.tb
+
+
+PRIORITY_LOW = -10    #: Priority for bulk work in a #ThreadPool.
+PRIORITY_NORMAL = 0   #: The default priority in a #ThreadPool.
+PRIORITY_HIGH = 10    #: Priority for latency sensitive work in a #ThreadPool.
+
+FIRST_COMPLETED = 'FIRST_COMPLETED'  #: Return as soon as any future completed.
+FIRST_EXCEPTION = 'FIRST_EXCEPTION'  #: Return as soon as any future failed.
+ALL_COMPLETED = 'ALL_COMPLETED'      #: Return when all futures completed.
+
+DoneAndNotDone = collections.namedtuple('DoneAndNotDone', 'done not_done')
+
+
+# Bits of #Future._state.
+_ENQUEUED = 1
+_RUNNING = 2
+_COMPLETED = 4
+_CANCELLED = 8
+_PRINT_EXC = 16
+_RESTARTABLE = 32
+
+# The locks shared by all #Future objects, picked by the object's address.
+_future_locks = tuple(threading.RLock() for _ in range(64))
+
+
+def _noop():
+  pass
+
+
+def _set_outcome(future, fun):
+  # Completes *future* with the result or the exception of `fun()`.
+  try:
+    result = fun()
+  except:
+    future._complete(None, sys.exc_info())
+  else:
+    future._complete(result, None)
+
+
+def _copy_outcome(source, target):
+  # Completes *target* like the completed or cancelled *source*.
+  if source.cancelled():
+    target.cancel()
+  else:
+    target._complete(source._result, source._exc_info)
+
 
 class Future(object):
   """
@@ -127,48 +211,63 @@ class Future(object):
   Timeout = Timeout
   Unavailable = Unavailable
 
+  # Futures are often created in large numbers, thus they have no instance
+  # dictionary, keep their state in a single integer and share a fixed set
+  # of locks. A condition variable and the list of done callbacks are only
+  # allocated when they are needed.
+  __slots__ = ('__weakref__', '_state', '_lock', '_cond', '_worker',
+               '_thread', '_result', '_exc_info', '_logger', '_callbacks',
+               '_enqueue_time')
+
   def __init__(self, worker=None, print_exc=True, logger=None, restartable=False):
     if isinstance(worker, bool):
       worker = None
       print_exc = worker
     if worker is not None and not callable(worker):
       raise TypeError('worker must be callable')
-    self._print_exc = print_exc
+    self._state = (_PRINT_EXC if print_exc else 0) | (_RESTARTABLE if restartable else 0)
+    self._lock = _future_locks[(id(self) >> 4) % len(_future_locks)]
+    self._cond = None
     self._worker = worker
     self._thread = None
-    self._enqueued = False
-    self._exc_info = None
-    self._lock = threading.Condition()
-    self._running = False
-    self._completed = False
-    self._cancelled = False
     self._result = None
+    self._exc_info = None
     self._logger = logger
-    self._restartable = restartable
-    self._done_callbacks = []
+    self._callbacks = None
+    self._enqueue_time = None  # Set by a #ThreadPool with hooks.
 
   def __repr__(self):
     with self._lock:
+      state = self._state
       if self._exc_info:
         status = 'error ({})'.format(self._exc_info[1])
-      elif self._cancelled:
+      elif state & _CANCELLED:
         status = 'cancelled'
-      elif self._completed:
+      elif state & _COMPLETED:
         status = 'completed'
-      elif self._running:
+      elif state & _RUNNING:
         status = 'running'
-      elif self._enqueued:
+      elif state & _ENQUEUED:
         status = 'enqueued'
       else:
         status = 'idle'
       return '<Future {}>'.format(status)
 
-  def _print_exception(self):
+  def __await__(self):
+    # The asyncio future is resolved through the event loop's
+    # #call_soon_threadsafe() when this future completes, no thread is
+    # blocked while waiting.
+    return _to_asyncio_future(self).__await__()
+
+  def _print_exception(self, exc_info=None):
     if self._logger:
-      self._logger.exception('Exception in {0}'.format(self))
+      self._logger.error('Exception in {0}'.format(self), exc_info=exc_info or True)
     else:
       print('Exception in {0}'.format(self), file=sys.stderr)
-      traceback.print_exc()
+      if exc_info:
+        traceback.print_exception(*exc_info)
+      else:
+        traceback.print_exc()
       sys.stderr.flush()
 
   def bind(self, __fun, *args, **kwargs):
@@ -178,7 +277,7 @@ class Future(object):
     """
 
     with self._lock:
-      if self._running or self._completed or self._cancelled:
+      if self._state & (_RUNNING | _COMPLETED | _CANCELLED):
         raise RuntimeError('Future object can not be reused')
       if self._worker:
         raise RuntimeError('Future object is already bound')
@@ -190,10 +289,11 @@ class Future(object):
     Adds the callback *fun* to the future so that it be invoked when the
     future completed. The future completes either when it has been completed
     after being started with the #start() method (independent of whether
-    an error occurs or not) or when either #set_result() or #set_exception()
-    is called.
+    an error occurs or not), when either #set_result() or #set_exception()
+    is called or when it is cancelled.
 
-    If the future is already complete, *fun* will be invoked directly.
+    If the future is already complete or cancelled, *fun* will be invoked
+    directly.
 
     The function *fun* must accept the future as its sole argument.
 
@@ -206,10 +306,113 @@ class Future(object):
     """
 
     with self._lock:
-      if self._completed:
-        fun(self)
-      if not self._completed or (not once and self._restartable):
-        self._done_callbacks.append((fun, once))
+      state = self._state
+      done = state & (_COMPLETED | _CANCELLED)
+      if not done or (not once and state & _RESTARTABLE):
+        if self._callbacks is None:
+          self._callbacks = []
+        self._callbacks.append((fun, once))
+    if done:
+      fun(self)
+
+  def _remove_done_callback(self, fun):
+    # Removes the callback *fun* (compared by identity) that was added with
+    # #add_done_callback() and not called yet.
+    with self._lock:
+      if self._callbacks:
+        self._callbacks = [x for x in self._callbacks if x[0] is not fun] or None
+
+  def then(self, fun, executor=None):
+    """
+    Returns a new future that completes with the result of `fun(self)`,
+    which is called when this future completed or has been cancelled.
+
+    The continuation runs on the thread that completes this future (or
+    the calling thread if it already completed), unless an *executor*
+    (eg. a #ThreadPool) is specified, in which case it is submitted to it.
+    Either way, no thread is blocked waiting for this future. Cancelling the
+    returned future does not cancel this future.
+    """
+
+    return self._continue(executor, lambda source, target:
+      _set_outcome(target, lambda: fun(source)), pass_cancel=False)
+
+  def map(self, fun, executor=None):
+    """
+    Returns a new future that completes with `fun(result)` when this future
+    completed successfully. Exceptions and the cancellation of this future
+    are passed on to the new future without calling *fun*. See #then() for
+    the *executor* parameter.
+    """
+
+    def handler(source, target):
+      if source._exc_info is None:
+        _set_outcome(target, lambda: fun(source._result))
+      else:
+        target._complete(None, source._exc_info)
+    return self._continue(executor, handler)
+
+  def recover(self, fun, executor=None):
+    """
+    Returns a new future that completes with `fun(exc)` if this future
+    failed with the exception *exc*, or with the result of this future. See
+    #then() for the *executor* parameter.
+    """
+
+    def handler(source, target):
+      if source._exc_info is None:
+        target._complete(source._result, None)
+      else:
+        _set_outcome(target, lambda: fun(source._exc_info[1]))
+    return self._continue(executor, handler)
+
+  def flat_map(self, fun, executor=None):
+    """
+    Like #map(), but *fun* returns another #Future and the new future
+    completes with the outcome of that future once it completed.
+    """
+
+    def handler(source, target):
+      if source._exc_info is not None:
+        target._complete(None, source._exc_info)
+        return
+      try:
+        inner = fun(source._result)
+        if not isinstance(inner, Future):
+          raise TypeError('flat_map() function must return a Future, got {0}'
+            .format(type(inner).__name__))
+      except:
+        target._complete(None, sys.exc_info())
+      else:
+        inner.add_done_callback(lambda inner: _copy_outcome(inner, target))
+    return self._continue(executor, handler)
+
+  def _continue(self, executor, handler, pass_cancel=True):
+    # Calls `handler(self, target)` when this future completed, where
+    # *target* is the returned future. With *pass_cancel*, the handler is
+    # not called if this future has been cancelled, the target is
+    # cancelled instead.
+    target = Future()
+    def run(source):
+      if target.cancelled():
+        return
+      if pass_cancel and source.cancelled():
+        target.cancel()
+        return
+      try:
+        handler(source, target)
+      except:
+        target._complete(None, sys.exc_info())
+    def callback(source):
+      if executor is None:
+        run(source)
+        return
+      try:
+        executor.submit(run, source)
+      except:
+        target._complete(None, sys.exc_info())
+    self.add_done_callback(callback, once=True)
+    return target
 
   def enqueue(self):
     """
@@ -221,15 +424,16 @@ class Future(object):
     """
 
     with self._lock:
-      if self._enqueued:
+      state = self._state
+      if state & _ENQUEUED:
         raise RuntimeError('Future object is already enqueued')
-      if self._running:
+      if state & _RUNNING:
         raise RuntimeError('Future object is already running')
-      if self._completed:
+      if state & _COMPLETED:
         raise RuntimeError('Future object can not be restarted')
       if not self._worker:
         raise RuntimeError('Future object is not bound')
-      self._enqueued = True
+      self._state = state | _ENQUEUED
 
   def start(self, as_thread=True):
     """
@@ -243,17 +447,16 @@ class Future(object):
     """
 
     with self._lock:
-      if self._running:
+      if self._state & _RUNNING:
         raise RuntimeError('Future object is already running')
-      if self._restartable:
-        self._enqueued = False
-        self._completed = False
+      if self._state & _RESTARTABLE:
+        self._state &= ~(_ENQUEUED | _COMPLETED)
       if as_thread:
         self.enqueue()
-      if self._cancelled:
+      if self._state & _CANCELLED:
         return
 
-      self._running = True
+      self._state |= _RUNNING
       if as_thread:
         self._thread = threading.Thread(target=self._run)
         self._thread.start()
@@ -268,38 +471,54 @@ class Future(object):
       result = self._worker()
     except:
       exc_info = sys.exc_info()
-      if self._print_exc:
+      if self._state & _PRINT_EXC:
         # The result is not expected to be collected, thus the exception
         # would be swallowed. We print it immediately.
         self._print_exception()
+    self._complete(result, exc_info)
+
+  # @requires_lock
+  def _mark_running(self):
+    # Marks the future as running for executors that run the worker
+    # elsewhere. Returns the worker, or #None if the future was cancelled.
+    if self._state & _CANCELLED:
+      return None
+    self._state |= _RUNNING
+    return self._worker
+
+  def _complete(self, result, exc_info):
     with self._lock:
-      if not self._restartable:
+      if not self._state & _RESTARTABLE:
         self._worker = None
       self._result = result
       self._exc_info = exc_info
-      self._running = False
-      self._completed = True
-      self._lock.notify_all()
-      callbacks = self._prepare_done_callbacks()
+      self._state = (self._state & ~_RUNNING) | _COMPLETED
+      callbacks = self._notify()
     try:
       callbacks()
     except:
       self._print_exception()
 
   # @requires_lock
-  def _prepare_done_callbacks(self):
+  def _notify(self):
+    # Wakes up the threads in #wait() and returns a function that invokes
+    # the done callbacks. Must be called after the future completed.
+    if self._cond is not None:
+      self._cond.notify_all()
+    if not self._callbacks:
+      return _noop
     def invoker(future, callbacks):
       for callback in callbacks:
         try:
           callback(future)
         except:
           future._print_exception()
-    callbacks = [x for x, once in self._done_callbacks]
-    if self._restartable:
+    callbacks = [x for x, once in self._callbacks]
+    if self._state & _RESTARTABLE:
       # Keep all callbacks that should not be invoked just once.
-      self._done_callbacks = [(x, False) for x, once in self._done_callbacks if not once]
+      self._callbacks = [(x, False) for x, once in self._callbacks if not once]
     else:
-      self._done_callbacks = []
+      self._callbacks = None
     return functools.partial(invoker, self, callbacks)
 
   def pending(self):
@@ -309,10 +528,7 @@ class Future(object):
     or not.
     """
 
-    with self._lock:
-      if self._running or self._completed or self._cancelled:
-        return False
-      return True
+    return not self._state & (_RUNNING | _COMPLETED | _CANCELLED)
 
   def enqueued(self):
     """
@@ -320,32 +536,28 @@ class Future(object):
     to be or already being executed.
     """
 
-    with self._lock:
-      return self._enqueued
+    return bool(self._state & _ENQUEUED)
 
   def running(self):
     """
     Returns #True if the future is running, #False otherwise.
     """
 
-    with self._lock:
-      return self._running
+    return bool(self._state & _RUNNING)
 
   def done(self):
     """
     Returns #True if the future completed, #False otherwise.
     """
 
-    with self._lock:
-      return self._completed
+    return bool(self._state & _COMPLETED)
 
   def cancelled(self):
     """
     Checks if the future has been cancelled.
     """
 
-    with self._lock:
-      return self._cancelled
+    return bool(self._state & _CANCELLED)
 
   def get(self, do_raise=True, default=None):
     """
@@ -389,7 +601,7 @@ class Future(object):
       self.wait(timeout, do_raise=do_raise)
       if self._exc_info:
         reraise(*self._exc_info)
-      if self._cancelled:
+      if self._state & _CANCELLED:
         if not do_raise:
           return None
         raise self.Cancelled()
@@ -410,7 +622,7 @@ class Future(object):
       self.wait(timeout, do_raise=do_raise)
       if not self._exc_info:
         return None
-      if self._cancelled:
+      if self._state & _CANCELLED:
         raise self.Cancelled()
       return self._exc_info[1]
 
@@ -430,7 +642,7 @@ class Future(object):
       self.wait(timeout, do_raise=do_raise)
       if not self._exc_info:
         return None
-      if self._cancelled:
+      if self._state & _CANCELLED:
         raise self.Cancelled()
       return self._exc_info
 
@@ -451,11 +663,11 @@ class Future(object):
     """
 
     with self._lock:
-      if not self._completed or mark_completed_as_cancelled:
-        self._cancelled = True
-      if not self._restartable:
+      if not self._state & _COMPLETED or mark_completed_as_cancelled:
+        self._state |= _CANCELLED
+      if not self._state & _RESTARTABLE:
         self._worker = None
-      callbacks = self._prepare_done_callbacks()
+      callbacks = self._notify()
     callbacks()
 
   def set_result(self, result):
@@ -471,13 +683,13 @@ class Future(object):
     """
 
     with self._lock:
-      if self._enqueued:
+      if self._state & _ENQUEUED:
         raise RuntimeError('can not set result of enqueued Future')
-      if not self._restartable:
+      if not self._state & _RESTARTABLE:
         self._worker = None
       self._result = result
-      self._completed = True
-      callbacks = self._prepare_done_callbacks()
+      self._state |= _COMPLETED
+      callbacks = self._notify()
     callbacks()
 
   def set_exception(self, exc_info):
@@ -506,13 +718,13 @@ class Future(object):
         exc_info = (exc_info[0], exc_info[1], exc_info[2])
 
     with self._lock:
-      if self._enqueued:
+      if self._state & _ENQUEUED:
         raise RuntimeError('can not set exception of enqueued Future')
-      if not self._restartable:
+      if not self._state & _RESTARTABLE:
         self._worker = None
       self._exc_info = exc_info
-      self._completed = True
-      callbacks = self._prepare_done_callbacks()
+      self._state |= _COMPLETED
+      callbacks = self._notify()
     callbacks()
 
   def wait(self, timeout=None, do_raise=False):
@@ -530,12 +742,17 @@ class Future(object):
 
     if timeout is not None:
       timeout = float(timeout)
-      start = time.clock()
+      start = _clock()
+
+    if self._state & (_COMPLETED | _CANCELLED):
+      return True
 
     with self._lock:
-      while not self._completed and not self._cancelled:
+      while not self._state & (_COMPLETED | _CANCELLED):
+        if self._cond is None:
+          self._cond = threading.Condition(self._lock)
         if timeout is not None:
-          time_left = timeout - (time.clock() - start)
+          time_left = timeout - (_clock() - start)
         else:
           time_left = None
         if time_left is not None and time_left <= 0.0:
@@ -543,33 +760,359 @@ class Future(object):
             raise self.Timeout()
           else:
             return False
-        self._lock.wait(time_left)
+        self._cond.wait(time_left)
     return True
 
 
-class ThreadPool(object):
+class _Waiter(object):
+  # Collects the futures passed to #add() (as a done callback) so that a
+  # single condition variable is enough to wait for any number of futures.
+
+  def __init__(self):
+    self.lock = threading.Condition()
+    self.finished = collections.deque()
+
+  def add(self, future):
+    with self.lock:
+      self.finished.append(future)
+      self.lock.notify()
+
+
+def as_completed(futures, timeout=None):
   """
-  Represents a pool of threads that can process futures.
+  Yields the *futures* as they complete (or are cancelled). Duplicate
+  futures are yielded only once. Waiting costs a single done callback per
+  future, regardless of how many futures there are.
 
-  :param max_workers: The number of parallel workers.
-  :param daemon: Whether the workers are daemon threads.
-  :param bounded: Enable to make :meth:`submit` block if the queue is full.
-  :param bounded_allowance: The number of futures to submit beyond the
-    maximum queue size (= maximum number of workers) before :meth:`submit`
-    blocks (only if *bounded* is enabled).
+  # Parameters
+  futures (iterable of Future): The futures to wait for.
+  timeout (None, float): The maximum number of seconds to wait for all
+    futures, measured from the call to #as_completed().
+  raise (Timeout): If the *timeout* expires before all futures completed.
   """
 
-  def __init__(self, max_workers, daemon=True, bounded=False,
-               bounded_allowance=0):
-    self._workers = []
-    self._daemon = daemon
-    self._max_workers = max_workers
-    self._queue = collections.deque()
-    self._running = collections.deque()
-    self._lock = threading.Condition()
-    self._bounded = bounded
-    self._bounded_allowance = bounded_allowance
-    self._shutdown = False
+  tbegin = _get_timeout_begin(timeout)
+  futures = list(collections.OrderedDict.fromkeys(futures))
+  waiter = _Waiter()
+  callback = waiter.add
+  for future in futures:
+    future.add_done_callback(callback, once=True)
+
+  pending = len(futures)
+  try:
+    while pending:
+      with waiter.lock:
+        while not waiter.finished:
+          remainder = _get_timeout_remainder(tbegin, timeout)
+          if remainder is not None and remainder <= 0.0:
+            raise Timeout()
+          waiter.lock.wait(remainder)
+        finished = list(waiter.finished)
+        waiter.finished.clear()
+      for future in finished:
+        pending -= 1
+        yield future
+  finally:
+    # Don't keep the waiter alive with the futures that did not complete.
+    if pending:
+      for future in futures:
+        future._remove_done_callback(callback)
+
+
+def wait(futures, timeout=None, return_when=ALL_COMPLETED):
+  """
+  Wait for the *futures* to complete as specified with *return_when*.
+
+  # Parameters
+  futures (iterable of Future): The futures to wait for.
+  timeout (None, float): The maximum number of seconds to wait.
+  return_when (str): One of #FIRST_COMPLETED, #FIRST_EXCEPTION or
+    #ALL_COMPLETED. With #FIRST_EXCEPTION, it returns when any future
+    failed or all completed.
+  return (DoneAndNotDone): A named tuple of two sets, the futures that
+    completed and those that didn't. Does not raise if the *timeout*
+    expires.
+  """
+
+  if return_when not in (FIRST_COMPLETED, FIRST_EXCEPTION, ALL_COMPLETED):
+    raise ValueError('invalid return_when: {0!r}'.format(return_when))
+  done, not_done = set(), set(futures)
+  try:
+    for future in as_completed(not_done, timeout):
+      done.add(future)
+      not_done.discard(future)
+      if return_when == FIRST_COMPLETED:
+        break
+      if return_when == FIRST_EXCEPTION and future._exc_info is not None:
+        break
+  except Timeout:
+    pass
+  return DoneAndNotDone(done, not_done)
+
+
+def gather(futures, timeout=None, return_exceptions=False):
+  """
+  Waits for all *futures* to complete and returns a list of their results
+  in the same order.
+
+  # Parameters
+  futures (iterable of Future): The futures to wait for.
+  timeout (None, float): The maximum number of seconds to wait.
+  return_exceptions (bool): Put the exception of a failed future (or a
+    #Cancelled exception for cancelled futures) into the list instead of
+    raising it.
+  raise (Timeout): If the *timeout* expires before all futures completed.
+  raise (BaseException): The exception of the first failed future in the
+    list, unless *return_exceptions* is #True.
+  """
+
+  futures = list(futures)
+  for _ in as_completed(futures, timeout):
+    pass
+  results = []
+  for future in futures:
+    try:
+      results.append(future.result())
+    except Exception as exc:
+      if not return_exceptions:
+        raise
+      results.append(exc)
+  return results
+
+
+CriticalPath = collections.namedtuple('CriticalPath', 'seconds nodes')
+
+
+class TaskGraph(object):
+  """
+  Runs a set of tasks that depend on the results of other tasks in an
+  executor. A task is enqueued only when all of its dependencies completed,
+  so no worker thread is blocked waiting for the result of another task,
+  and independent branches of the graph run in parallel.
+
+  A task is called with the results of its dependencies (in the order they
+  were declared) followed by its own *args*. If a dependency fails, the
+  task fails with the same exception without being run, if a dependency is
+  cancelled (or can not be enqueued, eg. because the executor has been shut
+  down), the task is cancelled.
+
+  ```python
+  graph = TaskGraph(pool)
+  graph.add('a', load, args=['a.csv'])
+  graph.add('b', load, args=['b.csv'])
+  graph.add('c', merge, deps=['a', 'b'])
+  print(graph.run().result('c'))
+  print(graph.critical_path())
+  ```
+
+  # Parameters
+  executor (ThreadPool): The executor to run the tasks in.
+  """
+
+  class _Node(object):
+    __slots__ = ('name', 'fn', 'args', 'kwargs', 'deps', 'dependents',
+                 'pending', 'resolved', 'future', 'started', 'finished')
+
+  def __init__(self, executor):
+    self._executor = executor
+    self._nodes = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._running = False
+    self._tstart = None
+
+  def __getitem__(self, name):
+    return self._nodes[name].future
+
+  def __contains__(self, name):
+    return name in self._nodes
+
+  def __len__(self):
+    return len(self._nodes)
+
+  def add(self, name, fn, deps=(), args=(), kwargs=None):
+    """
+    Adds the task *name* to the graph. The *deps* must name tasks that have
+    already been added, which ensures that the graph has no cycles. Returns
+    the #Future of the task.
+    """
+
+    if self._running:
+      raise RuntimeError('TaskGraph is already running')
+    if name in self._nodes:
+      raise ValueError('duplicate task: {0!r}'.format(name))
+    for dep in deps:
+      if dep not in self._nodes:
+        raise ValueError('unknown dependency of {0!r}: {1!r}'.format(name, dep))
+    node = self._Node()
+    node.name = name
+    node.fn = fn
+    node.args = tuple(args)
+    node.kwargs = kwargs or {}
+    node.deps = [self._nodes[dep] for dep in collections.OrderedDict.fromkeys(deps)]
+    node.dependents = []
+    node.pending = len(node.deps)
+    node.resolved = False
+    node.future = Future(print_exc=False)
+    node.started = None
+    node.finished = None
+    for dep in node.deps:
+      dep.dependents.append(node)
+    self._nodes[name] = node
+    return node.future
+
+  def run(self, wait=True, timeout=None):
+    """
+    Enqueues the tasks that have no dependencies into the executor, the
+    others follow as their dependencies complete. If *wait* is #True, waits
+    for all tasks to complete (see #wait()). Returns the graph.
+    """
+
+    with self._lock:
+      if self._running:
+        raise RuntimeError('TaskGraph is already running')
+      self._running = True
+    self._tstart = _clock()
+    for node in list(self._nodes.values()):
+      node.future.add_done_callback(functools.partial(self._finished, node))
+    for node in list(self._nodes.values()):
+      if not node.deps:
+        with self._lock:
+          if node.resolved:
+            continue
+          node.resolved = True
+        self._enqueue(node)
+    if wait:
+      self.wait(timeout)
+    return self
+
+  def wait(self, timeout=None):
+    """
+    Waits for all tasks to complete, fail or be cancelled.
+
+    # Raises
+    Timeout: If the *timeout* expires.
+    """
+
+    for _ in as_completed(self.futures(), timeout):
+      pass
+
+  def cancel(self):
+    """
+    Cancels all tasks that have not completed yet.
+    """
+
+    for future in self.futures():
+      future.cancel()
+
+  def futures(self):
+    """
+    Returns a list of the futures of all tasks in the order they were added.
+    """
+
+    return [node.future for node in self._nodes.values()]
+
+  def result(self, name, timeout=None):
+    """
+    Returns the result of the task *name*, waiting for it to complete.
+    """
+
+    return self._nodes[name].future.result(timeout)
+
+  def results(self, timeout=None):
+    """
+    Waits for all tasks and returns a dictionary that maps the task names
+    to their results. Raises the exception of the first failed task.
+    """
+
+    self.wait(timeout)
+    return collections.OrderedDict((name, node.future.result())
+      for name, node in self._nodes.items())
+
+  def timings(self):
+    """
+    Returns a dictionary that maps the names of the tasks that ran to a
+    tuple of their start and end time in seconds, relative to the call to
+    #run().
+    """
+
+    return collections.OrderedDict(
+      (name, (node.started - self._tstart, node.finished - self._tstart))
+      for name, node in self._nodes.items()
+      if node.started is not None and node.finished is not None)
+
+  def critical_path(self):
+    """
+    Returns the chain of dependent tasks with the longest total run time as
+    a #CriticalPath tuple of the total *seconds* and the task names. Tasks
+    that did not run count as zero seconds. This is the minimum time the
+    graph takes no matter how many workers there are.
+    """
+
+    best = {}
+    for name, node in self._nodes.items():  # Dependencies come first.
+      seconds = 0.0
+      if node.started is not None and node.finished is not None:
+        seconds = node.finished - node.started
+      prev = (0.0, [])
+      if node.deps:
+        prev = max((best[dep.name] for dep in node.deps), key=lambda x: x[0])
+      best[name] = (prev[0] + seconds, prev[1] + [name])
+    if not best:
+      return CriticalPath(0.0, [])
+    seconds, nodes = max(best.values(), key=lambda x: x[0])
+    return CriticalPath(seconds, nodes)
+
+  def _enqueue(self, node):
+    args = [dep.future.result() for dep in node.deps]
+    args.extend(node.args)
+    try:
+      node.future.bind(self._run_node, node, args)
+      self._executor.enqueue(node.future)
+    except Exception:
+      # The future has been cancelled in the meantime, or the executor has
+      # been shut down or is overloaded.
+      node.future.cancel()
+
+  def _run_node(self, node, args):
+    node.started = _clock()
+    try:
+      return node.fn(*args, **node.kwargs)
+    finally:
+      node.finished = _clock()
+
+  def _finished(self, node, future):
+    ready = []
+    with self._lock:
+      for dependent in node.dependents:
+        if dependent.resolved:
+          continue
+        if future.cancelled():
+          ready.append((dependent, None))
+        elif future._exc_info is not None:
+          ready.append((dependent, future._exc_info))
+        else:
+          dependent.pending -= 1
+          if dependent.pending != 0:
+            continue
+          ready.append((dependent, False))
+        dependent.resolved = True
+    for dependent, exc_info in ready:
+      if exc_info is None:
+        dependent.future.cancel()
+      elif exc_info:
+        dependent.future.set_exception(exc_info)
+      else:
+        self._enqueue(dependent)
+
+
+class _Executor(object):
+  """
+  Base class for #ThreadPool and #ProcessPool which implements the
+  convenience methods on top of #enqueue() and #enqueue_many().
+  """
+
+  _timer = None
+  _SCHEDULE_RETRY_DELAY = 0.01
 
   def __enter__(self):
     return self
@@ -578,23 +1121,16 @@ class ThreadPool(object):
     self.shutdown()
 
   def enqueue(self, future):
+    raise NotImplementedError
+
+  def enqueue_many(self, futures):
     """
-    Enqueue a future to be processed by one of the threads in the pool.
-    The future must be bound to a worker and not have been started yet.
+    Enqueue all *futures* at once. This is cheaper than calling #enqueue()
+    for every future.
     """
 
-    future.enqueue()
-    with self._lock:
-      if self._shutdown:
-        raise RuntimeError('ThreadPool has been shut down and can no '
-          'longer accept futures.')
-      if self._bounded:
-        while len(self._queue) >= (self._max_workers + self._bounded_allowance):
-          self._lock.wait()
-      self._queue.append(future)
-      if len(self._running) == len(self._workers):
-        self._new_worker()
-      self._lock.notify_all()
+    for future in futures:
+      self.enqueue(future)
 
   def submit(self, __fun, *args, **kwargs):
     """
@@ -605,79 +1141,1710 @@ class ThreadPool(object):
     self.enqueue(future)
     return future
 
-  def cancel(self, cancel_running=True, mark_completed_as_cancelled=False):
+  def schedule(self, __delay, __fun, *args, **kwargs):
     """
-    Cancel all futures queued in the pool. If *cancel_running* is True,
-    futures that are currently running in the pool are cancelled as well.
+    Creates a new future and enqueues it after *__delay* seconds. Returns
+    the future, cancelling it before it is due prevents it from being
+    enqueued. All scheduled futures of a pool share a single timer thread.
+    Futures that are not due when the pool is shut down are cancelled. If
+    the queue of a bounded pool is full when the future is due, it is
+    enqueued once there is room, regardless of the overflow policy.
     """
 
-    with self._lock:
-      for future in self._queue:
-        future.cancel(mark_completed_as_cancelled)
-      if cancel_running:
-        for future in self._running:
-          future.cancel(mark_completed_as_cancelled)
-      self._queue.clear()
+    future = Future().bind(__fun, *args, **kwargs)
+    self._get_timer().add(_clock() + __delay,
+      functools.partial(self._enqueue_scheduled, future), future)
+    return future
 
-  def shutdown(self, wait=True):
+  def schedule_at_fixed_rate(self, __delay, __period, __fun, *args, **kwargs):
     """
-    Shut down the pool. If *wait* is True, it will wait until all futures
-    are completed. Alternatively, you can use the #wait() method to wait
-    with timeout supported.
+    Calls *__fun* every *__period* seconds, starting after *__delay*
+    seconds. Every call is processed by the pool like a future enqueued
+    with #enqueue(). If a call takes longer than the period, the next call
+    starts late rather than in parallel.
+
+    Returns a future that represents the periodic task. Cancel it to stop
+    the calls. If a call raises an exception, no more calls are made and
+    the exception is set in the returned future.
     """
 
-    with self._lock:
-      self._shutdown = True
-      self._lock.notify_all()
-    if wait:
-      self.wait()
+    handle = Future(print_exc=False)
+    worker = functools.partial(__fun, *args, **kwargs)
+    timer = self._get_timer()
 
-  def wait(self, timeout=None):
-    """
-    Wait until all futures are completed. You should call this method only
-    after calling #shutdown(). Returns #False if all futures are complete,
-    #False if there are still some running.
-    """
+    def run(when):
+      if handle.cancelled():
+        return
+      future = Future(print_exc=False).bind(worker)
+      future.add_done_callback(functools.partial(done, when))
+      self._enqueue_scheduled(future)
 
-    tbegin = _get_timeout_begin(timeout)
+    def done(when, future):
+      if handle.done() or handle.cancelled():
+        return
+      if future.cancelled():
+        handle.cancel()
+      elif future.exc_info() is not None:
+        handle.set_exception(future.exc_info())
+      else:
+        when = max(when + __period, _clock())
+        try:
+          timer.add(when, functools.partial(run, when), handle)
+        except RuntimeError:  # The pool has been shut down.
+          handle.cancel()
+
+    when = _clock() + __delay
+    timer.add(when, functools.partial(run, when), handle)
+    return handle
+
+  def _get_timer(self):
     with self._lock:
-      while self._queue or self._running:
-        remainder = _get_timeout_remainder(tbegin, timeout)
-        if remainder is not None and remainder <= 0.0:
-          return False  # timeout
-        self._lock.wait(remainder)
       if self._shutdown:
-        for worker in self._workers:
-          worker.join()
+        raise RuntimeError('{0} has been shut down and can no longer '
+          'accept futures.'.format(type(self).__name__))
+      if self._timer is None:
+        self._timer = _Timer()
+        self._timer.start()
+      return self._timer
+
+  def _enqueue_scheduled(self, future):
+    # Called by the timer thread, which must neither block on a full queue
+    # nor run the future itself, whatever the pool's overflow policy. If
+    # the queue is full, the future is enqueued a little later.
+    if future.cancelled():
+      return
+    try:
+      if not self._enqueue_nowait(future):
+        self._get_timer().add(_clock() + self._SCHEDULE_RETRY_DELAY,
+          functools.partial(self._enqueue_scheduled, future), future)
+    except RuntimeError:
+      # The pool has been shut down (or the future was cancelled just now).
+      future.cancel()
+    except Exception:
+      try:
+        future.set_exception(sys.exc_info())
+      except RuntimeError:  # The future has already been enqueued.
+        future.cancel()
+
+  def _enqueue_nowait(self, future):
+    # Enqueues the *future* without blocking and without applying an
+    # overflow policy. Returns #False if the queue is full.
+    self.enqueue(future)
     return True
 
-  def _new_worker(self):
+  def _stop_timer(self):
     with self._lock:
-      if len(self._workers) < self._max_workers:
-        worker = self._Worker(self)
-        worker.daemon = self._daemon
-        self._workers.append(worker)
-        worker.start()
+      timer, self._timer = self._timer, None
+    if timer is not None:
+      timer.stop()
 
-  class _Worker(threading.Thread):
+  def run_in_pool(self, __fun, *args, **kwargs):
+    """
+    Like #submit(), but returns an #asyncio.Future for the running event
+    loop instead, so it must be called from a coroutine or callback of that
+    loop. Cancelling the asyncio future cancels the future in the pool.
+
+    ```python
+    async def handler(pool, request):
+      return await pool.run_in_pool(process, request)
+    ```
+    """
 
-    def __init__(self, master):
-      threading.Thread.__init__(self)
-      self._master = master
+    future = Future(print_exc=False).bind(__fun, *args, **kwargs)
+    result = _to_asyncio_future(future)
+    self.enqueue(future)
+    return result
 
-    def run(self):
-      while True:
-        with self._master._lock:
-          while not self._master._queue:
-            if self._master._shutdown:
-              return
-            self._master._lock.wait()
-          future = self._master._queue.popleft()
-          self._master._running.append(future)
-          self._master._lock.notify_all()
-        try:
-          future.start(as_thread=False)
-        finally:
-          with self._master._lock:
-            self._master._running.remove(future)
-            self._master._lock.notify_all()
+  def submit_many(self, __fun, iterable, chunksize=64):
+    """
+    Creates a future for every item in *iterable* that calls *__fun* with
+    the item and enqueues them in batches of *chunksize* futures with
+    #enqueue_many(). Returns a list of the futures.
+    """
+
+    futures = []
+    for chunk in _chunks(iterable, chunksize):
+      batch = [Future().bind(__fun, item) for item in chunk]
+      self.enqueue_many(batch)
+      futures.extend(batch)
+    return futures
+
+  def map(self, __fun, iterable, chunksize=1, ordered=True, window=None,
+          return_exceptions=False):
+    """
+    Calls *__fun* for every item in *iterable* and yields the results. The
+    items are processed in chunks of *chunksize* items, each chunk being
+    processed by a single future. At most *window* chunks (defaults to
+    twice the number of workers) are processed at a time, the *iterable*
+    is consumed only as fast as the results are consumed.
+
+    An exception raised for one item does not affect the other items. If
+    a chunk fails as a whole (eg. because it could not be sent to a child
+    process of a #ProcessPool), the exception applies to all of its items.
+
+    When the generator is closed before it is exhausted, the chunks that
+    are still pending are cancelled.
+
+    # Parameters
+    chunksize (int): The number of items per future.
+    ordered (bool): Yield the results in the order of the *iterable*. If
+      #False, the results are yielded as soon as their chunk completes.
+    window (int): The maximum number of chunks in flight.
+    return_exceptions (bool): Yield the exception instead of raising it if
+      the function raised an exception for an item.
+    """
+
+    if window is None:
+      window = 2 * self._max_workers
+    if window < 1:
+      raise ValueError('window must be at least 1')
+
+    pending = collections.deque()
+    completed = _queue.Queue()
+    chunks = _chunks(iterable, chunksize)
+
+    def fill():
+      while len(pending) < window:
+        chunk = next(chunks, None)
+        if chunk is None:
+          break
+        future = Future(print_exc=False).bind(_run_chunk, __fun, chunk)
+        if not ordered:
+          future.add_done_callback(completed.put)
+        self.enqueue(future)
+        pending.append((future, len(chunk)))
+
+    try:
+      fill()
+      while pending:
+        if ordered:
+          future, count = pending.popleft()
+        else:
+          future = completed.get()
+          count = next(c for f, c in pending if f is future)
+          pending.remove((future, count))
+        exc = future.exception()
+        results = [(False, exc)] * count if exc is not None else future.result()
+        fill()
+        for success, value in results:
+          if success or return_exceptions:
+            yield value
+          else:
+            raise value
+    finally:
+      for future, _ in pending:
+        future.cancel()
+
+
+class _Timer(threading.Thread):
+  # Calls functions at the specified times (as per #_clock()). Used for
+  # #_Executor.schedule(), the functions should return quickly.
+
+  def __init__(self):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self._lock = threading.Condition()
+    self._heap = []
+    self._counter = itertools.count()
+    self._stopped = False
+
+  def add(self, when, callback, future=None):
+    with self._lock:
+      if self._stopped:
+        raise RuntimeError('timer has been stopped')
+      entry = (when, next(self._counter), callback, future)
+      heapq.heappush(self._heap, entry)
+      if self._heap[0] is entry:
+        self._lock.notify()
+
+  def stop(self):
+    # Stops the timer and cancels the futures that were passed to #add()
+    # along with the functions that have not been called.
+    with self._lock:
+      self._stopped = True
+      entries, self._heap = self._heap, []
+      self._lock.notify()
+    for entry in entries:
+      if entry[3] is not None:
+        entry[3].cancel()
+
+  def run(self):
+    while True:
+      with self._lock:
+        while True:
+          if self._stopped:
+            return
+          if self._heap:
+            remainder = self._heap[0][0] - _clock()
+            if remainder <= 0:
+              callback = heapq.heappop(self._heap)[2]
+              break
+          else:
+            remainder = None
+          self._lock.wait(remainder)
+      try:
+        callback()
+      except:
+        traceback.print_exc()
+
+
+def wrap_asyncio_future(future):
+  """
+  Returns a #Future that completes with the result of the #asyncio.Future
+  *future*, allowing threads that are not running the event loop to wait
+  for it. Cancelling one future cancels the other. This works for
+  #concurrent.futures.Future objects (eg. as returned by
+  #asyncio.run_coroutine_threadsafe()) as well.
+  """
+
+  result = Future(print_exc=False)
+
+  def copy(future):
+    if future.cancelled():
+      result.cancel()
+    elif future.exception() is not None:
+      result.set_exception(future.exception())
+    else:
+      result.set_result(future.result())
+
+  def cancel(_):
+    if result.cancelled() and not future.done():
+      if asyncio is not None and asyncio.isfuture(future):
+        future.get_loop().call_soon_threadsafe(future.cancel)
+      else:
+        future.cancel()
+
+  future.add_done_callback(copy)
+  result.add_done_callback(cancel)
+  return result
+
+
+def _to_asyncio_future(future, loop=None):
+  if asyncio is None:
+    raise RuntimeError('asyncio is not available')
+  if loop is None:
+    if hasattr(asyncio, 'get_running_loop'):
+      loop = asyncio.get_running_loop()
+    else:
+      loop = asyncio.get_event_loop()
+  result = loop.create_future()
+
+  def copy():
+    if result.cancelled():
+      return
+    if future.cancelled():
+      result.cancel()
+    elif future.exception() is not None:
+      result.set_exception(future.exception())
+    else:
+      result.set_result(future.result())
+
+  def cancel(result):
+    if result.cancelled():
+      future.cancel()
+
+  future.add_done_callback(lambda _: loop.call_soon_threadsafe(copy))
+  result.add_done_callback(cancel)
+  return result
+
+
+def _chunks(iterable, chunksize):
+  if chunksize < 1:
+    raise ValueError('chunksize must be at least 1')
+  iterator = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(iterator, chunksize))
+    if not chunk:
+      return
+    yield chunk
+
+
+def _run_chunk(fun, items):
+  # Worker for the futures created by #_Executor.map(). Module level so that
+  # it can be pickled for the #ProcessPool.
+  results = []
+  for item in items:
+    try:
+      results.append((True, fun(item)))
+    except Exception as exc:
+      results.append((False, exc))
+  return results
+
+
+class PoolHooks(object):
+  """
+  Base class for objects that are notified about the futures passing
+  through a #ThreadPool. The methods are called from the threads that
+  enqueue and process the futures, sometimes with the pool's lock held, so
+  they must be quick and must not block or enqueue futures themselves.
+  """
+
+  def on_enqueue(self, pool, future):
+    """ Called when *future* has been enqueued. """
+
+  def on_block(self, pool, future):
+    """ Called when enqueueing *future* blocks because the pool is bounded. """
+
+  def on_reject(self, pool, future):
+    """ Called when *future* is rejected because the pool is overloaded. """
+
+  def on_start(self, pool, future, queue_time):
+    """ Called before *future* runs, *queue_time* is the time in seconds since it was enqueued. """
+
+  def on_done(self, pool, future, run_time):
+    """ Called after *future* ran, *run_time* is its run time in seconds. """
+
+  def on_cancel(self, pool, future):
+    """ Called when *future* is removed from the pool because it was cancelled before it started. """
+
+
+class Histogram(object):
+  """
+  A thread-safe histogram of durations with logarithmic buckets. Bucket
+  *i* counts the values up to `2 ** i` microseconds.
+  """
+
+  NUM_BUCKETS = 40
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self._buckets = [0] * self.NUM_BUCKETS
+      self._count = 0
+      self._sum = 0.0
+      self._min = None
+      self._max = None
+
+  def add(self, value):
+    index = math.frexp(value * 1e6)[1] if value > 0 else 0
+    index = min(max(index, 0), self.NUM_BUCKETS - 1)
+    with self._lock:
+      self._buckets[index] += 1
+      self._count += 1
+      self._sum += value
+      if self._min is None or value < self._min:
+        self._min = value
+      if self._max is None or value > self._max:
+        self._max = value
+
+  def percentile(self, fraction):
+    """
+    Returns the upper bound (in seconds) of the bucket that contains the
+    given *fraction* (between 0 and 1) of the values, or #None.
+    """
+
+    with self._lock:
+      return self._percentile(fraction)
+
+  def _percentile(self, fraction):
+    if not self._count:
+      return None
+    threshold = fraction * self._count
+    total = 0
+    for index, count in enumerate(self._buckets):
+      total += count
+      if total >= threshold:
+        return min(2 ** index / 1e6, self._max)
+    return self._max
+
+  def snapshot(self):
+    """
+    Returns a dictionary with the `count`, `sum`, `min`, `max`, `mean`,
+    `p50`, `p90` and `p99` values and the non-empty `buckets` as a list of
+    `(upper_bound, count)` tuples.
+    """
+
+    with self._lock:
+      return {
+        'count': self._count,
+        'sum': self._sum,
+        'min': self._min,
+        'max': self._max,
+        'mean': self._sum / self._count if self._count else None,
+        'p50': self._percentile(0.5),
+        'p90': self._percentile(0.9),
+        'p99': self._percentile(0.99),
+        'buckets': [(2 ** i / 1e6, c) for i, c in enumerate(self._buckets) if c],
+      }
+
+
+class PoolMetrics(PoolHooks):
+  """
+  Collects counters and latency histograms for a #ThreadPool. Create the
+  pool with `metrics=True` or pass an instance in its *hooks*.
+
+  # Attributes
+  queue_time (Histogram): The time between enqueueing and starting futures.
+  run_time (Histogram): The time the futures spent running.
+  """
+
+  COUNTERS = ('enqueued', 'started', 'completed', 'failed', 'cancelled',
+              'rejected', 'blocked')
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.queue_time = Histogram()
+    self.run_time = Histogram()
+    self._counters = dict.fromkeys(self.COUNTERS, 0)
+
+  def _incr(self, name):
+    with self._lock:
+      self._counters[name] += 1
+
+  def on_enqueue(self, pool, future):
+    self._incr('enqueued')
+
+  def on_block(self, pool, future):
+    self._incr('blocked')
+
+  def on_reject(self, pool, future):
+    self._incr('rejected')
+
+  def on_start(self, pool, future, queue_time):
+    self._incr('started')
+    self.queue_time.add(queue_time)
+
+  def on_done(self, pool, future, run_time):
+    self._incr('failed' if future._exc_info is not None else 'completed')
+    self.run_time.add(run_time)
+
+  def on_cancel(self, pool, future):
+    self._incr('cancelled')
+
+  def snapshot(self):
+    """
+    Returns a dictionary with the counters (see #COUNTERS), the gauges
+    `queue_depth` and `running` and the snapshots of the #queue_time and
+    #run_time histograms. The values are plain numbers, lists and
+    dictionaries that can be exported as they are, eg. as JSON.
+    """
+
+    with self._lock:
+      result = dict(self._counters)
+    finished = result['completed'] + result['failed']
+    result['queue_depth'] = result['enqueued'] - result['started'] - result['cancelled']
+    result['running'] = result['started'] - finished
+    result['queue_time'] = self.queue_time.snapshot()
+    result['run_time'] = self.run_time.snapshot()
+    return result
+
+
+class ResultCache(object):
+  """
+  A thread-safe cache for the results of #ThreadPool.submit_keyed() that
+  evicts the least recently used results when it holds more than *maxsize*
+  results, and results that are older than *ttl* seconds.
+
+  # Attributes
+  hits (int): The number of lookups that found a result.
+  misses (int): The number of lookups that did not find a result.
+  """
+
+  def __init__(self, maxsize=128, ttl=None):
+    if maxsize < 1:
+      raise ValueError('maxsize must be at least 1')
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    self._items = collections.OrderedDict()  # key -> (expires, value)
+
+  def __len__(self):
+    return len(self._items)
+
+  def lookup(self, key):
+    """
+    Returns a tuple of #True and the cached result for *key*, or a tuple of
+    #False and #None if there is none.
+    """
+
+    with self._lock:
+      item = self._items.get(key)
+      if item is not None and item[0] is not None and item[0] <= _clock():
+        del self._items[key]
+        item = None
+      if item is None:
+        self.misses += 1
+        return False, None
+      self.hits += 1
+      # Mark as most recently used.
+      del self._items[key]
+      self._items[key] = item
+      return True, item[1]
+
+  def put(self, key, value):
+    with self._lock:
+      self._items.pop(key, None)
+      self._items[key] = (None if self.ttl is None else _clock() + self.ttl, value)
+      while len(self._items) > self.maxsize:
+        self._items.popitem(last=False)
+
+  def invalidate(self, key):
+    with self._lock:
+      self._items.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
+
+
+class _Semaphore(object):
+  # A counting semaphore that limits the number of queued futures in a
+  # bounded #ThreadPool. #release() wakes up only as many blocked producers
+  # as slots became free, and #acquire() supports a timeout on Python 2.
+
+  def __init__(self, value):
+    self._cond = threading.Condition(threading.Lock())
+    self._value = value
+
+  def acquire(self, blocking=True, timeout=None):
+    tbegin = _get_timeout_begin(timeout)
+    with self._cond:
+      while self._value <= 0:
+        if not blocking:
+          return False
+        remainder = _get_timeout_remainder(tbegin, timeout)
+        if remainder is not None and remainder <= 0.0:
+          return False
+        self._cond.wait(remainder)
+      self._value -= 1
+      return True
+
+  def release(self, n=1):
+    if n:
+      with self._cond:
+        self._value += n
+        self._cond.notify(n)
+
+
+class _PriorityQueue(object):
+  # The queue of the #ThreadPool's 'fifo' scheduler. Futures with a higher
+  # priority are dequeued first, futures with the same priority in the order
+  # they were added. Futures are removed in #expire() if their deadline
+  # passed and in #pop_lowest(); they are only marked as removed and skipped
+  # in #popleft(). Cancelling the removed futures is up to the caller.
+
+  class Entry(object):
+    __slots__ = ('priority', 'time', 'future', 'removed')
+
+    def __init__(self, priority, time, future):
+      self.priority = priority
+      self.time = time
+      self.future = future
+      self.removed = False
+
+  def __init__(self):
+    self._heap = []  # (-priority, index, entry), compared without __lt__()
+    self._deadlines = []  # (deadline, index, entry)
+    self._size = 0
+    self._counter = itertools.count()
+
+  def __len__(self):
+    return self._size
+
+  def __bool__(self):
+    return self._size != 0
+
+  __nonzero__ = __bool__
+
+  def __iter__(self):
+    return (item[2].future for item in self._heap if not item[2].removed)
+
+  def append(self, future, priority, now, deadline=None):
+    index = next(self._counter)
+    entry = self.Entry(priority, now, future)
+    heapq.heappush(self._heap, (-priority, index, entry))
+    if deadline is not None:
+      heapq.heappush(self._deadlines, (deadline, index, entry))
+    self._size += 1
+
+  def peek(self):
+    heap = self._heap
+    while heap and heap[0][2].removed:
+      heapq.heappop(heap)
+    return heap[0][2] if heap else None
+
+  def popleft(self):
+    entry = self.peek()
+    if entry is None:
+      raise IndexError('pop from an empty queue')
+    heapq.heappop(self._heap)
+    entry.removed = True
+    self._size -= 1
+    return entry.future
+
+  def pop_lowest(self):
+    # Removes the oldest of the futures with the lowest priority.
+    items = [item for item in self._heap if not item[2].removed]
+    if not items:
+      raise IndexError('pop from an empty queue')
+    entry = min(items, key=lambda item: (-item[0], item[1]))[2]
+    entry.removed = True
+    self._size -= 1
+    return entry.future
+
+  def expire(self, now=None):
+    deadlines = self._deadlines
+    if not deadlines:
+      return ()
+    if now is None:
+      now = _clock()
+    expired = []
+    while deadlines and deadlines[0][0] <= now:
+      entry = heapq.heappop(deadlines)[2]
+      if not entry.removed:
+        entry.removed = True
+        self._size -= 1
+        expired.append(entry.future)
+    return expired
+
+  def clear(self):
+    for item in self._heap:
+      item[2].removed = True
+    del self._heap[:]
+    del self._deadlines[:]
+    self._size = 0
+
+
+class ThreadPool(_Executor):
+  """
+  Represents a pool of threads that can process futures.
+
+  :param max_workers: The number of parallel workers.
+  :param daemon: Whether the workers are daemon threads.
+  :param bounded: Enable to limit the number of queued futures. What
+    happens when the queue is full is determined by the *overflow* policy.
+  :param bounded_allowance: The number of futures to queue beyond the
+    maximum queue size (= maximum number of workers) before the queue is
+    full (only if *bounded* is enabled).
+  :param overflow: The policy for enqueueing futures into a full queue
+    (see #OVERFLOW_POLICIES). `'block'` (the default) waits for a free
+    slot, `'raise'` raises #Overloaded, `'caller_runs'` runs the future in
+    the calling thread and `'drop_oldest'` cancels the oldest of the
+    queued futures with the lowest priority to make room (not supported
+    by the `'stealing'` scheduler). Blocked producers wait on a dedicated
+    semaphore and are woken one at a time as slots become free.
+  :param overflow_timeout: With the `'block'` policy, the maximum number
+    of seconds to wait for a free slot before raising #Overloaded.
+  :param initializer: A function that is called with *initargs* in every
+    worker thread before it processes futures, eg. to open a connection and
+    store it in #worker_local().
+  :param initargs: The arguments for the *initializer*.
+  :param finalizer: A function that is called in every worker thread before
+    it exits, be it because of #shutdown() or because it has been idle for
+    *keepalive* seconds. Exceptions in the *initializer* and *finalizer*
+    are printed to #sys.stderr.
+  :param scheduler: Either `'fifo'` (the default) or `'stealing'`. The
+    `'fifo'` scheduler uses a single priority queue and condition variable
+    shared by all workers. The `'stealing'` scheduler gives every worker
+    its own queue, wakes exactly one idle worker per enqueued future and
+    lets idle workers steal from the queues of busy workers. It scales much
+    better with many workers and many small tasks, but it does not
+    guarantee that futures are started in the order they were enqueued and
+    it does not support priorities and timeouts.
+  :param max_queue_wait: If the next future to be started has been waiting
+    in the queue for longer than this many seconds, #enqueue() sheds load
+    by rejecting futures that do not have a higher priority with an
+    #Overloaded exception. Only supported by the `'fifo'` scheduler.
+  :param min_workers: The number of workers that are kept alive when
+    they are idle (only relevant if *keepalive* is set).
+  :param keepalive: The number of seconds after which an idle worker
+    exits if there are more than *min_workers*. New workers are started
+    on demand. If #None, workers never exit before the pool is shut down.
+  :param prestart: Start *min_workers* workers immediately instead of
+    when the first futures are enqueued.
+  :param hooks: A list of #PoolHooks objects that are notified about the
+    futures passing through the pool.
+  :param metrics: Collect #PoolMetrics, available as #metrics.
+  :param result_cache: A #ResultCache for the results of #submit_keyed(),
+    available as #result_cache.
+  """
+
+  SCHEDULERS = ('fifo', 'stealing')
+  OVERFLOW_POLICIES = ('block', 'raise', 'caller_runs', 'drop_oldest')
+
+  def __init__(self, max_workers, daemon=True, bounded=False,
+               bounded_allowance=0, scheduler='fifo', max_queue_wait=None,
+               min_workers=0, keepalive=None, prestart=False, hooks=None,
+               metrics=False, result_cache=None, overflow='block',
+               overflow_timeout=None, initializer=None, initargs=(),
+               finalizer=None):
+    if scheduler not in self.SCHEDULERS:
+      raise ValueError('invalid scheduler: {0!r}'.format(scheduler))
+    if overflow not in self.OVERFLOW_POLICIES:
+      raise ValueError('invalid overflow policy: {0!r}'.format(overflow))
+    if overflow == 'drop_oldest' and scheduler == 'stealing':
+      raise ValueError('the drop_oldest policy is not supported by the stealing scheduler')
+    if max_queue_wait is not None and scheduler == 'stealing':
+      raise ValueError('max_queue_wait is not supported by the stealing scheduler')
+    if not 0 <= min_workers <= max_workers:
+      raise ValueError('min_workers must be between 0 and max_workers')
+    self._workers = []
+    self._daemon = daemon
+    self._max_workers = max_workers
+    self._min_workers = min_workers
+    self._keepalive = keepalive
+    self._max_queue_wait = max_queue_wait
+    self._queue = _PriorityQueue()
+    self._running = set()
+    self._lock = threading.Condition()
+    self._overflow = overflow
+    self._overflow_timeout = overflow_timeout
+    self._slots = None
+    if bounded:
+      self._slots = _Semaphore(max_workers + bounded_allowance)
+    self._shutdown = False
+    self._scheduler = scheduler
+    self._idle = collections.deque()  # Idle workers of the stealing scheduler.
+    self._cancelled = collections.deque()  # See #_defer_cancel().
+    self._waiters = 0
+    self._next_victim = itertools.count()
+    self._hooks = tuple(hooks or ())
+    self.metrics = None
+    if metrics:
+      self.metrics = PoolMetrics()
+      self._hooks += (self.metrics,)
+    self.result_cache = result_cache
+    self._initializer = initializer
+    self._initargs = tuple(initargs)
+    self._finalizer = finalizer
+    self._keyed = {}
+    self._keyed_lock = threading.Lock()
+    if prestart:
+      for _ in range(min_workers):
+        self._new_worker()
+
+  def enqueue(self, future, priority=PRIORITY_NORMAL, timeout=None):
+    """
+    Enqueue a future to be processed by one of the threads in the pool.
+    The future must be bound to a worker and not have been started yet.
+
+    With the `'fifo'` scheduler, futures with a higher *priority* are
+    started before futures with a lower priority. If a *timeout* is
+    specified and the future has not been started within that many seconds,
+    it is cancelled instead (at the latest when the next future is enqueued
+    or a worker becomes available).
+
+    :raise Overloaded: If the pool has a *max_queue_wait* and it has been
+      exceeded. The *future* is cancelled.
+    """
+
+    if self._scheduler == 'stealing':
+      self._check_stealing_options(priority, timeout)
+    future.enqueue()
+    if self._slots is not None:
+      self._enqueue_bounded(future, priority, timeout)
+    elif self._scheduler == 'stealing':
+      self._enqueue_stealing(future)
+    else:
+      try:
+        with self._lock:
+          self._put(future, priority, timeout)
+          self._lock.notify_all()
+      finally:
+        self._finish_cancelled()
+
+  def enqueue_many(self, futures, priority=PRIORITY_NORMAL, timeout=None):
+    """
+    Enqueue all *futures* with a single acquisition of the pool's lock.
+    See #enqueue() for the *priority* and *timeout* parameters. If the
+    pool rejects a future, it and the rest of the batch are cancelled.
+    """
+
+    futures = list(futures)
+    if self._scheduler == 'stealing':
+      self._check_stealing_options(priority, timeout)
+    queued = 0
+    try:
+      if self._slots is not None:
+        # Every future needs a free slot, so they are enqueued one by one.
+        for future in futures:
+          self.enqueue(future, priority, timeout)
+          queued += 1
+        return
+      for future in futures:
+        future.enqueue()
+      if self._scheduler == 'stealing':
+        for future in futures:
+          self._enqueue_stealing(future)
+          queued += 1
+        return
+      try:
+        with self._lock:
+          try:
+            for future in futures:
+              self._put(future, priority, timeout)
+              queued += 1
+          finally:
+            self._lock.notify_all()
+      finally:
+        self._finish_cancelled()
+    except:
+      # Nobody would ever run the rest of the batch.
+      for future in futures[queued:]:
+        future.cancel()
+      raise
+
+  def submit_keyed(self, __key, __fun, *args, **kwargs):
+    """
+    Like #submit(), but if a future submitted with the same *__key* is
+    still queued or running, that future is returned instead of running
+    *__fun* again. Note that cancelling the returned future cancels it for
+    all callers that share it.
+
+    If the pool has a #result_cache, the successful results are cached and
+    served with an already completed future without scheduling anything.
+    """
+
+    with self._keyed_lock:
+      future = self._keyed.get(__key)
+      if future is not None:
+        # The done callback may not have removed a failed future yet.
+        if not future.cancelled() and future._exc_info is None:
+          return future
+        del self._keyed[__key]
+      if self.result_cache is not None:
+        found, result = self.result_cache.lookup(__key)
+        if found:
+          future = Future()
+          future.set_result(result)
+          return future
+      future = Future().bind(__fun, *args, **kwargs)
+      self._keyed[__key] = future
+    future.add_done_callback(functools.partial(self._keyed_done, __key))
+    try:
+      self.enqueue(future)
+    except:
+      with self._keyed_lock:
+        if self._keyed.get(__key) is future:
+          del self._keyed[__key]
+      raise
+    return future
+
+  def _keyed_done(self, key, future):
+    with self._keyed_lock:
+      if self._keyed.get(key) is future:
+        del self._keyed[key]
+        if self.result_cache is not None and not future.cancelled() \
+            and future._exc_info is None:
+          self.result_cache.put(key, future._result)
+
+  # @requires_lock
+  def _put(self, future, priority, timeout):
+    if self._shutdown:
+      raise RuntimeError('ThreadPool has been shut down and can no '
+        'longer accept futures.')
+    now = _clock()
+    self._expire(now)
+    hooks = self._hooks
+    if self._max_queue_wait is not None:
+      head = self._queue.peek()
+      if head and now - head.time > self._max_queue_wait and priority <= head.priority:
+        self._defer_cancel(future, 'on_reject')
+        raise Overloaded('queue wait exceeds {0} seconds'.format(self._max_queue_wait))
+    deadline = None if timeout is None else now + timeout
+    self._queue.append(future, priority, now, deadline)
+    if hooks:
+      future._enqueue_time = now
+      for hook in hooks:
+        hook.on_enqueue(self, future)
+    workers = len(self._workers)
+    if workers < self._max_workers and len(self._queue) + len(self._running) > workers:
+      self._new_worker()
+
+  def _enqueue_bounded(self, future, priority, timeout):
+    # Takes a slot for the *future* from the semaphore, handling a full
+    # queue according to the overflow policy. The slot is released when
+    # the future leaves the queue.
+    if not self._slots.acquire(blocking=False):
+      policy = self._overflow
+      if policy == 'drop_oldest':
+        try:
+          with self._lock:
+            if self._queue:
+              # The new future takes over the slot of the dropped future,
+              # the oldest of the futures with the lowest priority.
+              self._defer_cancel(self._queue.pop_lowest())
+              try:
+                self._put(future, priority, timeout)
+              except:
+                self._slots.release()
+                raise
+              self._lock.notify_all()
+              return
+        finally:
+          self._finish_cancelled()
+        policy = 'block'  # The slots are taken by concurrent producers.
+      if policy == 'caller_runs':
+        future.start(as_thread=False)
+        return
+      if policy == 'raise' or not self._block(future):
+        future.cancel()
+        for hook in self._hooks:
+          hook.on_reject(self, future)
+        raise Overloaded('queue is full')
+    self._enqueue_acquired(future, priority, timeout)
+
+  def _enqueue_acquired(self, future, priority, timeout):
+    # Enqueues the *future* after a slot was taken for it.
+    try:
+      if self._scheduler == 'stealing':
+        self._enqueue_stealing(future)
+      else:
+        try:
+          with self._lock:
+            self._put(future, priority, timeout)
+            self._lock.notify_all()
+        finally:
+          self._finish_cancelled()
+    except:
+      self._slots.release()
+      raise
+
+  def _enqueue_nowait(self, future):
+    if self._slots is None:
+      self.enqueue(future)
+      return True
+    if not self._slots.acquire(blocking=False):
+      return False
+    try:
+      future.enqueue()
+    except:
+      self._slots.release()
+      raise
+    self._enqueue_acquired(future, PRIORITY_NORMAL, None)
+    return True
+
+  def _block(self, future):
+    for hook in self._hooks:
+      hook.on_block(self, future)
+    return self._slots.acquire(timeout=self._overflow_timeout)
+
+  def _release_slots(self, n=1):
+    if self._slots is not None:
+      self._slots.release(n)
+
+  # @requires_lock
+  def _expire(self, now=None):
+    expired = self._queue.expire(now)
+    self._release_slots(len(expired))
+    for future in expired:
+      self._defer_cancel(future)
+
+  # @requires_lock
+  def _defer_cancel(self, future, hook='on_cancel'):
+    # Schedules the *future* to be cancelled by #_finish_cancelled() once
+    # the lock is released, as its done callbacks may enqueue futures into
+    # this pool (and block on a full queue). A future removed from the queue
+    # counts as running until then, so #wait() does not return early.
+    if hook == 'on_cancel':
+      self._running.add(future)
+    self._cancelled.append((future, hook))
+
+  def _finish_cancelled(self):
+    # Cancels the futures passed to #_defer_cancel(). Must be called
+    # without holding the lock.
+    done = []
+    while True:
+      try:
+        future, hook = self._cancelled.popleft()
+      except IndexError:
+        break
+      try:
+        future.cancel()
+        for obj in self._hooks:
+          getattr(obj, hook)(self, future)
+      finally:
+        done.append(future)
+    if done:
+      with self._lock:
+        self._running.difference_update(done)
+        self._lock.notify_all()
+
+  def _process(self, future):
+    # Runs a future in a worker thread.
+    hooks = self._hooks
+    if not hooks:
+      future.start(as_thread=False)
+      return
+    if future.cancelled():
+      for hook in hooks:
+        hook.on_cancel(self, future)
+      return
+    tstart = _clock()
+    for hook in hooks:
+      hook.on_start(self, future, tstart - (future._enqueue_time or tstart))
+    try:
+      future.start(as_thread=False)
+    finally:
+      runtime = _clock() - tstart
+      for hook in hooks:
+        hook.on_done(self, future, runtime)
+
+  def _check_stealing_options(self, priority, timeout):
+    if priority != PRIORITY_NORMAL or timeout is not None:
+      raise ValueError('priority and timeout are not supported by the '
+        'stealing scheduler')
+
+  def _enqueue_stealing(self, future, rescued=False):
+    # Note: This does not acquire the pool's lock unless a new worker needs
+    # to be spawned. The operations on the #collections.deque objects are
+    # atomic, and the order of operations here and in
+    # #_StealingWorker.run() ensures that no wakeup is lost.
+    #
+    # Rescued futures were already accepted, they are handed to a worker
+    # other than the current one (which is the retiring worker) even if
+    # the pool is shutting down.
+    if self._shutdown and not rescued:
+      raise RuntimeError('ThreadPool has been shut down and can no '
+        'longer accept futures.')
+    if self._hooks and not rescued:
+      future._enqueue_time = _clock()
+      for hook in self._hooks:
+        hook.on_enqueue(self, future)
+    current = threading.current_thread()
+    if not rescued and isinstance(current, self._StealingWorker) and current._master is self:
+      # Futures enqueued from within the pool stay with the worker.
+      current._tasks.append(future)
+    else:
+      try:
+        worker = self._idle.popleft()
+      except IndexError:
+        worker = None
+      if worker is not None:
+        worker._tasks.append(future)
+        worker._wakeup.set()
+        return
+      if self._new_worker(future):
+        return
+      workers = [w for w in self._workers if w is not current and not w._retired]
+      if not workers:
+        # All workers retired in the meantime, so there is room for a new one.
+        self._enqueue_stealing(future, rescued=True)
+        return
+      victim = workers[next(self._next_victim) % len(workers)]
+      victim._tasks.append(future)
+      if victim._retired:
+        # The worker retired after we got the list of workers, it won't
+        # see the future anymore.
+        self._rescue(victim)
+    # A worker may have become idle since we looked.
+    if self._idle:
+      self._wake_one()
+
+  def _rescue(self, worker):
+    # Re-enqueues the futures that ended up with a retired worker.
+    while True:
+      try:
+        future = worker._tasks.popleft()
+      except IndexError:
+        break
+      self._enqueue_stealing(future, rescued=True)
+
+  def _wake_one(self):
+    try:
+      worker = self._idle.popleft()
+    except IndexError:
+      return
+    worker._wakeup.set()
+
+  def cancel(self, cancel_running=True, mark_completed_as_cancelled=False):
+    """
+    Cancel all futures queued in the pool. If *cancel_running* is True,
+    futures that are currently running in the pool are cancelled as well.
+    """
+
+    with self._lock:
+      if self._scheduler == 'stealing':
+        for worker in self._workers:
+          while True:
+            try:
+              future = worker._tasks.popleft()
+            except IndexError:
+              break
+            self._release_slots()
+            future.cancel(mark_completed_as_cancelled)
+            for hook in self._hooks:
+              hook.on_cancel(self, future)
+          future = worker._current
+          if cancel_running and future is not None:
+            future.cancel(mark_completed_as_cancelled)
+        return
+      for future in self._queue:
+        future.cancel(mark_completed_as_cancelled)
+        for hook in self._hooks:
+          hook.on_cancel(self, future)
+      if cancel_running:
+        for future in self._running:
+          future.cancel(mark_completed_as_cancelled)
+      self._release_slots(len(self._queue))
+      self._queue.clear()
+
+  def shutdown(self, wait=True):
+    """
+    Shut down the pool. If *wait* is True, it will wait until all futures
+    are completed. Alternatively, you can use the #wait() method to wait
+    with timeout supported.
+    """
+
+    self._stop_timer()
+    with self._lock:
+      self._shutdown = True
+      self._lock.notify_all()
+    while self._idle:
+      self._wake_one()
+    if wait:
+      self.wait()
+
+  def wait(self, timeout=None):
+    """
+    Wait until all futures are completed. You should call this method only
+    after calling #shutdown(). Returns #False if all futures are complete,
+    #False if there are still some running.
+    """
+
+    tbegin = _get_timeout_begin(timeout)
+    with self._lock:
+      self._waiters += 1
+      try:
+        while not self._completed():
+          remainder = _get_timeout_remainder(tbegin, timeout)
+          if remainder is not None and remainder <= 0.0:
+            return False  # timeout
+          self._lock.wait(remainder)
+      finally:
+        self._waiters -= 1
+      workers = self._workers if self._shutdown else []
+    # Join outside of the lock, the workers need it to see that they're done.
+    for worker in workers:
+      worker.join()
+    return True
+
+  # @requires_lock
+  def _completed(self):
+    if self._scheduler != 'stealing':
+      return not self._queue and not self._running
+    # The workers of the stealing scheduler do not hold the lock when they
+    # take a future, so we check that none of them took one while we were
+    # looking. Every worker increments its tick counter before it looks
+    # for a future and is busy while it handles it.
+    workers = self._workers
+    ticks = [worker._ticks for worker in workers]
+    if any(worker._busy for worker in workers):
+      return False
+    if any(worker._tasks for worker in workers):
+      return False
+    return ticks == [worker._ticks for worker in workers]
+
+  def _new_worker(self, future=None):
+    with self._lock:
+      if len(self._workers) < self._max_workers:
+        if self._scheduler == 'stealing':
+          worker = self._StealingWorker(self)
+          if future is not None:
+            worker._tasks.append(future)
+        else:
+          worker = self._Worker(self)
+        worker.daemon = self._daemon
+        # Copy on write, the stealing scheduler reads it without the lock.
+        self._workers = self._workers + [worker]
+        worker.start()
+        return True
+    return False
+
+  def _retire(self, worker):
+    # Called by idle workers after *keepalive* seconds. Returns #True if
+    # the worker may exit.
+    with self._lock:
+      if self._shutdown or len(self._workers) <= self._min_workers:
+        return False
+      worker._retired = True
+      self._workers = [w for w in self._workers if w is not worker]
+      self._lock.notify_all()
+      return True
+
+  class _WorkerThread(threading.Thread):
+
+    def __init__(self, master):
+      threading.Thread.__init__(self)
+      self._master = master
+      self._retired = False
+      self.local = WorkerLocal()
+
+    def run(self):
+      master = self._master
+      if master._initializer is not None:
+        try:
+          master._initializer(*master._initargs)
+        except:
+          self._print_exception('initializer')
+      try:
+        self._work()
+      finally:
+        if master._finalizer is not None:
+          try:
+            master._finalizer()
+          except:
+            self._print_exception('finalizer')
+
+    def _print_exception(self, what):
+      print('Exception in {0} of {1}'.format(what, self.name), file=sys.stderr)
+      traceback.print_exc()
+      sys.stderr.flush()
+
+  class _Worker(_WorkerThread):
+
+    def _work(self):
+      keepalive = self._master._keepalive
+      while True:
+        with self._master._lock:
+          self._master._expire()
+          idle_since = None
+          while not self._master._queue and not self._master._cancelled:
+            if self._master._shutdown:
+              return
+            if keepalive is None:
+              self._master._lock.wait()
+              continue
+            now = _clock()
+            if idle_since is None:
+              idle_since = now
+            elif now - idle_since >= keepalive and self._master._retire(self):
+              return
+            self._master._lock.wait(keepalive)
+          future = None
+          if self._master._queue:
+            future = self._master._queue.popleft()
+            self._master._running.add(future)
+        if future is not None:
+          self._master._release_slots()
+        self._master._finish_cancelled()
+        if future is None:
+          continue
+        try:
+          self._master._process(future)
+        finally:
+          with self._master._lock:
+            self._master._running.remove(future)
+            self._master._lock.notify_all()
+
+  class _StealingWorker(_WorkerThread):
+
+    def __init__(self, master):
+      ThreadPool._WorkerThread.__init__(self, master)
+      self._tasks = collections.deque()
+      self._wakeup = threading.Event()
+      self._current = None
+      self._busy = True
+      self._ticks = 0
+
+    def _next_task(self):
+      self._ticks += 1
+      tasks = self._tasks
+      while tasks:
+        try:
+          return tasks.popleft()
+        except IndexError:  # Someone stole it in the meantime.
+          break
+      workers = self._master._workers
+      count = len(workers)
+      offset = self._ticks
+      for index in range(count):
+        tasks = workers[(offset + index) % count]._tasks
+        while tasks:
+          try:
+            return tasks.popleft()
+          except IndexError:
+            break
+      return None
+
+    def _leave_idle(self):
+      try:
+        self._master._idle.remove(self)
+      except ValueError:
+        # A producer already took us out of the idle list to hand us a
+        # future. Pass the wakeup on so it does not have to wait for us.
+        self._master._wake_one()
+
+    def _try_retire(self):
+      try:
+        self._master._idle.remove(self)
+      except ValueError:
+        return False  # A producer just handed us a future.
+      if not self._master._retire(self):
+        return False
+      self._master._rescue(self)
+      return True
+
+    def _work(self):
+      master = self._master
+      while True:
+        future = self._next_task()
+        if future is None:
+          # Register as idle before checking the queues again, otherwise a
+          # future enqueued in between could go unnoticed.
+          self._wakeup.clear()
+          master._idle.append(self)
+          future = self._next_task()
+          if future is None:
+            self._busy = False
+            if master._waiters:
+              with master._lock:
+                master._lock.notify_all()
+            if master._shutdown:
+              return
+            if not self._wakeup.wait(master._keepalive) and self._try_retire():
+              return
+            self._busy = True
+            continue
+          self._leave_idle()
+        master._release_slots()
+        self._current = future
+        try:
+          master._process(future)
+        finally:
+          self._current = None
+
+
+class WorkerLocal(object):
+  """
+  A namespace for the resources of a #ThreadPool worker thread, see
+  #worker_local().
+  """
+
+
+def worker_local():
+  """
+  Returns the #WorkerLocal namespace of the current #ThreadPool worker
+  thread. Futures can store resources in it that are expensive to create
+  and that can be reused by all futures processed by the same worker, eg.
+  a database connection. The namespace lives as long as the worker thread;
+  use the #ThreadPool *initializer* and *finalizer* to create and release
+  the resources.
+
+  ```python
+  def connect():
+    worker_local().db = open_database()
+  def disconnect():
+    worker_local().db.close()
+  pool = ThreadPool(4, initializer=connect, finalizer=disconnect)
+  pool.submit(lambda: worker_local().db.query(...))
+  ```
+
+  # Raises
+  RuntimeError: If the current thread is not a #ThreadPool worker.
+  """
+
+  thread = threading.current_thread()
+  if not isinstance(thread, ThreadPool._WorkerThread):
+    raise RuntimeError('worker_local() must be called from a ThreadPool worker')
+  return thread.local
+
+
+class ProcessPool(_Executor):
+  """
+  Processes futures in child processes, allowing CPU bound workers to run
+  in parallel without being serialized by the GIL. The interface is the
+  same as for #ThreadPool and the futures behave the same way, except that
+  the worker function bound to a future, its arguments and its result must
+  be picklable.
+
+  Errors are propagated to the future. If the worker or its result can not
+  be pickled, the pickling error is set in the future. If the exception
+  raised by the worker can not be pickled, a #RemoteError is set instead.
+  If a child process dies unexpectedly, all futures that are not yet
+  completed receive a #BrokenPool error and the pool can no longer be
+  used.
+
+  Cancelling a future prevents it from being sent to a child process. Once
+  it has been sent, it runs to completion.
+
+  :param max_workers: The number of child processes. Defaults to the
+    number of CPUs.
+  :param chunksize: The maximum number of futures that are sent to a child
+    process in one message. Futures that are enqueued faster than the child
+    processes consume them are batched, which reduces the communication
+    overhead for many small tasks.
+  :param daemon: Whether the child processes are daemonic.
+  """
+
+  def __init__(self, max_workers=None, chunksize=1, daemon=True):
+    if max_workers is None:
+      max_workers = multiprocessing.cpu_count()
+    if max_workers < 1:
+      raise ValueError('max_workers must be at least 1')
+    if chunksize < 1:
+      raise ValueError('chunksize must be at least 1')
+    self._max_workers = max_workers
+    self._chunksize = chunksize
+    self._daemon = daemon
+    self._queue = collections.deque()
+    self._inflight = {}
+    self._chunk_ids = itertools.count()
+    self._lock = threading.Condition()
+    self._shutdown = False
+    self._broken = False
+    self._processes = []
+    self._threads = []
+    self._call_queue = None
+    self._result_queue = None
+
+  def enqueue(self, future):
+    """
+    Enqueue a future to be processed by one of the child processes. The
+    future must be bound to a worker and not have been started yet.
+    """
+
+    with self._lock:
+      self._check_accepting()
+      future.enqueue()
+      if not self._processes:
+        self._start()
+      self._queue.append(future)
+      self._lock.notify_all()
+
+  def enqueue_many(self, futures):
+    """
+    Enqueue all *futures* with a single acquisition of the pool's lock. If
+    the pool rejects them, they are cancelled.
+    """
+
+    futures = list(futures)
+    queued = 0
+    try:
+      with self._lock:
+        try:
+          self._check_accepting()
+          if not self._processes:
+            self._start()
+          for future in futures:
+            future.enqueue()
+            self._queue.append(future)
+            queued += 1
+        finally:
+          self._lock.notify_all()
+    except:
+      # Nobody would ever run the rest of the batch.
+      for future in futures[queued:]:
+        future.cancel()
+      raise
+
+  # @requires_lock
+  def _check_accepting(self):
+    if self._shutdown:
+      raise RuntimeError('ProcessPool has been shut down and can no '
+        'longer accept futures.')
+    if self._broken:
+      raise BrokenPool('a child process of the ProcessPool terminated abruptly')
+
+  def cancel(self, cancel_running=True, mark_completed_as_cancelled=False):
+    """
+    Cancel all futures queued in the pool. If *cancel_running* is True,
+    futures that have already been sent to a child process are cancelled
+    as well (they will still run to completion).
+    """
+
+    with self._lock:
+      for future in self._queue:
+        future.cancel(mark_completed_as_cancelled)
+      if cancel_running:
+        for futures in self._inflight.values():
+          for future in futures:
+            future.cancel(mark_completed_as_cancelled)
+      self._queue.clear()
+      self._lock.notify_all()
+
+  def shutdown(self, wait=True):
+    """
+    Shut down the pool. The child processes exit after all queued futures
+    have been processed. If *wait* is True, it will wait until that is the
+    case.
+    """
+
+    self._stop_timer()
+    with self._lock:
+      self._shutdown = True
+      self._lock.notify_all()
+    if wait:
+      self.wait()
+
+  def wait(self, timeout=None):
+    """
+    Wait until all futures are completed. Returns #True if all futures are
+    complete, #False if the *timeout* expired before that.
+    """
+
+    tbegin = _get_timeout_begin(timeout)
+    with self._lock:
+      while self._queue or self._inflight:
+        remainder = _get_timeout_remainder(tbegin, timeout)
+        if remainder is not None and remainder <= 0.0:
+          return False  # timeout
+        self._lock.wait(remainder)
+      joinables = self._threads + self._processes if self._shutdown else []
+    for obj in joinables:
+      obj.join()
+    return True
+
+  # @requires_lock
+  def _start(self):
+    self._call_queue = multiprocessing.Queue()
+    self._result_queue = multiprocessing.Queue()
+    # Start the processes before the threads, forking a process with other
+    # threads running is asking for trouble.
+    for _ in range(self._max_workers):
+      process = multiprocessing.Process(target=_process_worker,
+        args=(self._call_queue, self._result_queue))
+      process.daemon = self._daemon
+      process.start()
+      self._processes.append(process)
+    for target in (self._feed, self._collect):
+      thread = threading.Thread(target=target)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _feed(self):
+    # Sends the enqueued futures to the child processes in chunks.
+    while True:
+      with self._lock:
+        # Keep at most one chunk per child process waiting in the call
+        # queue, the rest stays here where it can still be cancelled and
+        # batched with futures enqueued later.
+        while not self._broken:
+          if self._queue and len(self._inflight) <= self._max_workers:
+            break
+          if self._shutdown and not self._queue:
+            break
+          self._lock.wait()
+        if self._broken or not self._queue:
+          break
+        count = min(self._chunksize, len(self._queue))
+        futures = [self._queue.popleft() for _ in range(count)]
+        chunk_id = next(self._chunk_ids)
+        self._inflight[chunk_id] = futures  # Still counts as queued for wait().
+
+      batch, items = [], []
+      for future in futures:
+        with future._lock:
+          worker = future._mark_running()
+        if worker is None:
+          continue
+        try:
+          items.append(pickle.dumps(worker, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+          future._complete(None, sys.exc_info())
+        else:
+          batch.append(future)
+
+      with self._lock:
+        broken = self._broken
+        if broken:
+          pass  # #_break() cleared the in-flight chunks already.
+        elif batch:
+          self._inflight[chunk_id] = batch
+        else:
+          del self._inflight[chunk_id]
+          self._lock.notify_all()
+      if broken:
+        _fail_broken(batch)
+        break
+      if items:
+        self._call_queue.put((chunk_id, items))
+
+    if not self._broken:
+      for _ in self._processes:
+        self._call_queue.put(None)
+
+  def _collect(self):
+    # Receives the results from the child processes and completes the
+    # futures. Also detects child processes that died unexpectedly.
+    while True:
+      try:
+        chunk_id, results = self._result_queue.get(timeout=0.1)
+      except _queue.Empty:
+        with self._lock:
+          if self._shutdown and not self._queue and not self._inflight:
+            break
+        if any(p.exitcode not in (None, 0) for p in self._processes):
+          self._break()
+          break
+        continue
+      with self._lock:
+        futures = self._inflight.get(chunk_id)
+      if futures is None:
+        continue  # The pool broke in the meantime.
+      for future, data in zip(futures, results):
+        try:
+          success, value, tb = pickle.loads(data)
+        except Exception:
+          success, value, tb = False, RemoteError('result could not be '
+            'unpickled:\n' + traceback.format_exc()), None
+        if success:
+          future._complete(value, None)
+        else:
+          if tb is not None:
+            value.__cause__ = _RemoteTraceback(tb)
+          exc_info = (type(value), value, None)
+          if future._state & _PRINT_EXC:
+            future._print_exception(exc_info)
+          future._complete(None, exc_info)
+      with self._lock:
+        self._inflight.pop(chunk_id, None)
+        self._lock.notify_all()
+
+  def _break(self):
+    with self._lock:
+      self._broken = True
+      futures = list(self._queue)
+      for batch in self._inflight.values():
+        futures.extend(batch)
+      self._queue.clear()
+      self._inflight.clear()
+      self._lock.notify_all()
+    for process in self._processes:
+      if process.exitcode is None:
+        process.terminate()
+    _fail_broken(futures)
+
+
+def _fail_broken(futures):
+  # Completes the *futures* of a broken #ProcessPool that are not done yet.
+  for future in futures:
+    if not future._state & _COMPLETED:
+      try:
+        raise BrokenPool('a child process of the ProcessPool terminated abruptly')
+      except BrokenPool:
+        future._complete(None, sys.exc_info())
+
+
+def _process_worker(call_queue, result_queue):
+  # Main loop of the #ProcessPool child processes. Every item and result is
+  # pickled separately so that a pickling error only affects one future.
+  while True:
+    chunk = call_queue.get()
+    if chunk is None:
+      break
+    chunk_id, items = chunk
+    results = []
+    for data in items:
+      try:
+        data = pickle.dumps((True, pickle.loads(data)(), None), pickle.HIGHEST_PROTOCOL)
+      except BaseException as exc:
+        data = _pickle_exception(exc, traceback.format_exc())
+      results.append(data)
+    result_queue.put((chunk_id, results))
+
+
+def _pickle_exception(exc, tb):
+  # Some exceptions can be pickled but not unpickled, so we check both.
+  try:
+    data = pickle.dumps((False, exc, tb), pickle.HIGHEST_PROTOCOL)
+    pickle.loads(data)
+  except Exception:
+    data = pickle.dumps((False, RemoteError(tb), None), pickle.HIGHEST_PROTOCOL)
+  return data
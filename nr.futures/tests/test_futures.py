@@ -1,6 +1,12 @@
 
 from nose.tools import *
-from nr.futures import Future, ThreadPool
+import threading
+import time
+import weakref
+from nr.futures import (Future, ThreadPool, ProcessPool, RemoteError, Timeout,
+  Overloaded, wrap_asyncio_future, as_completed, wait, gather, FIRST_COMPLETED,
+  FIRST_EXCEPTION, PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH, PoolHooks,
+  TaskGraph, ResultCache, worker_local, BrokenPool)
 
 
 def test_set_exception():
@@ -16,3 +22,748 @@ def test_set_result():
   f.set_result(42)
   assert_equals(f.result(), 42)
   assert f.done()
+
+
+def test_thread_pool():
+  for scheduler in ThreadPool.SCHEDULERS:
+    with ThreadPool(4, scheduler=scheduler) as pool:
+      futures = [pool.submit(lambda x: x * 2, i) for i in range(200)]
+    assert_equals([f.result() for f in futures], [i * 2 for i in range(200)])
+
+
+def test_stealing_scheduler_nested_submit():
+  pool = ThreadPool(4, scheduler='stealing')
+  def worker(depth):
+    if depth == 0:
+      return 1
+    children = [pool.submit(worker, depth - 1) for _ in range(3)]
+    return children
+  root = pool.submit(worker, 4)
+  # Wait for all the nested futures, then flatten the tree.
+  assert pool.wait(timeout=10)
+  def count(value):
+    if isinstance(value, list):
+      return sum(count(f.result()) for f in value)
+    return value
+  assert_equals(count(root.result()), 3 ** 4)
+  pool.shutdown()
+
+
+def test_stealing_scheduler_cancel():
+  pool = ThreadPool(1, scheduler='stealing')
+  event = threading.Event()
+  blocker = pool.submit(event.wait)
+  futures = [pool.submit(lambda: None) for _ in range(10)]
+  pool.cancel(cancel_running=False)
+  event.set()
+  pool.shutdown()
+  assert blocker.done()
+  assert all(f.cancelled() for f in futures)
+  with assert_raises(ValueError):
+    ThreadPool(1, bounded=True, scheduler='stealing', overflow='drop_oldest')
+
+
+def _square(x):
+  return x * x
+
+
+def _fail(message):
+  raise ValueError(message)
+
+
+class _Unpicklable(Exception):
+  def __init__(self, a, b):
+    Exception.__init__(self, a)
+
+
+def _fail_unpicklable():
+  raise _Unpicklable(1, 2)
+
+
+def test_stealing_scheduler_retire_race():
+  # A producer hands a future to a worker after the worker took itself out
+  # of the idle list but before it retired. The retiring worker must pass
+  # it on to another worker instead of keeping it.
+  pool = ThreadPool(1, scheduler='stealing', keepalive=0.05)
+  late = Future().bind(_square, 5)
+  retire = pool._retire
+  def racy_retire(worker):
+    if not late.enqueued():
+      late.enqueue()
+      worker._tasks.append(late)
+    return retire(worker)
+  pool._retire = racy_retire
+  assert_equals(pool.submit(_square, 2).result(timeout=1), 4)
+  assert_equals(late.result(timeout=2), 25)
+  pool.shutdown()
+
+
+def test_process_pool():
+  with ProcessPool(2, chunksize=8) as pool:
+    futures = [pool.submit(_square, i) for i in range(100)]
+    failed = pool.submit(_fail, 'foo')
+    unpicklable = pool.submit(_fail_unpicklable)
+    local = pool.submit(lambda: None)
+  assert_equals([f.result() for f in futures], [i * i for i in range(100)])
+  with assert_raises(ValueError):
+    failed.result()
+  with assert_raises(RemoteError):
+    unpicklable.result()
+  assert local.exception() is not None
+
+
+def test_process_pool_cancel():
+  pool = ProcessPool(1)
+  blocker = pool.submit(time.sleep, 0.5)
+  while not blocker.running():
+    time.sleep(0.01)
+  futures = [pool.submit(_square, i) for i in range(10)]
+  pool.cancel(cancel_running=False)
+  pool.shutdown()
+  assert blocker.done()
+  # One more chunk may already have been sent to the child process.
+  assert sum(f.cancelled() for f in futures) >= 9
+
+
+class _BreaksPoolWhenPickled(object):
+  pool = None
+  def __call__(self):
+    return 42
+  def __reduce__(self):
+    # Runs in the feeder thread while it does not hold the pool's lock. A
+    # child process dies, and the collector breaks the pool and exits.
+    for process in self.pool._processes:
+      process.terminate()
+      process.join()
+    self.pool._threads[1].join(5)
+    return (_square, (2,))
+
+
+def test_process_pool_break_while_feeding():
+  pool = ProcessPool(1)
+  task = _BreaksPoolWhenPickled()
+  task.pool = pool
+  future = pool.submit(task)
+  thread = threading.Thread(target=pool.shutdown)
+  thread.daemon = True
+  thread.start()
+  thread.join(5)
+  assert not thread.is_alive(), 'ProcessPool.shutdown() hangs'
+  assert pool.wait(timeout=1), 'stale in-flight chunk'
+  with assert_raises(BrokenPool):
+    future.result(timeout=1)
+
+
+def test_process_pool_rejects_before_enqueue():
+  pool = ProcessPool(1)
+  pool.shutdown()
+  future = Future().bind(_square, 2)
+  with assert_raises(RuntimeError):
+    pool.enqueue(future)
+  assert not future.enqueued()
+  batch = [Future().bind(_square, i) for i in range(3)]
+  with assert_raises(RuntimeError):
+    pool.enqueue_many(batch)
+  assert all(f.cancelled() for f in batch)
+
+  pool = ProcessPool(1)
+  pool._broken = True
+  with assert_raises(BrokenPool):
+    pool.enqueue(future)
+  assert not future.enqueued()
+  batch = [Future().bind(_square, i) for i in range(3)]
+  with assert_raises(BrokenPool):
+    pool.enqueue_many(batch)
+  assert all(f.cancelled() for f in batch)
+
+
+def _invert(x):
+  return 1.0 / x
+
+
+def test_submit_many():
+  for kwargs in [{'scheduler': 'fifo'}, {'scheduler': 'stealing'}, {'bounded': True},
+                 {'bounded': True, 'scheduler': 'stealing'}]:
+    with ThreadPool(3, **kwargs) as pool:
+      futures = pool.submit_many(_square, range(100), chunksize=16)
+    assert_equals([f.result() for f in futures], [i * i for i in range(100)])
+
+
+def test_map():
+  with ThreadPool(4) as pool:
+    assert_equals(list(pool.map(_square, range(100), chunksize=7)),
+                  [i * i for i in range(100)])
+    assert_equals(sorted(pool.map(_square, range(100), chunksize=7, ordered=False)),
+                  [i * i for i in range(100)])
+    results = list(pool.map(_invert, [1, 0, 2], return_exceptions=True))
+    assert_equals(results[0], 1.0)
+    assert isinstance(results[1], ZeroDivisionError)
+    assert_equals(results[2], 0.5)
+    with assert_raises(ZeroDivisionError):
+      list(pool.map(_invert, [1, 0, 2]))
+
+    # The iterable is consumed lazily.
+    consumed = []
+    def items():
+      for i in range(1000):
+        consumed.append(i)
+        yield i
+    results = pool.map(_square, items(), chunksize=10, window=2)
+    assert_equals(next(results), 0)
+    assert len(consumed) <= 30
+    results.close()
+
+  with ProcessPool(2) as pool:
+    assert_equals(list(pool.map(_square, range(50), chunksize=8)),
+                  [i * i for i in range(50)])
+
+
+def test_asyncio():
+  try:
+    import asyncio
+  except ImportError:
+    return
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  try:
+    with ThreadPool(4) as pool:
+      def in_loop(fun):
+        # Calls *fun* from within the running loop and waits for the
+        # asyncio future it returns.
+        result = loop.create_future()
+        def copy(future):
+          if future.exception() is not None:
+            result.set_exception(future.exception())
+          else:
+            result.set_result(future.result())
+        loop.call_soon(lambda: fun().add_done_callback(copy))
+        return loop.run_until_complete(result)
+
+      results = in_loop(lambda: asyncio.gather(*[pool.run_in_pool(_square, i) for i in range(20)]))
+      assert_equals(results, [i * i for i in range(20)])
+
+      future = pool.submit(_square, 3)
+      assert_equals(loop.run_until_complete(asyncio.ensure_future(future, loop=loop)), 9)
+
+      with assert_raises(ZeroDivisionError):
+        in_loop(lambda: pool.run_in_pool(_invert, 0))
+
+      # The asyncio future is bound to the running loop, there is none here.
+      with assert_raises(RuntimeError):
+        pool.run_in_pool(_square, 2)
+
+    afut = loop.create_future()
+    future = wrap_asyncio_future(afut)
+    loop.call_soon(afut.set_result, 42)
+    loop.run_until_complete(afut)
+    assert_equals(future.result(timeout=1), 42)
+
+    afut = loop.create_future()
+    future = wrap_asyncio_future(afut)
+    future.cancel()
+    loop.run_until_complete(asyncio.sleep(0))
+    assert afut.cancelled()
+  finally:
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def test_as_completed():
+  events = [threading.Event() for _ in range(3)]
+  with ThreadPool(3) as pool:
+    futures = [pool.submit(e.wait) for e in events]
+    order = []
+    def release():
+      for i in (2, 0, 1):
+        events[i].set()
+        while not futures[i].done():
+          time.sleep(0.001)
+    threading.Thread(target=release).start()
+    for future in as_completed(futures + futures, timeout=10):
+      order.append(futures.index(future))
+    assert_equals(order, [2, 0, 1])
+
+  event = threading.Event()
+  with ThreadPool(1) as pool:
+    future = pool.submit(event.wait)
+    with assert_raises(Timeout):
+      list(as_completed([future], timeout=0.05))
+    event.set()
+
+  # The done callbacks are removed from the futures that did not complete.
+  pending, done = Future(), Future()
+  done.set_result(1)
+  with assert_raises(Timeout):
+    list(as_completed([pending], timeout=0.01))
+  assert not pending._callbacks
+  for _ in as_completed([done, pending]):
+    break
+  assert not pending._callbacks
+
+
+def test_wait_and_gather():
+  event = threading.Event()
+  with ThreadPool(4) as pool:
+    slow = pool.submit(event.wait)
+    fast = pool.submit(_square, 2)
+    failed = pool.submit(_invert, 0)
+    done, not_done = wait([slow, fast], return_when=FIRST_COMPLETED)
+    assert_equals((done, not_done), ({fast}, {slow}))
+    done, not_done = wait([slow, failed], return_when=FIRST_EXCEPTION)
+    assert_equals((done, not_done), ({failed}, {slow}))
+    done, not_done = wait([slow, fast], timeout=0.05)
+    assert_equals((done, not_done), ({fast}, {slow}))
+    with assert_raises(Timeout):
+      gather([slow, fast], timeout=0.05)
+    event.set()
+    assert_equals(gather([fast, slow]), [4, True])
+    with assert_raises(ZeroDivisionError):
+      gather([fast, failed])
+    results = gather([fast, failed], return_exceptions=True)
+    assert_equals(results[0], 4)
+    assert isinstance(results[1], ZeroDivisionError)
+
+  cancelled = Future(lambda: None)
+  cancelled.cancel()
+  assert_equals(wait([cancelled], timeout=1).done, {cancelled})
+
+
+def test_priority_and_timeout():
+  event = threading.Event()
+  order = []
+  with ThreadPool(1) as pool:
+    blocker = pool.submit(event.wait)
+    while not blocker.running():
+      time.sleep(0.001)
+    for name, priority in [('low', PRIORITY_LOW), ('normal', PRIORITY_NORMAL),
+                           ('high', PRIORITY_HIGH), ('normal2', PRIORITY_NORMAL)]:
+      pool.enqueue(Future().bind(order.append, name), priority=priority)
+    expired = Future().bind(order.append, 'expired')
+    pool.enqueue(expired, priority=PRIORITY_HIGH, timeout=0.01)
+    time.sleep(0.05)
+    event.set()
+  assert_equals(order, ['high', 'normal', 'normal2', 'low'])
+  assert expired.cancelled()
+
+
+def test_expired_continuation_enqueues_into_full_pool():
+  # The expired future is cancelled outside of the pool's lock and after its
+  # slot was released, so the continuation can be submitted to the pool.
+  event = threading.Event()
+  pool = ThreadPool(1, bounded=True)
+  blocker = pool.submit(event.wait)
+  while not blocker.running():
+    time.sleep(0.001)
+  expired = Future().bind(_square, 2)
+  pool.enqueue(expired, timeout=0.01)
+  continuation = expired.then(lambda f: f.cancelled(), pool)
+  time.sleep(0.05)
+  event.set()
+  assert continuation.wait(2)
+  assert_equals(continuation.result(), True)
+  pool.shutdown(wait=False)
+  assert pool.wait(timeout=2)
+
+
+def test_max_queue_wait():
+  event = threading.Event()
+  with ThreadPool(1, max_queue_wait=0.01) as pool:
+    pool.submit(event.wait)
+    waiting = pool.submit(_square, 2)
+    time.sleep(0.05)
+    rejected = Future().bind(_square, 3)
+    with assert_raises(Overloaded):
+      pool.enqueue(rejected)
+    assert rejected.cancelled()
+    urgent = Future().bind(_square, 4)
+    pool.enqueue(urgent, priority=PRIORITY_HIGH)
+    event.set()
+  assert_equals(waiting.result(), 4)
+  assert_equals(urgent.result(), 16)
+
+
+def test_stealing_rejects_options_before_enqueue():
+  with ThreadPool(1, scheduler='stealing') as pool:
+    future = Future().bind(_square, 3)
+    with assert_raises(ValueError):
+      pool.enqueue(future, priority=PRIORITY_HIGH)
+    with assert_raises(ValueError):
+      pool.enqueue_many([future], timeout=1)
+    assert not future.enqueued()
+    pool.enqueue(future)
+  assert_equals(future.result(), 9)
+
+
+def test_enqueue_many_cancels_rejected_batch():
+  event = threading.Event()
+  with ThreadPool(1, max_queue_wait=0.01) as pool:
+    pool.submit(event.wait)
+    pool.submit(_square, 2)
+    time.sleep(0.05)
+    batch = [Future().bind(_square, i) for i in range(3)]
+    with assert_raises(Overloaded):
+      pool.enqueue_many(batch)
+    assert all(f.cancelled() for f in batch)
+    event.set()
+  for kwargs in [{}, {'scheduler': 'stealing'}, {'bounded': True}]:
+    pool = ThreadPool(1, **kwargs)
+    pool.shutdown()
+    batch = [Future().bind(_square, i) for i in range(3)]
+    with assert_raises(RuntimeError):
+      pool.enqueue_many(batch)
+    assert all(f.cancelled() for f in batch), kwargs
+
+
+def test_elastic_workers():
+  for scheduler in ThreadPool.SCHEDULERS:
+    pool = ThreadPool(4, scheduler=scheduler, min_workers=1, keepalive=0.05, prestart=True)
+    assert_equals(len(pool._workers), 1)
+    events = [threading.Event() for _ in range(4)]
+    futures = [pool.submit(e.wait) for e in events]
+    while not all(f.running() for f in futures):
+      time.sleep(0.001)
+    assert_equals(len(pool._workers), 4)
+    for event in events:
+      event.set()
+    time.sleep(0.5)
+    assert_equals(len(pool._workers), 1)
+    assert_equals(pool.submit(_square, 3).result(timeout=1), 9)
+    pool.shutdown()
+
+
+def test_schedule():
+  order = []
+  with ThreadPool(2) as pool:
+    tstart = time.time()
+    late = pool.schedule(0.1, order.append, 'late')
+    early = pool.schedule(0.02, order.append, 'early')
+    cancelled = pool.schedule(0.05, order.append, 'cancelled')
+    cancelled.cancel()
+    late.wait(timeout=1)
+    assert time.time() - tstart >= 0.1
+    assert early.done()
+    assert_equals(order, ['early', 'late'])
+
+    calls = []
+    periodic = pool.schedule_at_fixed_rate(0, 0.01, calls.append, None)
+    while len(calls) < 5:
+      time.sleep(0.005)
+    periodic.cancel()
+    count = len(calls)
+    time.sleep(0.05)
+    assert len(calls) <= count + 1
+
+    failing = pool.schedule_at_fixed_rate(0, 0.01, _invert, 0)
+    with assert_raises(ZeroDivisionError):
+      failing.result(timeout=1)
+
+    pending = pool.schedule(10, order.append, 'never')
+  assert pending.cancelled()
+
+
+def test_schedule_into_full_pool():
+  # The timer thread neither blocks on the full queue nor runs the future.
+  for overflow in ['block', 'caller_runs']:
+    event = threading.Event()
+    pool = ThreadPool(1, bounded=True, overflow=overflow)
+    blocker = pool.submit(event.wait)
+    while not blocker.running():
+      time.sleep(0.001)
+    queued = pool.submit(_square, 2)
+    scheduled = pool.schedule(0.01, threading.current_thread)
+    time.sleep(0.05)
+    timer = pool._timer
+    assert not scheduled.done()
+    if overflow == 'block':
+      pool._stop_timer()
+      timer.join(1)
+      assert not timer.is_alive(), 'timer thread blocks'
+      assert scheduled.cancelled()
+    else:
+      event.set()
+      assert scheduled.result(timeout=1) is not timer
+    event.set()
+    pool.shutdown()
+    assert_equals(queued.result(), 4)
+
+  # Errors other than a shut down pool end up in the scheduled futures.
+  pool = ProcessPool(1)
+  pool._broken = True
+  scheduled = pool.schedule(0, _square, 2)
+  periodic = pool.schedule_at_fixed_rate(0, 0.01, _square, 2)
+  with assert_raises(BrokenPool):
+    scheduled.result(timeout=1)
+  with assert_raises(BrokenPool):
+    periodic.result(timeout=1)
+  pool.shutdown()
+
+
+def test_wait_is_notified():
+  for complete in [lambda f: f.set_result(1), lambda f: f.set_exception(ValueError()),
+                   lambda f: f.cancel()]:
+    future = Future()
+    threading.Timer(0.01, complete, [future]).start()
+    tstart = time.time()
+    assert future.wait(timeout=5)
+    assert time.time() - tstart < 1
+
+
+def test_metrics():
+  for scheduler in ThreadPool.SCHEDULERS:
+    events = []
+    class Hooks(PoolHooks):
+      def on_start(self, pool, future, queue_time):
+        events.append(('start', queue_time >= 0))
+      def on_done(self, pool, future, run_time):
+        events.append(('done', run_time >= 0.01))
+    with ThreadPool(2, scheduler=scheduler, hooks=[Hooks()], metrics=True) as pool:
+      for i in range(4):
+        pool.submit(time.sleep, 0.01)
+      pool.submit(_invert, 0)
+      cancelled = Future(lambda: None)
+      pool.enqueue(cancelled)
+      cancelled.cancel()
+    snapshot = pool.metrics.snapshot()
+    assert_equals(snapshot['enqueued'], 6)
+    assert_equals(snapshot['completed'] + snapshot['cancelled'], 5)
+    assert_equals(snapshot['failed'], 1)
+    assert_equals(snapshot['queue_depth'], 0)
+    assert_equals(snapshot['running'], 0)
+    assert_equals(snapshot['run_time']['count'], snapshot['started'])
+    assert snapshot['run_time']['max'] >= 0.01
+    assert snapshot['run_time']['p50'] <= snapshot['run_time']['max']
+    assert events.count(('start', True)) == snapshot['started']
+    assert events.count(('done', True)) == 4
+
+
+def test_future_is_compact():
+  future = Future(lambda: 42)
+  assert not hasattr(future, '__dict__')
+  assert future._cond is None and future._callbacks is None
+  assert weakref.ref(future)() is future
+  assert not future.wait(0.01)
+  assert future._cond is not None
+  calls = []
+  future.add_done_callback(calls.append)
+  future.start(as_thread=False)
+  assert_equals(future.result(), 42)
+  assert_equals(calls, [future])
+  future.add_done_callback(calls.append)
+  assert_equals(calls, [future, future])
+
+
+def test_task_graph():
+  def sleep_and_return(value, seconds=0.05):
+    time.sleep(seconds)
+    return value
+  with ThreadPool(4) as pool:
+    graph = TaskGraph(pool)
+    graph.add('a', sleep_and_return, args=[1])
+    graph.add('b', sleep_and_return, args=[2])
+    graph.add('slow', sleep_and_return, args=[3], kwargs={'seconds': 0.1})
+    graph.add('c', lambda a, b: a + b, deps=['a', 'b'])
+    graph.add('d', lambda c, slow, x: c * slow + x, deps=['c', 'slow'], args=[1])
+    with assert_raises(ValueError):
+      graph.add('e', sum, deps=['unknown'])
+    tstart = time.time()
+    results = graph.run(timeout=5).results()
+    assert time.time() - tstart < 0.14  # a, b and slow ran in parallel
+    assert_equals(dict(results), {'a': 1, 'b': 2, 'slow': 3, 'c': 3, 'd': 10})
+    seconds, nodes = graph.critical_path()
+    assert_equals(nodes, ['slow', 'd'])
+    assert seconds >= 0.1
+    assert_equals(list(graph.timings()), ['a', 'b', 'slow', 'c', 'd'])
+
+    graph = TaskGraph(pool)
+    graph.add('fail', _invert, args=[0])
+    graph.add('cancel', time.sleep, args=[0])
+    graph['cancel'].cancel()
+    graph.add('x', _invert, deps=['fail'])
+    graph.add('y', _invert, deps=['x', 'cancel'])
+    graph.add('z', lambda c: c, deps=['cancel'])
+    graph.run(timeout=5)
+    with assert_raises(ZeroDivisionError):
+      graph.result('x')
+    assert graph['y'].done() or graph['y'].cancelled()
+    assert graph['z'].cancelled()
+    with assert_raises(ZeroDivisionError):
+      graph.results()
+
+
+def test_submit_keyed():
+  calls = []
+  def compute(x):
+    calls.append(x)
+    time.sleep(0.05)
+    return x * 2
+  with ThreadPool(4, result_cache=ResultCache(maxsize=2, ttl=0.2)) as pool:
+    futures = [pool.submit_keyed(('compute', 1), compute, 1) for _ in range(4)]
+    assert all(f is futures[0] for f in futures)
+    assert_equals(futures[0].result(), 2)
+    time.sleep(0.01)  # The result is cached in a done callback.
+    assert pool.submit_keyed(('compute', 1), compute, 1).done()
+    assert_equals(pool.submit_keyed(('compute', 1), compute, 1).result(), 2)
+    assert_equals(calls, [1])
+    assert_equals((pool.result_cache.hits, pool.result_cache.misses), (2, 1))
+
+    # Failures are not cached, the least recently used result is evicted.
+    failed = pool.submit_keyed('fail', _invert, 0)
+    with assert_raises(ZeroDivisionError):
+      failed.result()
+    assert pool.submit_keyed('fail', _invert, 0) is not failed
+    for x in (2, 3):
+      pool.submit_keyed(('compute', x), compute, x).result()
+    assert_equals(pool.submit_keyed(('compute', 1), compute, 1).result(), 2)
+    assert_equals(calls, [1, 2, 3, 1])
+
+    # Results expire after the ttl.
+    time.sleep(0.2)
+    assert not pool.submit_keyed(('compute', 1), compute, 1).done()
+
+
+def test_continuations():
+  with ThreadPool(1) as pool:
+    # With a single worker, a continuation that blocked would deadlock.
+    source = pool.submit(_square, 3)
+    chained = source.map(_square, pool).map(lambda x: x + 1).then(lambda f: f.result() * 2)
+    assert_equals(chained.result(timeout=1), 164)
+
+    failed = pool.submit(_invert, 0).map(_square)
+    with assert_raises(ZeroDivisionError):
+      failed.result(timeout=1)
+    recovered = failed.recover(lambda exc: type(exc).__name__, pool)
+    assert_equals(recovered.result(timeout=1), 'ZeroDivisionError')
+    assert_equals(source.recover(lambda exc: None).result(timeout=1), 9)
+
+    flat = source.flat_map(lambda x: pool.submit(_square, x), pool)
+    assert_equals(flat.result(timeout=1), 81)
+    with assert_raises(TypeError):
+      source.flat_map(_square).result(timeout=1)
+
+  pending = Future()
+  mapped = pending.map(_square)
+  seen = pending.then(lambda f: f.cancelled())
+  pending.cancel()
+  assert mapped.cancelled()
+  assert_equals(seen.result(), True)
+
+
+def test_bounded_policies():
+  for scheduler in ThreadPool.SCHEDULERS:
+    event = threading.Event()
+    with ThreadPool(1, bounded=True, scheduler=scheduler, overflow='raise') as pool:
+      pool.submit(event.wait)
+      time.sleep(0.02)
+      queued = pool.submit(_square, 2)
+      with assert_raises(Overloaded):
+        pool.submit(_square, 3)
+      event.set()
+    assert_equals(queued.result(), 4)
+
+    event.clear()
+    with ThreadPool(1, bounded=True, scheduler=scheduler, overflow='caller_runs') as pool:
+      pool.submit(event.wait)
+      time.sleep(0.02)
+      pool.submit(_square, 2)
+      future = pool.submit(threading.current_thread)
+      assert future.done()
+      assert_equals(future.result(), threading.current_thread())
+      event.set()
+
+    event.clear()
+    with ThreadPool(1, bounded=True, scheduler=scheduler, overflow_timeout=0.05) as pool:
+      pool.submit(event.wait)
+      time.sleep(0.02)
+      pool.submit(_square, 2)
+      tstart = time.time()
+      with assert_raises(Overloaded):
+        pool.submit(_square, 3)
+      assert time.time() - tstart >= 0.05
+      event.set()
+
+  event.clear()
+  with ThreadPool(1, bounded=True, bounded_allowance=1, overflow='drop_oldest') as pool:
+    pool.submit(event.wait)
+    time.sleep(0.02)
+    futures = [pool.submit(_square, i) for i in range(4)]
+    event.set()
+  assert_equals([f.cancelled() for f in futures], [True, True, False, False])
+  assert_equals([f.result() for f in futures[2:]], [4, 9])
+
+  # The oldest of the futures with the lowest priority is dropped.
+  event.clear()
+  with ThreadPool(1, bounded=True, bounded_allowance=1, overflow='drop_oldest') as pool:
+    pool.submit(event.wait)
+    time.sleep(0.02)
+    high = Future().bind(_square, 2)
+    pool.enqueue(high, priority=PRIORITY_HIGH)
+    low = Future().bind(_square, 3)
+    pool.enqueue(low, priority=PRIORITY_LOW)
+    normal = pool.submit(_square, 4)
+    event.set()
+  assert_equals(high.result(), 4)
+  assert low.cancelled()
+  assert_equals(normal.result(), 16)
+
+
+def test_bounded_producers_wake_one_at_a_time():
+  class CountingCondition(object):
+    def __init__(self, cond):
+      self.cond = cond
+      self.wakeups = 0
+    def __enter__(self):
+      return self.cond.__enter__()
+    def __exit__(self, *args):
+      return self.cond.__exit__(*args)
+    def wait(self, timeout=None):
+      result = self.cond.wait(timeout)
+      self.wakeups += 1
+      return result
+    def notify(self, n=1):
+      self.cond.notify(n)
+
+  for scheduler in ThreadPool.SCHEDULERS:
+    events = [threading.Event() for _ in range(4)]
+    pool = ThreadPool(1, bounded=True, scheduler=scheduler)
+    cond = pool._slots._cond = CountingCondition(pool._slots._cond)
+    pool.submit(events[0].wait)
+    time.sleep(0.02)
+    pool.submit(events[1].wait)
+    producers = [threading.Thread(target=pool.submit, args=[e.wait]) for e in events[2:]]
+    for producer in producers:
+      producer.start()
+    time.sleep(0.05)
+    assert_equals(cond.wakeups, 0)
+    events[0].set()  # Frees one slot.
+    time.sleep(0.05)
+    assert_equals(cond.wakeups, 1)
+    assert_equals(sum(p.is_alive() for p in producers), 1)
+    for event in events:
+      event.set()
+    for producer in producers:
+      producer.join()
+    pool.shutdown()
+
+
+def test_worker_initializer():
+  for scheduler in ThreadPool.SCHEDULERS:
+    lock = threading.Lock()
+    opened, closed = [], []
+    def initializer(prefix):
+      with lock:
+        worker_local().handle = '{0}-{1}'.format(prefix, len(opened))
+        opened.append(worker_local().handle)
+    def finalizer():
+      with lock:
+        closed.append(worker_local().handle)
+    pool = ThreadPool(2, scheduler=scheduler, keepalive=0.05, initializer=initializer,
+                      initargs=['db'], finalizer=finalizer)
+    handles = set(pool.map(lambda _: worker_local().handle, range(20)))
+    assert handles <= set(opened)
+    time.sleep(0.2)  # The idle workers retire.
+    assert_equals(sorted(closed), sorted(opened))
+    assert_equals(pool.submit(lambda: worker_local().handle).result(), opened[-1])
+    pool.shutdown()
+    assert_equals(sorted(closed), sorted(opened))
+  with assert_raises(RuntimeError):
+    worker_local()
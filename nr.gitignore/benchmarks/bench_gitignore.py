@@ -0,0 +1,175 @@
+"""
+Measures how fast #nr.gitignore walks a tree (files per second) and
+matches paths (paths per second) and prints the results as a table, or
+as JSON with `--json` so that they can be compared across changes.
+
+    $ python benchmarks/bench_gitignore.py --json results.json
+    $ python benchmarks/bench_gitignore.py --dir ~/src/project --only scan match
+
+Without `--dir`, a synthetic tree is generated into a temporary directory
+(see `gentree.py`). Every value is the best of `--repeat` runs.
+
+Benchmarks:
+
+* `walk`, `walk-compiled`: #walk() with the per-directory ignore files and
+  the patterns as an #IgnoreListCollection or compiled.
+* `scan`, `scan-workers`: #scan() with the same arguments, single-threaded
+  and with `--workers` threads.
+* `match`, `match-compiled`: #IgnoreListCollection.match() and
+  #CompiledIgnoreList.match() for the path of every file in the tree.
+* `match-many`: #IgnoreListCollection.match_many() with the same paths.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import gentree
+import nr.gitignore
+from nr.gitignore import parse, scan, walk
+
+
+def bench_walk(ctx, args):
+  return count_files(walk(ctx['patterns'], ctx['dirname'], '.gitignore'))
+
+
+def bench_walk_compiled(ctx, args):
+  return count_files(walk(ctx['compiled'], ctx['dirname'], '.gitignore'))
+
+
+def bench_scan(ctx, args):
+  return count_files(scan(ctx['compiled'], ctx['dirname'], '.gitignore'))
+
+
+def bench_scan_workers(ctx, args):
+  return count_files(scan(ctx['compiled'], ctx['dirname'], '.gitignore', args.workers))
+
+
+def bench_match(ctx, args):
+  match = ctx['patterns'].match
+  for path, isdir in ctx['paths']:
+    match(path, isdir)
+  return len(ctx['paths'])
+
+
+def bench_match_compiled(ctx, args):
+  match = ctx['compiled'].match
+  for path, isdir in ctx['paths']:
+    match(path, isdir)
+  return len(ctx['paths'])
+
+
+def bench_match_many(ctx, args):
+  paths = ctx['paths']
+  ctx['patterns'].match_many([x[0] for x in paths], [x[1] for x in paths])
+  return len(paths)
+
+
+def count_files(results):
+  return sum(len(files) for _, _, files in results)
+
+
+BENCHMARKS = [
+  ('walk', bench_walk, 'files/s'),
+  ('walk-compiled', bench_walk_compiled, 'files/s'),
+  ('scan', bench_scan, 'files/s'),
+  ('scan-workers', bench_scan_workers, 'files/s'),
+  ('match', bench_match, 'paths/s'),
+  ('match-compiled', bench_match_compiled, 'paths/s'),
+  ('match-many', bench_match_many, 'paths/s'),
+]
+
+
+def run(func, ctx, args):
+  tstart = time.time()
+  count = func(ctx, args)
+  return count / (time.time() - tstart)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--dir', help='benchmark with an existing directory')
+  parser.add_argument('--depth', type=int, default=4)
+  parser.add_argument('--fanout', type=int, default=6)
+  parser.add_argument('--files', type=int, default=30)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--workers', type=int, default=4)
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--quick', action='store_true', help='a smaller tree and a single run')
+  parser.add_argument('--only', nargs='+', choices=[x[0] for x in BENCHMARKS])
+  parser.add_argument('--json', metavar='FILE', help='write the results as JSON ("-" for stdout)')
+  args = parser.parse_args(argv)
+  if args.quick:
+    args.depth, args.fanout, args.repeat = 3, 4, 1
+
+  tempdir = None
+  if args.dir:
+    dirname = args.dir
+  else:
+    dirname = tempdir = tempfile.mkdtemp()
+    gentree.make_tree(tempdir, args.depth, args.fanout, args.files, seed=args.seed)
+
+  try:
+    # The ignore file in the root is read by walk() and scan() like the
+    # ones in the subdirectories.
+    patterns = parse(None, os.path.join(dirname, '.git'), global_=False)
+    paths = []
+    for root, dirs, files in os.walk(dirname):
+      dirs[:] = [d for d in dirs if d != '.git']
+      paths.extend((os.path.join(root, d), True) for d in dirs)
+      paths.extend((os.path.join(root, f), False) for f in files)
+    ctx = {
+      'dirname': dirname,
+      'patterns': patterns,
+      'compiled': patterns.compile(),
+      'paths': paths,
+    }
+
+    results = []
+    for name, func, unit in BENCHMARKS:
+      if args.only and name not in args.only:
+        continue
+      value = max(run(func, ctx, args) for _ in range(args.repeat))
+      results.append({'benchmark': name, 'value': value, 'unit': unit})
+  finally:
+    if tempdir:
+      shutil.rmtree(tempdir)
+
+  if args.json:
+    data = {
+      'meta': {
+        'nr.gitignore': nr.gitignore.__version__,
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'dir': args.dir,
+        'tree': None if args.dir else {'depth': args.depth, 'fanout': args.fanout,
+                                       'files': args.files, 'seed': args.seed},
+        'paths': len(paths),
+        'workers': args.workers,
+        'repeat': args.repeat,
+      },
+      'results': results,
+    }
+    if args.json == '-':
+      json.dump(data, sys.stdout, indent=2)
+      print()
+      return
+    with open(args.json, 'w') as fp:
+      json.dump(data, fp, indent=2)
+
+  print('{:>16}  {:>14}  {}'.format('benchmark', 'value', 'unit'))
+  for result in results:
+    print('{:>16}  {:>14.0f}  {}'.format(result['benchmark'], result['value'], result['unit']))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,121 @@
+"""
+Compares the files and directories that #nr.gitignore.walk() ignores with
+what `git check-ignore --stdin` reports for the same work tree and prints
+the differences. Exits with status 1 if there are any.
+
+    $ python benchmarks/check_git.py --repo ~/src/project
+    $ python benchmarks/check_git.py --depth 3 --seed 7 --compiled
+
+Without `--repo`, a synthetic tree is generated into a temporary Git
+repository (see `gentree.py`). Only the ignore files in the work tree and
+`.git/info/exclude` are taken into account, the global excludes file is
+disabled for Git as well. The index is ignored (`--no-index`), so tracked
+files are compared like untracked ones.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import gentree
+from nr.gitignore import parse, walk
+
+
+def list_paths(dirname):
+  """
+  Returns the paths of all files and directories in *dirname* relative to
+  it (joined with slashes, directories with a trailing slash), except for
+  the `.git` directory.
+  """
+
+  result = []
+  for root, dirs, files in os.walk(dirname):
+    if root == dirname:
+      dirs[:] = [d for d in dirs if d != '.git']
+    rel = os.path.relpath(root, dirname).replace(os.sep, '/')
+    prefix = '' if rel == '.' else rel + '/'
+    result.extend(prefix + d + '/' for d in dirs)
+    result.extend(prefix + f for f in files)
+  return result
+
+
+def git_ignored(dirname, paths):
+  """
+  Returns the subset of *paths* that Git ignores.
+  """
+
+  command = ['git', '-c', 'core.excludesFile=' + os.devnull, 'check-ignore',
+             '--stdin', '-z', '--no-index']
+  proc = subprocess.Popen(command, cwd=dirname, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  data = '\0'.join(paths).encode(sys.getfilesystemencoding())
+  output = proc.communicate(data)[0]
+  if proc.returncode not in (0, 1):  # 1 means that no path is ignored.
+    raise RuntimeError('git check-ignore exited with {0}'.format(proc.returncode))
+  output = output.decode(sys.getfilesystemencoding())
+  return set(x for x in output.split('\0') if x)
+
+
+def nr_ignored(dirname, paths, compiled=False):
+  """
+  Returns the subset of *paths* that #nr.gitignore.walk() does not yield.
+  """
+
+  patterns = parse(None, os.path.join(dirname, '.git'), global_=False)
+  if compiled:
+    patterns = patterns.compile()
+  seen = set()
+  for root, dirs, files in walk(patterns, dirname, '.gitignore'):
+    rel = os.path.relpath(root, dirname).replace(os.sep, '/')
+    prefix = '' if rel == '.' else rel + '/'
+    seen.update(prefix + d + '/' for d in dirs)
+    seen.update(prefix + f for f in files)
+  return set(paths) - seen
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--repo', help='compare in an existing Git work tree')
+  parser.add_argument('--depth', type=int, default=3)
+  parser.add_argument('--fanout', type=int, default=5)
+  parser.add_argument('--files', type=int, default=25)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--compiled', action='store_true', help='match with the compiled patterns')
+  parser.add_argument('--max', type=int, default=50, help='the number of differences to print')
+  args = parser.parse_args(argv)
+
+  tempdir = None
+  if args.repo:
+    dirname = args.repo
+  else:
+    dirname = tempdir = tempfile.mkdtemp()
+    subprocess.check_call(['git', 'init', '-q', tempdir])
+    gentree.make_tree(tempdir, args.depth, args.fanout, args.files, seed=args.seed)
+
+  try:
+    paths = list_paths(dirname)
+    git = git_ignored(dirname, paths)
+    nr = nr_ignored(dirname, paths, args.compiled)
+  finally:
+    if tempdir:
+      shutil.rmtree(tempdir)
+
+  differences = sorted(git ^ nr)
+  for path in differences[:args.max]:
+    if path in git:
+      print('ignored by git only:', path)
+    else:
+      print('ignored by nr only: ', path)
+  if len(differences) > args.max:
+    print('... and {0} more'.format(len(differences) - args.max))
+  print('{0} paths, {1} ignored by git, {2} ignored by nr, {3} differences'.format(
+    len(paths), len(git), len(nr), len(differences)))
+  return 1 if differences else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Generates a synthetic source tree to benchmark and test #nr.gitignore
+with. The names of the files and directories are drawn from a vocabulary
+that hits the patterns in the `corpus/` directory, and some directories
+get an ignore file with a few of its patterns.
+
+    $ python benchmarks/gentree.py /tmp/tree --depth 4 --fanout 5 --files 20
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+DIR_NAMES = [
+  'src', 'lib', 'app', 'core', 'util', 'tests', 'docs', 'main', 'pkg', 'api',
+  'build', 'dist', 'out', 'target', 'bin', 'node_modules', '__pycache__',
+  'logs', 'coverage', 'Debug', 'release', '.idea', '.vscode', 'venv', 'gradle',
+]
+
+FILE_NAMES = [
+  'main.py', 'util.pyc', 'module.pyo', 'index.js', 'app.ts', 'README.md',
+  'Foo.class', 'Foo.java', 'lib.jar', 'gradle-wrapper.jar', 'main.c', 'main.o',
+  'libx.so', 'libx.so.1', 'libx.a', 'app.exe', 'debug.log', 'npm-debug.log.1',
+  'server.pid', '.env', '.coverage', 'notes.txt~', '.main.c.swp', 'Thumbs.db',
+  '.DS_Store', 'settings.json', 'package.tgz', 'data.tar.gz', 'setup.cfg',
+  '#draft#', 'CMakeCache.txt', '.gitkeep', 'x.egg', 'style.css',
+]
+
+
+def load_corpus(names=None):
+  """
+  Returns a dictionary that maps the names of the ignore files in the
+  corpus (without the `.gitignore` suffix) to their lines.
+  """
+
+  result = {}
+  for filename in sorted(os.listdir(CORPUS_DIR)):
+    name = filename[:-len('.gitignore')]
+    if filename.endswith('.gitignore') and (not names or name in names):
+      with open(os.path.join(CORPUS_DIR, filename)) as fp:
+        result[name] = fp.read().splitlines()
+  return result
+
+
+def make_tree(dirname, depth=4, fanout=5, files=20, ignore_files=0.2, seed=0, corpus=None):
+  """
+  Creates a tree of empty files in *dirname* with *fanout* subdirectories
+  per directory down to *depth* levels and *files* files per directory.
+  The root gets an ignore file that combines all files of the *corpus*,
+  and every other directory gets one with a few patterns from it with
+  the probability *ignore_files*. Returns the number of files created.
+  """
+
+  rng = random.Random(seed)
+  if corpus is None:
+    corpus = load_corpus()
+  lines = [line for name in sorted(corpus) for line in corpus[name]]
+  patterns = [line for line in lines if line.strip() and not line.startswith('#')]
+
+  count = 0
+  pending = [(dirname, 0)]
+  while pending:
+    path, level = pending.pop()
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    if level == 0:
+      content = lines
+    elif rng.random() < ignore_files:
+      content = rng.sample(patterns, min(3, len(patterns)))
+    else:
+      content = None
+    if content is not None:
+      with open(os.path.join(path, '.gitignore'), 'w') as fp:
+        fp.write('\n'.join(content) + '\n')
+      count += 1
+    for name in rng.sample(FILE_NAMES, min(files, len(FILE_NAMES))):
+      open(os.path.join(path, name), 'w').close()
+      count += 1
+    for i in range(files - len(FILE_NAMES)):
+      open(os.path.join(path, 'file{0}.{1}'.format(i, rng.choice(['py', 'js', 'c', 'log']))), 'w').close()
+      count += 1
+    if level < depth:
+      for name in rng.sample(DIR_NAMES, min(fanout, len(DIR_NAMES))):
+        pending.append((os.path.join(path, name), level + 1))
+  return count
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser()
+  parser.add_argument('dirname')
+  parser.add_argument('--depth', type=int, default=4)
+  parser.add_argument('--fanout', type=int, default=5)
+  parser.add_argument('--files', type=int, default=20)
+  parser.add_argument('--ignore-files', type=float, default=0.2,
+    help='probability that a directory has its own ignore file')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--corpus', nargs='+', help='the corpus files to use (default: all)')
+  args = parser.parse_args(argv)
+  count = make_tree(args.dirname, args.depth, args.fanout, args.files,
+    args.ignore_files, args.seed, load_corpus(args.corpus))
+  print('created {0} files in {1}'.format(count, args.dirname))
+
+
+if __name__ == '__main__':
+  main()
@@ -39,7 +39,18 @@ __version__ = '1.0.0'
 
 import os
 import fnmatch as _fnmatch
+import errno
+import functools as _functools
+import hashlib
+import itertools
+import json
 import re as _re
+import select
+import struct
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool as _ThreadPool
 
 try: range
 except NameError: range = xrange
@@ -55,15 +66,17 @@ class Pattern(object):
 
   # Attributes
 
-  parts (list of str): The parts of the pattern split by `/`. Joining
-    the parts using this separator gives the full pattern again.
+  parts (list of str): The parts of the pattern split by `/`, without the
+    trailing slash of a directory-only pattern. Joining the parts using
+    this separator gives the full pattern again (minus that slash).
   invert (bool): True if the pattern explicitly *includes* the matched
     files rather than excluding them.
   is_abs (bool): True if the pattern is absolute (and thus only matches the
     root project directory).
   has_slash (bool): True if there is at least one slash in the pattern.
-  dir_onl (bool): True if this pattern matches only directories (that is
-    when the pattern ends with a slash).
+  dir_only (bool): True if this pattern matches only directories (that is
+    when the pattern ends with a slash). It matches a file only by one of
+    the file's parent directories.
   """
 
   def __init__(self, pattern, invert=False):
@@ -71,21 +84,39 @@ class Pattern(object):
     self.invert = invert
     self.is_abs = not self.parts[0]
     self.has_slash = len(self.parts) != 1
-    self.dir_only = not self.parts[-1]
+    self.dir_only = len(self.parts) > 1 and not self.parts[-1]
+    if self.dir_only:
+      self.parts.pop()
 
   def __str__(self):
     prefix = '!' if self.invert else ''
-    return prefix + '/'.join(self.parts)
+    suffix = '/' if self.dir_only else ''
+    return prefix + '/'.join(self.parts) + suffix
 
   def __repr__(self):
     return '<Pattern {0!r} invert={1} is_abs={2} has_slash={3} dir_only={4}>'.format(
       str(self), self.invert, self.is_abs, self.has_slash, self.dir_only)
 
-  def match(self, filename):
-    filename = os.path.normpath(filename).replace(os.sep, '/')
-    # Does not take #Pattern.invert into account.
-    if isinstance(filename, str):
-      filename = filename.split('/')
+  def to_regex(self, isdir=False):
+    """
+    Returns a regular expression (as a string) that matches the same
+    normalized, slash-separated paths as #match() (also not taking
+    #invert into account). Used by #IgnoreList.compile().
+    """
+
+    body = '/'.join(_translate(part) for part in self.parts)
+    end = '/' if self.dir_only and not isdir else r'(?:/|\Z)'
+    if self.is_abs:
+      return r'\A' + body + end
+    return r'(?:\A|/)' + body + end
+
+  def match(self, filename, isdir=False):
+    # Does not take #Pattern.invert into account. The *filename* may also
+    # be a list of the parts of the normalized path.
+    if not isinstance(filename, list):
+      filename = os.path.normpath(filename).replace(os.sep, '/').split('/')
+    if self.dir_only and not isdir:
+      filename = filename[:-1]  # Only the parent directories can match.
     if len(filename) < len(self.parts):
       return False
     #print("match()", repr(self), filename, self.parts)
@@ -110,6 +141,10 @@ class IgnoreList(object):
   A collection of the patterns in a `.gitignore` file. Must be initialized
   with the path to the root directory of the repository to properly match
   absolute paths in the patterns.
+
+  The #patterns list may be modified (patterns added, removed or replaced),
+  the index used by #match() is rebuilt when it changed. The #Pattern
+  objects themselves must not be modified.
   """
 
   def __init__(self, root=None, patterns=None):
@@ -117,6 +152,7 @@ class IgnoreList(object):
       root = os.path.normpath(os.path.abspath(root))
     self.root = root
     self.patterns = patterns or []
+    self._index = None
 
   def __repr__(self):
     return '<IgnoreList root={0!r} patterns({1})>'.format(
@@ -146,11 +182,15 @@ class IgnoreList(object):
           invert = True
         while line.endswith(' ') and line[-2:] != '\ ':
           line = line[:-1]
+        if not line.strip('/'):
+          continue  # A blank line (or a lone slash) matches no files.
         line = sub(r'\\([!# ])', r'\1', line)
-        if '/' in line and not line.startswith('/'):
-          # Patterns with a slash can only be matched absolute.
+        if '/' in line[:-1] and not line.startswith('/'):
+          # Patterns with a slash (other than a trailing one) can only be
+          # matched absolute.
           line = '/' + line
         self.patterns.append(Pattern(line, invert))
+    self._index = _PatternIndex(self.patterns)
 
   def convert_path(self, path):
     if os.path.isabs(path):
@@ -158,7 +198,7 @@ class IgnoreList(object):
         raise ValueError('IgnoreList.root not set, can not handle absolute paths')
       path = os.path.relpath(path, self.root)
     path = os.path.normpath(path)
-    if path.startswith(os.pardir + os.sep) or path.startswith(os.curdir + os.sep):
+    if path == os.pardir or path.startswith(os.pardir + os.sep) or path.startswith(os.curdir + os.sep):
       raise ValueError("path ({0!r}) is not under the IgnoreList.root directory ({1!r})".format(path, self.root))
     if os.sep != '/':
       path = path.replace(os.sep, '/')
@@ -167,7 +207,7 @@ class IgnoreList(object):
   def match(self, filename, isdir=False):
     """
     Match the specified *filename*. If *isdir* is False, directory-only
-    patterns will be ignored.
+    patterns match only the parent directories of the *filename*.
 
     Returns one of
 
@@ -176,16 +216,28 @@ class IgnoreList(object):
     - #MATCH_INCLUDE
     """
 
-    fnmatch = _fnmatch.fnmatch
-    ignored = False
     filename = self.convert_path(filename)
-    basename = os.path.basename(filename)
+    return self._match_parts(os.path.normpath(filename).replace(os.sep, '/').split('/'), isdir)
+
+  def _match_parts(self, parts, isdir):
+    # Matches the parts of a path as returned by #convert_path().
+    index = self._index
+    if index is None or not index.valid_for(self.patterns):
+      # The patterns have been modified without #parse().
+      index = self._index = _PatternIndex(self.patterns)
 
-    for pattern in self.patterns:
-      if pattern.dir_only and not isdir:
+    # An inverted pattern that matches means that this file is definitely
+    # NOT ignored, no matter what other patterns match.
+    ignored = False
+    for pattern in index.literal_matches(parts):
+      if pattern.dir_only and not isdir and not pattern.match(parts):
         continue
-      if (not ignored or pattern.invert) and pattern.match(filename):
-        if pattern.invert: # This file is definitely NOT ignored, no matter what other patterns match
+      if pattern.invert:
+        return MATCH_INCLUDE
+      ignored = True
+    for pattern in index.globs:
+      if (not ignored or pattern.invert) and pattern.match(parts, isdir):
+        if pattern.invert:
           return MATCH_INCLUDE
         ignored = True
     if ignored:
@@ -200,6 +252,107 @@ class IgnoreList(object):
 
     return self.match(filename, isdir) == MATCH_IGNORE
 
+  def match_many(self, paths, isdir=None):
+    """
+    Matches all *paths* at once, see #match_many().
+    """
+
+    return match_many(self, paths, isdir)
+
+  def filter(self, paths, isdir=None):
+    """
+    Returns the *paths* that are not ignored, see #match_many().
+    """
+
+    flags = match_many(self, paths, isdir)
+    return [path for path, ignored in zip(paths, flags) if not ignored]
+
+  def compile(self):
+    """
+    Returns a #CompiledIgnoreList that gives the same results as #match()
+    but evaluates all patterns with a single regular expression. It does
+    not reflect later changes to the #patterns.
+    """
+
+    return CompiledIgnoreList([self])
+
+
+class _PatternIndex(object):
+  # Indexes the patterns that do not need #fnmatch so that #IgnoreList.match()
+  # does not have to try them one by one:
+  #
+  # - literal names (eg. `node_modules`) in a set, they match any component
+  #   of the path,
+  # - extensions (eg. `*.pyc`) in a table that is looked up with every
+  #   suffix of a path component that starts with a dot,
+  # - anchored literal paths (eg. `/build`) in a trie, they match any path
+  #   that begins with them.
+  #
+  # All other patterns are kept in #globs and matched with #Pattern.match().
+
+  def __init__(self, patterns):
+    self._source = patterns
+    self._snapshot = list(patterns)
+    self.names = {}
+    self.extensions = {}
+    self.prefixes = ({}, [])  # (children, patterns)
+    self.globs = []
+    normcase = os.path.normcase
+    for pattern in patterns:
+      parts = pattern.parts
+      if not any(_is_glob(x) for x in parts):
+        if pattern.is_abs:
+          node = self.prefixes
+          for part in parts[1:]:
+            node = node[0].setdefault(normcase(part), ({}, []))
+          node[1].append(pattern)
+          continue
+        if len(parts) == 1:
+          self.names.setdefault(normcase(parts[0]), []).append(pattern)
+          continue
+      elif len(parts) == 1 and not pattern.is_abs and parts[0].startswith('*.') \
+          and not _is_glob(parts[0][1:]):
+        self.extensions.setdefault(normcase(parts[0][1:]), []).append(pattern)
+        continue
+      self.globs.append(pattern)
+
+  def valid_for(self, patterns):
+    # The list comparison falls back to the identity of the #Pattern
+    # objects and runs in C, so this is cheap compared to matching.
+    return patterns is self._source and patterns == self._snapshot
+
+  def literal_matches(self, parts):
+    """
+    Returns the indexed patterns that match the path *parts*.
+    """
+
+    normcase = os.path.normcase
+    parts = [normcase(x) for x in parts]
+    result = []
+    if self.names:
+      for part in parts:
+        result.extend(self.names.get(part, ()))
+    if self.extensions:
+      for part in parts:
+        index = part.find('.')
+        while index >= 0:
+          result.extend(self.extensions.get(part[index:], ()))
+          index = part.find('.', index + 1)
+    node = self.prefixes
+    if node[1] or node[0]:
+      if parts[0] == '':
+        result.extend(node[1])
+        for part in parts[1:]:
+          node = node[0].get(part)
+          if node is None:
+            break
+          result.extend(node[1])
+    return result
+
+
+def _is_glob(pattern):
+  return '*' in pattern or '?' in pattern or '[' in pattern
+
 
 class IgnoreListCollection(list):
   """
@@ -238,6 +391,179 @@ class IgnoreListCollection(list):
 
     return self.match(filename, isdir) == MATCH_IGNORE
 
+  def match_many(self, paths, isdir=None):
+    """
+    Matches all *paths* at once, see #match_many().
+    """
+
+    return match_many(self, paths, isdir)
+
+  def filter(self, paths, isdir=None):
+    """
+    Returns the *paths* that are not ignored, see #match_many().
+    """
+
+    flags = match_many(self, paths, isdir)
+    return [path for path, ignored in zip(paths, flags) if not ignored]
+
+  def compile(self):
+    """
+    Returns a #CompiledIgnoreList for all #IgnoreList#s in the collection.
+    """
+
+    return CompiledIgnoreList(self)
+
+
+class CompiledIgnoreList(object):
+  """
+  Matches paths against the patterns of one or more #IgnoreList#s with
+  the same results as #IgnoreList.match() and #IgnoreListCollection.match(),
+  but instead of matching every #Pattern separately, all patterns of the
+  lists that share the same root are combined into one regular expression
+  per kind of path (file or directory), which is evaluated once per path.
+  Use #IgnoreList.compile() or #IgnoreListCollection.compile() to create it.
+  """
+
+  def __init__(self, lists):
+    self._segments = []
+    for lst in lists:
+      if not self._segments or self._segments[-1][0].root != lst.root:
+        self._segments.append((lst, []))
+      self._segments[-1][1].append(lst)
+    self._segments = [(lst, self._compile(group, False), self._compile(group, True))
+                      for lst, group in self._segments]
+
+  def __repr__(self):
+    return '<CompiledIgnoreList segments({0})>'.format(len(self._segments))
+
+  @staticmethod
+  def _compile(lists, isdir):
+    # Returns a regular expression with an empty named group for every
+    # possible result, the first alternative that matches determines the
+    # result. Within an #IgnoreList, a matching inverted pattern takes
+    # precedence over all other patterns.
+    alternatives = []
+    results = {}
+    for lst in lists:
+      for result, invert in ((MATCH_INCLUDE, True), (MATCH_IGNORE, False)):
+        regexes = [p.to_regex(isdir) for p in lst.patterns if p.invert == invert]
+        if regexes:
+          group = 'g{0}'.format(len(results))
+          results[group] = result
+          alternatives.append('(?=.*?(?:{0}))(?P<{1}>)'.format('|'.join(regexes), group))
+    if not alternatives:
+      return None, results
+    flags = _re.S
+    if os.path.normcase('A') == 'a':
+      flags |= _re.I  # Like #fnmatch.fnmatch() on case-insensitive systems.
+    return _re.compile(r'\A(?:' + '|'.join(alternatives) + ')', flags), results
+
+  def match(self, filename, isdir=False):
+    """
+    Returns one of #MATCH_DEFAULT, #MATCH_IGNORE or #MATCH_INCLUDE.
+    """
+
+    for lst, files, dirs in self._segments:
+      regex, results = dirs if isdir else files
+      if regex is None:
+        continue
+      path = lst.convert_path(filename)
+      if path == '/.':
+        path = '/'  # #Pattern.match() normalizes the path once more.
+      match = regex.match(path)
+      if match:
+        return results[match.lastgroup]
+    return MATCH_DEFAULT
+
+  def is_ignored(self, filename, isdir=False):
+    """
+    Matches and returns #True if the file/directory should be ignored.
+    """
+
+    return self.match(filename, isdir) == MATCH_IGNORE
+
+  def match_many(self, paths, isdir=None):
+    """
+    Matches all *paths* at once, see #match_many().
+    """
+
+    return match_many(self, paths, isdir)
+
+  def filter(self, paths, isdir=None):
+    """
+    Returns the *paths* that are not ignored, see #match_many().
+    """
+
+    flags = match_many(self, paths, isdir)
+    return [path for path, ignored in zip(paths, flags) if not ignored]
+
+
+def _translate(pattern):
+  # Translates a #fnmatch pattern for a single path component to a regular
+  # expression that does not match a slash. Character sets are handled
+  # like #fnmatch.translate() does it.
+  result = []
+  i, n = 0, len(pattern)
+  while i < n:
+    c = pattern[i]
+    i += 1
+    if c == '*':
+      if not result or result[-1] != '[^/]*':
+        result.append('[^/]*')
+    elif c == '?':
+      result.append('[^/]')
+    elif c == '[':
+      j = i
+      if j < n and pattern[j] == '!':
+        j += 1
+      if j < n and pattern[j] == ']':
+        j += 1
+      while j < n and pattern[j] != ']':
+        j += 1
+      if j >= n:
+        result.append('\\[')
+        continue
+      stuff = pattern[i:j]
+      if '-' not in stuff:
+        stuff = stuff.replace('\\', r'\\')
+      else:
+        chunks = []
+        k = i + 2 if pattern[i] == '!' else i + 1
+        while True:
+          k = pattern.find('-', k, j)
+          if k < 0:
+            break
+          chunks.append(pattern[i:k])
+          i = k + 1
+          k = k + 3
+        chunk = pattern[i:j]
+        if chunk:
+          chunks.append(chunk)
+        else:
+          chunks[-1] += '-'
+        # Remove empty ranges, they are invalid in regular expressions.
+        for k in range(len(chunks) - 1, 0, -1):
+          if chunks[k - 1][-1] > chunks[k][0]:
+            chunks[k - 1] = chunks[k - 1][:-1] + chunks[k][1:]
+            del chunks[k]
+        stuff = '-'.join(x.replace('\\', r'\\').replace('-', r'\-') for x in chunks)
+      stuff = _re.sub(r'([&~|])', r'\\\1', stuff)
+      i = j + 1
+      if not stuff:
+        result.append('(?!)')
+      elif stuff == '!':
+        result.append('[^/]')
+      else:
+        if stuff[0] == '!':
+          stuff = '^' + stuff[1:]
+        elif stuff[0] in ('^', '['):
+          stuff = '\\' + stuff
+        # A range may include the slash, but a path component does not.
+        result.append('(?!/)[{0}]'.format(stuff))
+    else:
+      result.append(_re.escape(c))
+  return ''.join(result)
+
 
 def parse(ignore_file='.gitignore', git_dir='.git', additional_files=(),
           global_=True, root_dir=None, defaults=True):
@@ -295,19 +621,716 @@ def get_defaults(root):
   return defaults
 
 
-def walk(patterns, dirname):
+def walk(patterns, dirname, ignore_file=None):
   """
   Like #os.walk(), but filters the files and directories that are excluded by
-  the specified *patterns*.
+  the specified *patterns*. The contents of excluded directories are not
+  walked.
+
+  If *ignore_file* is specified (eg. `'.gitignore'`), the file with that
+  name is read from every directory that is walked, like Git does it. Its
+  patterns apply to the contents of the directory and take precedence over
+  those of the parent directories and the *patterns*. Every file is read
+  and compiled once, the directories share the rules of their parents.
 
   # Arguments
   patterns (IgnoreList, IgnoreListCollection): Can also be any object that
     implements the #IgnoreList.match() interface.
   dirname (str): The directory to walk.
+  ignore_file (str): The name of the per-directory ignore files.
   """
 
   join = os.path.join
+  stacks = {}  # Maps directories that are yet to be walked to their rules.
   for root, dirs, files in os.walk(dirname, topdown=True):
-    dirs[:] = [d for d in dirs if patterns.match(join(root, d), True) != MATCH_IGNORE]
-    files[:] = [f for f in files if patterns.match(join(root, f), False) != MATCH_IGNORE]
+    stack = stacks.pop(root, ())
+    lines = None
+    if ignore_file and ignore_file in files:
+      lines = _read_ignore_file(join(root, ignore_file))
+    if lines:
+      lst = IgnoreList(root)
+      lst.parse(lines)
+      stack = (lst.compile(),) + stack
+    if stack:
+      absroot = os.path.abspath(root)
+      def match(name, isdir):
+        for layer in stack:
+          result = layer.match(join(absroot, name), isdir)
+          if result != MATCH_DEFAULT:
+            return result
+        return patterns.match(join(root, name), isdir)
+    else:
+      match = lambda name, isdir: patterns.match(join(root, name), isdir)
+    dirs[:] = [d for d in dirs if match(d, True) != MATCH_IGNORE]
+    files[:] = [f for f in files if match(f, False) != MATCH_IGNORE]
     yield root, dirs, files
+    if stack:
+      for d in dirs:
+        stacks[join(root, d)] = stack
+
+
+def scan(patterns, dirname, ignore_file=None, workers=None, cache=None):
+  """
+  Like #walk(), but built on #os.scandir() and faster: the file types are
+  taken from the directory entries without extra system calls, and the
+  entries are matched by their path relative to *dirname*, which is built
+  up while descending, instead of converting every path for every
+  #IgnoreList. The directories and files are sorted by name and the
+  directories are yielded top-down in depth-first order.
+
+  With *workers*, the directories are listed and matched by that many
+  threads ahead of the consumer, while the results are still yielded in
+  the same, deterministic order. Removing names from the yielded *dirs*
+  list prevents the directories from being yielded, but they may have been
+  listed already. Symbolic links to directories are yielded in *dirs* but
+  not followed, like #os.walk() does it.
+
+  # Arguments
+  patterns (IgnoreList, IgnoreListCollection, CompiledIgnoreList): The
+    patterns to filter with. Other objects that implement the
+    #IgnoreList.match() interface are supported, but are slower.
+  dirname (str): The directory to walk.
+  ignore_file (str): The name of the per-directory ignore files, see #walk().
+  workers (int): The number of threads to list directories with.
+  cache (UntrackedCache): Reuse the results of previous scans for the
+    directories that did not change.
+  """
+
+  match = _relative_matcher(patterns, dirname)
+  rules = None
+  if cache is not None:
+    rules = cache._begin(dirname, _rules_hash(patterns, ignore_file))
+  pool = _ThreadPool(workers) if workers else None
+
+  def submit(path, rel, stack, rules):
+    args = (path, rel, stack, rules, match, ignore_file, cache)
+    if pool is None:
+      return _functools.partial(_scan_dir, *args)
+    return pool.apply_async(_scan_dir, args).get
+
+  try:
+    pending = [(dirname, submit(dirname, '', (), rules))]
+    while pending:
+      path, result = pending.pop()
+      result = result()
+      if result is None:
+        continue  # The directory can not be listed, #os.walk() skips it too.
+      rel, dirs, files, links, stack, rules = result
+      # Start listing the subdirectories while the consumer looks at this one.
+      children = {}
+      for name in dirs:
+        if name not in links:
+          child = os.path.join(path, name)
+          children[name] = (child, submit(child, rel + '/' + name if rel else name, stack, rules))
+      yield path, dirs, files
+      for name in reversed(dirs):
+        if name in children:
+          pending.append(children[name])
+  finally:
+    if pool is not None:
+      pool.terminate()
+  if cache is not None:
+    cache._end()
+
+
+def _scan_dir(path, rel, stack, rules, match, ignore_file, cache):
+  # Lists and filters the directory *path* for #scan(). *rel* is its path
+  # relative to the walked directory (joined with slashes, empty for the
+  # walked directory itself), *stack* are the rules of the ignore files of
+  # the parent directories as (match, offset) tuples, deepest first, where
+  # *offset* is the length of the directory's *rel* prefix to strip. With
+  # a *cache*, *rules* is the hash of all rules that apply to the directory.
+  entry = None
+  try:
+    if cache is not None:
+      stamp = _dir_stamp(path)
+      entry = cache._lookup(rel, stamp)
+    entries = _list_dir(path) if entry is None else entry['entries']
+  except OSError:
+    return None
+  lines = None
+  if ignore_file and any(name == ignore_file and not isdir for name, isdir, _ in entries):
+    lines = _read_ignore_file(os.path.join(path, ignore_file))
+  if lines:
+    lst = IgnoreList(path)
+    lst.parse(lines)
+    layer = _relative_matcher(lst.compile(), os.path.abspath(path))
+    stack = ((layer, len(rel) + 1 if rel else 0),) + stack
+    if rules is not None:
+      rules = _hash(rules + '\n' + '\n'.join(lines))
+
+  if entry is not None and entry['rules'] == rules:
+    cache._hit()
+    return rel, list(entry['dirs']), list(entry['files']), set(entry['links']), stack, rules
+
+  dirs, files, links = [], [], set()
+  for name, isdir, islink in entries:
+    child = rel + '/' + name if rel else name
+    if _match_layers(match, stack, child, isdir) == MATCH_IGNORE:
+      continue
+    if isdir:
+      dirs.append(name)
+      if islink:
+        links.add(name)
+    else:
+      files.append(name)
+  if cache is not None:
+    cache._store(rel, stamp, rules, entries, dirs, files, links)
+  return rel, dirs, files, links, stack, rules
+
+
+def _read_ignore_file(filename):
+  # Returns the lines of a per-directory ignore file without the blank ones
+  # (which #IgnoreList.parse() would turn into a pattern that matches every
+  # directory), or #None if the file can not be read. Like Git, #walk() and
+  # #scan() then treat the directory as if it had no ignore file.
+  try:
+    with open(filename) as fp:
+      lines = fp.read().splitlines()
+  except (IOError, OSError):
+    return None
+  return [line for line in lines if line.strip()]
+
+
+def _match_layers(match, stack, rel, isdir):
+  # Matches *rel* with the ignore file *stack* of #_scan_dir() first, and
+  # with *match* if none of the ignore files decides.
+  for layer, offset in stack:
+    result = layer(rel[offset:], isdir)
+    if result != MATCH_DEFAULT:
+      return result
+  return match(rel, isdir)
+
+
+class UntrackedCache(object):
+  """
+  Caches the results of #scan() per directory, like Git's untracked cache.
+  A directory is listed and matched again only if its modification time,
+  inode or device changed (that is, entries were added, removed or
+  renamed in it), and its entries are matched again only if the rules that
+  apply to it changed: the patterns passed to #scan() (which include the
+  contents of `info/exclude` and the global ignore file if they come from
+  #parse()) or the contents of the ignore files in it or any of its parent
+  directories. The ignore files are still read on every scan to detect
+  changes, which is cheap compared to listing all directories.
+
+  The cache is loaded from and saved to *filename* as JSON if specified.
+  #scan() saves it after it walked the whole tree. Directories that were
+  not visited are removed from the cache at that point.
+
+  ```python
+  cache = UntrackedCache('.git/nr-untracked-cache.json')
+  for root, dirs, files in scan(parse(), '.', '.gitignore', cache=cache):
+    ...
+  ```
+
+  # Attributes
+  hits (int): The number of directories served from the cache in the
+    last scan.
+  misses (int): The number of directories that were listed or matched in
+    the last scan.
+  """
+
+  VERSION = 1
+
+  # Directories modified less than this many seconds before the scan
+  # began are not cached, as further changes within the same timestamp
+  # granularity would go unnoticed.
+  RACY_SECONDS = 2
+
+  def __init__(self, filename=None):
+    self.filename = filename
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+    self._key = None
+    self._dirs = {}
+    self._visited = set()
+    self._tstart = None
+    if filename and os.path.isfile(filename):
+      self.load()
+
+  def __len__(self):
+    return len(self._dirs)
+
+  def load(self):
+    with open(self.filename) as fp:
+      data = json.load(fp)
+    if data.get('version') != self.VERSION:
+      self.clear()
+      return
+    self._key = data['key']
+    self._dirs = data['dirs']
+
+  def save(self):
+    data = {'version': self.VERSION, 'key': self._key, 'dirs': self._dirs}
+    tmp = self.filename + '.tmp'
+    with open(tmp, 'w') as fp:
+      json.dump(data, fp)
+    if os.name == 'nt' and os.path.exists(self.filename):
+      os.remove(self.filename)
+    os.rename(tmp, self.filename)
+
+  def clear(self):
+    with self._lock:
+      self._key = None
+      self._dirs = {}
+
+  def _begin(self, dirname, rules):
+    # Starts a scan of *dirname* with the rules hash *rules*, returns the
+    # hash of the rules for the *dirname* itself.
+    key = _hash(os.path.abspath(dirname) + '\n' + rules)
+    with self._lock:
+      if key != self._key:
+        self._key = key
+        self._dirs = {}
+      self._visited = set()
+      self._tstart = time.time()
+      self.hits = self.misses = 0
+    return key
+
+  def _end(self):
+    with self._lock:
+      self._dirs = dict((k, v) for k, v in self._dirs.items() if k in self._visited)
+    if self.filename:
+      self.save()
+
+  def _lookup(self, rel, stamp):
+    with self._lock:
+      self._visited.add(rel)
+      entry = self._dirs.get(rel)
+    if entry is not None and entry['stamp'] == stamp:
+      return entry
+    return None
+
+  def _hit(self):
+    with self._lock:
+      self.hits += 1
+
+  def _store(self, rel, stamp, rules, entries, dirs, files, links):
+    with self._lock:
+      self.misses += 1
+      if stamp[0] >= self._tstart - self.RACY_SECONDS:
+        self._dirs.pop(rel, None)
+        return
+      self._dirs[rel] = {'stamp': stamp, 'rules': rules, 'entries': entries,
+                         'dirs': list(dirs), 'files': list(files), 'links': sorted(links)}
+
+
+def _dir_stamp(path):
+  st = os.stat(path)
+  return [st.st_mtime, getattr(st, 'st_mtime_ns', 0), st.st_ino, st.st_dev]
+
+
+def _hash(text):
+  return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+def _rules_hash(patterns, ignore_file):
+  # Returns a hash of the rules that #scan() applies with *patterns*.
+  if isinstance(patterns, IgnoreList):
+    patterns = [patterns]
+  if isinstance(patterns, list):
+    parts = [repr((lst.root, [str(p) for p in lst.patterns])) for lst in patterns]
+  elif isinstance(patterns, CompiledIgnoreList):
+    parts = [repr((lst.root, [None if r is None else r.pattern for r, _ in (f, d)]))
+             for lst, f, d in patterns._segments]
+  else:
+    raise TypeError('UntrackedCache requires IgnoreList, IgnoreListCollection '
+      'or CompiledIgnoreList patterns')
+  return _hash('\n'.join([repr(ignore_file)] + parts))
+
+
+class FileIndex(object):
+  """
+  Keeps the set of files in *dirname* that are not ignored by the
+  *patterns* and the per-directory *ignore_file*s (see #walk()) up to date
+  with Linux' inotify. The directory is scanned once when the index is
+  created, after that only the paths reported by inotify are matched
+  again. Directories that are created or moved into the tree, and those
+  whose ignore file changed, are scanned again. Ignored directories and
+  symbolic links to directories are not watched.
+
+  Call #poll() to process the pending events, for example when #fileno()
+  becomes readable or before taking a #snapshot().
+
+  ```python
+  with FileIndex(parse(), '.', '.gitignore') as index:
+    while True:
+      if index.poll(timeout=1):
+        rebuild(index.snapshot())
+  ```
+
+  Raises an #OSError if inotify is not available.
+  """
+
+  def __init__(self, patterns, dirname, ignore_file=None):
+    self.dirname = dirname
+    self.ignore_file = ignore_file
+    self._match = _relative_matcher(patterns, dirname)
+    self._inotify = _Inotify()
+    self._lock = threading.RLock()
+    self._dirs = {}     # rel -> [wd, inherited stack, stack, set of file names]
+    self._watches = {}  # wd -> rel
+    self._snapshot = None
+    self.refresh()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __len__(self):
+    return len(self.snapshot())
+
+  def fileno(self):
+    """
+    Returns the inotify file descriptor. It becomes readable when there
+    are events to #poll().
+    """
+
+    return self._inotify.fd
+
+  def close(self):
+    self._inotify.close()
+
+  def snapshot(self):
+    """
+    Returns a #frozenset of the paths of all files that are not ignored,
+    joined with the *dirname*. The set is only rebuilt after it changed.
+    """
+
+    with self._lock:
+      if self._snapshot is None:
+        join = os.path.join
+        paths = []
+        for rel, entry in self._dirs.items():
+          base = join(self.dirname, *rel.split('/')) if rel else self.dirname
+          paths.extend(join(base, name) for name in entry[3])
+        self._snapshot = frozenset(paths)
+      return self._snapshot
+
+  def refresh(self):
+    """
+    Scans the whole directory again. Necessary if the *patterns* changed.
+    This also happens automatically if the kernel's event queue overflows.
+    """
+
+    with self._lock:
+      self._remove_tree('')
+      self._add_tree('', ())
+      self._snapshot = None
+
+  def poll(self, timeout=0):
+    """
+    Processes the pending events, waiting up to *timeout* seconds for the
+    first one (forever if #None). Returns #True if the set of files changed.
+    """
+
+    events = self._inotify.read(timeout)
+    with self._lock:
+      changed = False
+      for wd, mask, name in events:
+        if self._handle(wd, mask, name):
+          changed = True
+      if changed:
+        self._snapshot = None
+      return changed
+
+  def _path(self, rel):
+    return os.path.join(self.dirname, *rel.split('/')) if rel else self.dirname
+
+  def _handle(self, wd, mask, name):
+    # Applies a single event, returns #True if the set of files changed.
+    if mask & _IN_Q_OVERFLOW:
+      self.refresh()
+      return True
+    rel = self._watches.get(wd)
+    if rel is None:
+      return False  # An event for a directory that is no longer watched.
+    if mask & _IN_IGNORED:
+      del self._watches[wd]
+      return False
+    if mask & _IN_DELETE_SELF:
+      return rel == '' and self._remove_tree('')
+    if not name:
+      return False
+
+    entry = self._dirs[rel]
+    child = rel + '/' + name if rel else name
+    isdir = bool(mask & _IN_ISDIR)
+    if name == self.ignore_file and not isdir:
+      # The rules changed for everything in the directory.
+      self._remove_tree(rel)
+      self._add_tree(rel, entry[1])
+      return True
+    if mask & (_IN_DELETE | _IN_MOVED_FROM):
+      if isdir:
+        return self._remove_tree(child)
+      if name in entry[3]:
+        entry[3].discard(name)
+        return True
+      return False
+    if mask & (_IN_CREATE | _IN_MOVED_TO):
+      path = self._path(child)
+      if not isdir:
+        isdir = os.path.isdir(path)  # Symbolic links to directories.
+      if _match_layers(self._match, entry[2], child, isdir) == MATCH_IGNORE:
+        return False
+      if not isdir:
+        entry[3].add(name)
+        return True
+      if not os.path.islink(path):
+        return self._add_tree(child, entry[2])
+    return False
+
+  def _add_tree(self, rel, stack):
+    # Watches and scans the directory *rel* and its subdirectories. The
+    # watch is added before the directory is listed so that no changes
+    # are missed in between.
+    changed = False
+    pending = [(rel, stack)]
+    while pending:
+      rel, stack = pending.pop()
+      path = self._path(rel)
+      try:
+        wd = self._inotify.add_watch(path, _WATCH_MASK)
+      except OSError:
+        continue  # Removed in the meantime, or not a directory anymore.
+      try:
+        result = _scan_dir(path, rel, stack, None, self._match, self.ignore_file, None)
+      except (IOError, OSError):
+        result = None  # The ignore file was removed in the meantime.
+      if result is None:
+        self._inotify.rm_watch(wd)
+        continue
+      dirs, files, links, inner = result[1:5]
+      self._dirs[rel] = [wd, stack, inner, set(files)]
+      self._watches[wd] = rel
+      changed = changed or bool(files)
+      for name in dirs:
+        if name not in links:
+          pending.append((rel + '/' + name if rel else name, inner))
+    return changed
+
+  def _remove_tree(self, rel):
+    # Stops watching the directory *rel* and its subdirectories and
+    # removes their files from the index.
+    prefix = rel + '/'
+    changed = False
+    for key in list(self._dirs):
+      if not rel or key == rel or key.startswith(prefix):
+        wd, _, _, files = self._dirs.pop(key)
+        changed = changed or bool(files)
+        if self._watches.pop(wd, None) is not None:
+          self._inotify.rm_watch(wd)
+    return changed
+
+
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_ISDIR = 0x40000000
+_WATCH_MASK = _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | \
+  _IN_DELETE | _IN_DELETE_SELF | _IN_ONLYDIR
+
+
+class _Inotify(object):
+  # A minimal binding of the Linux inotify API with #ctypes.
+
+  _header = struct.Struct('iIII')
+
+  def __init__(self):
+    import ctypes
+    import ctypes.util
+    try:
+      libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+      self._init, self._add, self._rm = libc.inotify_init1, \
+        libc.inotify_add_watch, libc.inotify_rm_watch
+    except (OSError, AttributeError):
+      raise OSError(errno.ENOSYS, 'inotify is not available')
+    self._get_errno = ctypes.get_errno
+    self.fd = self._check(self._init(os.O_NONBLOCK | 0o2000000))  # IN_CLOEXEC
+
+  def _check(self, result):
+    if result < 0:
+      code = self._get_errno()
+      raise OSError(code, os.strerror(code))
+    return result
+
+  def close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+  def add_watch(self, path, mask):
+    if not isinstance(path, bytes):
+      path = path.encode(sys.getfilesystemencoding(), 'surrogateescape')
+    return self._check(self._add(self.fd, path, mask))
+
+  def rm_watch(self, wd):
+    self._rm(self.fd, wd)  # Fails if the watch is already gone, that's fine.
+
+  def read(self, timeout=0):
+    # Returns a list of (wd, mask, name) tuples.
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return []
+    data = b''
+    while True:
+      try:
+        chunk = os.read(self.fd, 65536)
+      except OSError as exc:
+        if exc.errno == errno.EAGAIN:
+          break
+        raise
+      if not chunk:
+        break
+      data += chunk
+    events = []
+    offset = 0
+    size = self._header.size
+    while offset < len(data):
+      wd, mask, cookie, length = self._header.unpack_from(data, offset)
+      name = data[offset + size:offset + size + length].rstrip(b'\0')
+      if not isinstance(name, str):
+        name = name.decode(sys.getfilesystemencoding(), 'surrogateescape')
+      events.append((wd, mask, name))
+      offset += size + length
+    return events
+
+
+def _list_dir(path):
+  # Returns a sorted list of (name, isdir, islink) tuples.
+  scandir = getattr(os, 'scandir', None)
+  if scandir is None:
+    join, isdir, islink = os.path.join, os.path.isdir, os.path.islink
+    return [(name, isdir(join(path, name)), islink(join(path, name)))
+            for name in sorted(os.listdir(path))]
+  result = []
+  for entry in scandir(path):
+    try:
+      isdir = entry.is_dir()
+    except OSError:
+      isdir = False
+    result.append((entry.name, isdir, isdir and entry.is_symlink()))
+  result.sort()
+  return result
+
+
+def match_many(patterns, paths, isdir=None):
+  """
+  Matches a batch of *paths* with the *patterns* (an #IgnoreList,
+  #IgnoreListCollection or #CompiledIgnoreList) and returns a #bytearray
+  with one byte per path that is 1 if the path is ignored and 0 otherwise.
+
+  The paths are grouped by their parent directory, which is converted with
+  #IgnoreList.convert_path() and matched only once per group. Like Git
+  and #walk(), a path inside of an ignored directory is ignored as well,
+  even if a pattern would include it (and even if the directory itself is
+  not in *paths*). Apart from that, the result for every path is the same
+  as from #IgnoreList.is_ignored().
+
+  # Arguments
+  patterns (IgnoreList, IgnoreListCollection, CompiledIgnoreList): The
+    patterns to match with.
+  paths (list of str): The paths to match.
+  isdir (bool, list of bool): Whether the paths are directories, either
+    for all paths or for every path. If omitted, paths that end with a
+    slash are directories.
+  """
+
+  if isdir is None:
+    isdir = [path.endswith(('/', os.sep)) for path in paths]
+  elif isinstance(isdir, bool):
+    isdir = itertools.repeat(isdir)
+
+  result = bytearray(len(paths))
+  groups = {}
+  split = os.path.split
+  normpath = os.path.normpath
+  for index, (path, is_dir) in enumerate(zip(paths, isdir)):
+    head, name = split(normpath(path))
+    if not name or name == os.curdir:
+      # The root of the filesystem or the current directory.
+      result[index] = patterns.match(path, is_dir) == MATCH_IGNORE
+    else:
+      groups.setdefault(head, []).append((index, name, is_dir))
+
+  # Maps a directory to a function that matches names in it, #None if the
+  # directory is ignored, or the #ValueError raised while converting it.
+  matchers = {}
+  def matcher(dirname):
+    try:
+      return matchers[dirname]
+    except KeyError:
+      pass
+    parent, name = split(dirname)
+    if name and parent != dirname:
+      func = matcher(parent)
+      if func is None or (not isinstance(func, ValueError) and func(name, True) == MATCH_IGNORE):
+        matchers[dirname] = None
+        return None
+    try:
+      func = _relative_matcher(patterns, dirname or os.curdir)
+    except ValueError as exc:
+      func = exc  # Not under the root of one of the lists.
+    matchers[dirname] = func
+    return func
+
+  for dirname, entries in groups.items():
+    func = matcher(dirname)
+    if func is None:
+      for index, name, is_dir in entries:
+        result[index] = 1
+    elif isinstance(func, ValueError):
+      # Only the directory itself may be the root of the lists.
+      for index, name, is_dir in entries:
+        path = os.path.join(dirname, name)
+        result[index] = patterns.match(path, is_dir) == MATCH_IGNORE
+    else:
+      for index, name, is_dir in entries:
+        result[index] = func(name, is_dir) == MATCH_IGNORE
+  return result
+
+
+def _relative_matcher(patterns, dirname):
+  # Returns a function that matches a path relative to *dirname* (joined
+  # with slashes) with the *patterns*, converting *dirname* only once.
+
+  def prefix(lst):
+    path = lst.convert_path(dirname)
+    if path == '/.':
+      return '/'
+    return path + '/'
+
+  if isinstance(patterns, IgnoreList):
+    patterns = IgnoreListCollection([patterns])
+  if isinstance(patterns, IgnoreListCollection):
+    lists = [(lst, prefix(lst)) for lst in patterns if lst]
+    def match(rel, isdir):
+      for lst, base in lists:
+        result = lst._match_parts((base + rel).split('/'), isdir)
+        if result != MATCH_DEFAULT:
+          return result
+      return MATCH_DEFAULT
+    return match
+  if isinstance(patterns, CompiledIgnoreList):
+    segments = [(prefix(lst), files, dirs) for lst, files, dirs in patterns._segments]
+    def match(rel, isdir):
+      for base, files, dirs in segments:
+        regex, results = dirs if isdir else files
+        if regex is not None:
+          m = regex.match(base + rel)
+          if m:
+            return results[m.lastgroup]
+      return MATCH_DEFAULT
+    return match
+  join = os.path.join
+  return lambda rel, isdir: patterns.match(join(dirname, *rel.split('/')), isdir)
@@ -1,7 +1,13 @@
 
+import itertools
 import os
+import random
+import shutil
+import sys
+import tempfile
 from nose.tools import *
-from nr.gitignore import Pattern, IgnoreList, IgnoreListCollection, MATCH_IGNORE
+from nr.gitignore import Pattern, IgnoreList, IgnoreListCollection, MATCH_IGNORE, \
+  MATCH_INCLUDE, MATCH_DEFAULT, get_defaults, walk, scan, UntrackedCache, match_many, FileIndex
 
 
 def test_pattern():
@@ -23,3 +29,336 @@ def test_ignore_list():
   ignore = IgnoreList()
   ignore.parse(['__pycache__', 'dist'])
   assert ignore.match('./dist/module-1.0.0.tar.gz') == MATCH_IGNORE
+
+
+def test_dir_only_patterns():
+  # Like Git, a trailing slash does not anchor the pattern, and the pattern
+  # matches files only by their parent directories.
+  ignore = IgnoreList('/repo')
+  ignore.parse(['build/', '/out/', 'docs/tmp/', '*.d/', '!keep/', '', '   ', '/'])
+  assert_equals([str(p) for p in ignore.patterns],
+                ['build/', '/out/', '/docs/tmp/', '*.d/', '!keep/'])
+  for lst in [ignore, ignore.compile()]:
+    assert_equals(lst.match('/repo/build', True), MATCH_IGNORE)
+    assert_equals(lst.match('/repo/a/b/build', True), MATCH_IGNORE)
+    assert_equals(lst.match('/repo/a/build'), MATCH_DEFAULT)
+    assert_equals(lst.match('/repo/a/build/x.c'), MATCH_IGNORE)
+    assert_equals(lst.match('/repo/out', True), MATCH_IGNORE)
+    assert_equals(lst.match('/repo/out/x'), MATCH_IGNORE)
+    assert_equals(lst.match('/repo/a/out', True), MATCH_DEFAULT)
+    assert_equals(lst.match('/repo/docs/tmp', True), MATCH_IGNORE)
+    assert_equals(lst.match('/repo/docs/tmp'), MATCH_DEFAULT)
+    assert_equals(lst.match('/repo/a/docs/tmp', True), MATCH_DEFAULT)
+    assert_equals(lst.match('/repo/x.d', True), MATCH_IGNORE)
+    assert_equals(lst.match('/repo/x.d/y'), MATCH_IGNORE)
+    assert_equals(lst.match('/repo/x.d'), MATCH_DEFAULT)
+    assert_equals(lst.match('/repo/keep', True), MATCH_INCLUDE)
+    assert_equals(lst.match('/repo/src', True), MATCH_DEFAULT)
+
+
+def test_ignore_list_index():
+  ignore = IgnoreList('/repo')
+  ignore.parse(['node_modules', '*.tar.gz', '/build', '/docs/_build', 'out/', '*.py[co]',
+                '!keep.tar.gz'])
+  index = ignore._index
+  assert_equals(sorted(index.names), ['keep.tar.gz', 'node_modules', 'out'])
+  assert_equals(sorted(index.extensions), ['.tar.gz'])
+  assert_equals(sorted(index.prefixes[0]), ['build', 'docs'])
+  assert_equals([str(p) for p in index.globs], ['*.py[co]'])
+  assert_equals(ignore.match('/repo/a/node_modules/x.js'), MATCH_IGNORE)
+  assert_equals(ignore.match('/repo/dist/x.tar.gz'), MATCH_IGNORE)
+  assert_equals(ignore.match('/repo/dist/keep.tar.gz'), MATCH_INCLUDE)
+  assert_equals(ignore.match('/repo/build/x'), MATCH_IGNORE)
+  assert_equals(ignore.match('/repo/src/build'), MATCH_DEFAULT)
+  assert_equals(ignore.match('/repo/docs/_build/index.html'), MATCH_IGNORE)
+  assert_equals(ignore.match('/repo/docs/index.html'), MATCH_DEFAULT)
+  assert_equals(ignore.match('/repo/x.pyc'), MATCH_IGNORE)
+  assert_equals(ignore.match('/repo/a/out', True), MATCH_IGNORE)
+  assert_equals(ignore.match('/repo/a/out'), MATCH_DEFAULT)
+  assert_equals(ignore.match('/repo/a/out/x'), MATCH_IGNORE)
+
+  # The index is rebuilt if the patterns are modified directly.
+  ignore.patterns.append(Pattern('x.pyc', invert=True))
+  assert_equals(ignore.match('/repo/x.pyc'), MATCH_INCLUDE)
+  ignore.patterns[-1] = Pattern('y.pyc', invert=True)
+  assert_equals(ignore.match('/repo/x.pyc'), MATCH_IGNORE)
+  assert_equals(ignore.match('/repo/y.pyc'), MATCH_INCLUDE)
+
+
+PATTERN_CORPUS = [
+  '__pycache__', '*.pyc', '*.py[co]', '/build', 'build/', 'dist', 'docs/_build',
+  '!important.log', '*.log', '!/keep', 'a?c', '[!a]*', '[a-c]x', '[]]', '[',
+  '[z-a]', '[+-0]x', '**/foo', 'foo/**', 'foo/*/bar', '\\#hash', '\\!bang',
+  'trailing\\ ', '.*', '!.gitkeep', 'node_modules', '*~', '', 'a/b/c/',
+  '[!]x', '*.[ch]', 'x*y*z', 'CamelCase', '!*.txt', 'sub/dir', '[a-]b',
+]
+
+PATH_COMPONENTS = [
+  '__pycache__', 'x.pyc', 'x.pyo', 'build', 'dist', 'docs', '_build', 'important.log',
+  'debug.log', 'keep', 'abc', 'bx', ']', '[', '.x', '+x', 'foo', 'bar', '#hash',
+  '!bang', 'trailing ', '.hidden', '.gitkeep', 'node_modules', 'x~', 'a', 'b', 'c',
+  'main.c', 'xyz', 'xaybz', 'camelcase', 'CamelCase', 'notes.txt', 'sub', 'dir',
+  '-b', 'ab',
+]
+
+
+def _differential_paths(count=1500, seed=42):
+  rng = random.Random(seed)
+  paths = ['.', 'a', 'a/b', 'a/b/c']
+  for _ in range(count):
+    depth = rng.randint(1, 5)
+    paths.append('/'.join(rng.choice(PATH_COMPONENTS) for _ in range(depth)).replace('//', '/'))
+  return paths
+
+
+def test_compiled_matches_like_ignore_list():
+  rng = random.Random(7)
+  paths = _differential_paths()
+  pattern_sets = [PATTERN_CORPUS] + [rng.sample(PATTERN_CORPUS, 8) for _ in range(20)]
+  for patterns in pattern_sets:
+    ignore = IgnoreList('/repo')
+    ignore.parse(patterns)
+    compiled = ignore.compile()
+    for path, isdir in itertools.product(paths, (False, True)):
+      expected = ignore.match(path, isdir)
+      assert compiled.match(path, isdir) == expected, (patterns, path, isdir, expected)
+
+
+def test_compiled_matches_like_collection():
+  rng = random.Random(11)
+  paths = _differential_paths(1000)
+  for _ in range(10):
+    collection = IgnoreListCollection()
+    for root in ['/repo', '/repo', '/repo/a', '/repo']:
+      collection.parse(rng.sample(PATTERN_CORPUS, 6), root)
+    collection.append(get_defaults('/repo'))
+    compiled = collection.compile()
+    for path, isdir in itertools.product(paths, (False, True)):
+      path = os.path.join('/repo/a', path)
+      expected = collection.match(path, isdir)
+      assert compiled.match(path, isdir) == expected, (path, isdir, expected)
+
+
+
+def test_match_many():
+  rng = random.Random(13)
+  paths = _differential_paths(1000)
+  for _ in range(10):
+    collection = IgnoreListCollection()
+    for root in ['/repo', '/repo', '/repo/a']:
+      collection.parse(rng.sample(PATTERN_CORPUS, 6), root)
+    for patterns in [collection[0], collection, collection.compile()]:
+      def expected(path, isdir):
+        parent = os.path.dirname(os.path.normpath(path))
+        while parent not in ('', '/'):
+          try:
+            if patterns.is_ignored(parent, True):
+              return True
+          except ValueError:
+            break  # Above the root of a list.
+          parent = os.path.dirname(parent)
+        return patterns.is_ignored(path, isdir)
+      for base in ['', '/repo/a/']:
+        batch = [base + path for path in paths]
+        isdir = [rng.random() < 0.3 for _ in batch]
+        flags = patterns.match_many(batch, isdir)
+        assert_equals(len(flags), len(batch))
+        for path, is_dir, flag in zip(batch, isdir, flags):
+          assert flag == expected(path, is_dir), (path, is_dir, flag)
+        assert_equals(patterns.filter(batch, isdir),
+                      [p for p, flag in zip(batch, flags) if not flag])
+
+  ignore = IgnoreList('/repo')
+  ignore.parse(['/build', 'tmp', '*.log', '!keep.log'])
+  paths = ['build/', 'src/build', 'build/keep.log', 'keep.log', 'x/tmp/keep.log', 'a.log']
+  assert_equals(list(match_many(ignore, paths)), [1, 0, 1, 0, 1, 1])
+  assert_equals(ignore.filter(paths), ['src/build', 'keep.log'])
+
+
+NESTED_TREE = {
+  '.gitignore': '*.log\nbuild/\n/local\n',
+  'a.log': '', 'a.txt': '', 'local': '',
+  'sub/.gitignore': '!keep.log\n/local\n*.tmp\n',
+  'sub/keep.log': '', 'sub/other.log': '', 'sub/local': '', 'sub/x.tmp': '',
+  'sub/deep/local': '', 'sub/deep/y.tmp': '', 'sub/deep/z.txt': '',
+  'ignored/.gitignore': '!*.log\n', 'ignored/b.log': '',
+  'other/local': '', 'other/x.tmp': '',
+}
+
+
+def _make_tree(tree):
+  tempdir = tempfile.mkdtemp()
+  for name, content in tree.items():
+    path = os.path.join(tempdir, *name.split('/'))
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fp:
+      fp.write(content)
+  return tempdir
+
+
+def test_walk_nested_ignore_files():
+  tempdir = _make_tree(NESTED_TREE)
+  try:
+    patterns = IgnoreList(tempdir)
+    patterns.parse(['/ignored'])
+    found = set()
+    for root, dirs, files in walk(patterns, tempdir, ignore_file='.gitignore'):
+      rel = os.path.relpath(root, tempdir).replace(os.sep, '/')
+      for f in files:
+        found.add(f if rel == '.' else rel + '/' + f)
+    assert_equals(found, set([
+      '.gitignore', 'a.txt', 'sub/.gitignore', 'sub/keep.log', 'sub/deep/local',
+      'sub/deep/z.txt', 'other/local', 'other/x.tmp']))
+  finally:
+    shutil.rmtree(tempdir)
+
+
+def test_nested_ignore_files_blank_and_unreadable():
+  tempdir = _make_tree({
+    'blank/.gitignore': '\n*.log\n   \n',
+    'blank/sub/a.txt': '', 'blank/b.log': '', 'blank/c.txt': '',
+    'dangling/sub/a.txt': '', 'dangling/b.log': '',
+  })
+  try:
+    os.symlink(os.path.join(tempdir, 'missing'), os.path.join(tempdir, 'dangling', '.gitignore'))
+    patterns = IgnoreList(tempdir)
+    for func in [walk, scan]:
+      found = set()
+      for root, dirs, files in func(patterns, tempdir, '.gitignore'):
+        rel = os.path.relpath(root, tempdir).replace(os.sep, '/')
+        found.update(rel + '/' + f for f in files)
+      assert_equals(found, set(['blank/.gitignore', 'blank/sub/a.txt', 'blank/c.txt',
+        'dangling/.gitignore', 'dangling/sub/a.txt', 'dangling/b.log']))
+  finally:
+    shutil.rmtree(tempdir)
+
+
+def test_scan_matches_walk():
+  tree = dict(NESTED_TREE)
+  rng = random.Random(3)
+  for i in range(300):
+    depth = rng.randint(1, 4)
+    name = '/'.join(rng.choice(['a', 'b', 'sub', 'build', 'node_modules', 'x.log', 'y.tmp'])
+                    for _ in range(depth)) + '/file{0}.{1}'.format(i, rng.choice(['py', 'pyc', 'log']))
+    tree[name] = ''
+  tempdir = _make_tree(tree)
+  try:
+    ignore = IgnoreList(tempdir)
+    ignore.parse(['/ignored', '*.pyc', 'node_modules', '!b'])
+    collection = IgnoreListCollection([ignore, get_defaults(tempdir)])
+    def normalize(results):
+      return [(os.path.relpath(root, tempdir), sorted(dirs), sorted(files))
+              for root, dirs, files in results]
+    for patterns in [ignore, collection, collection.compile()]:
+      for ignore_file in [None, '.gitignore']:
+        expected = sorted(normalize(walk(patterns, tempdir, ignore_file)))
+        for workers in [None, 4]:
+          results = normalize(scan(patterns, tempdir, ignore_file, workers))
+          assert_equals(results, sorted(results, key=lambda x: x[0].split(os.sep)))
+          assert_equals(sorted(results), expected)
+  finally:
+    shutil.rmtree(tempdir)
+
+
+def test_scan_untracked_cache():
+  tempdir = _make_tree(NESTED_TREE)
+  try:
+    # Directories modified just now are not cached, pretend they are old.
+    old = os.stat(tempdir).st_mtime - 60
+    def age():
+      for root, dirs, files in os.walk(tempdir):
+        os.utime(root, (old, old))
+    age()
+    ignore = IgnoreList(tempdir)
+    ignore.parse(['*.pyc'])
+    def normalize(results):
+      return sorted((os.path.relpath(root, tempdir), sorted(dirs), sorted(files))
+                    for root, dirs, files in results)
+    filename = os.path.join(tempfile.gettempdir(), 'nr-gitignore-cache-{0}.json'.format(os.getpid()))
+    try:
+      cache = UntrackedCache(filename)
+      expected = normalize(scan(ignore, tempdir, '.gitignore'))
+      assert_equals(normalize(scan(ignore, tempdir, '.gitignore', cache=cache)), expected)
+      assert_equals(cache.hits, 0)
+      visited = cache.misses
+      cache = UntrackedCache(filename)
+      assert_equals(normalize(scan(ignore, tempdir, '.gitignore', cache=cache)), expected)
+      assert_equals((cache.hits, cache.misses), (visited, 0))
+
+      # Editing an ignore file in place invalidates its directory and below.
+      with open(os.path.join(tempdir, 'sub', '.gitignore'), 'a') as fp:
+        fp.write('\n*.txt\n')
+      expected = normalize(scan(ignore, tempdir, '.gitignore'))
+      assert_equals(normalize(scan(ignore, tempdir, '.gitignore', cache=cache)), expected)
+      assert cache.misses > 0 and cache.hits > 0
+
+      # Adding a file changes the mtime of its directory.
+      open(os.path.join(tempdir, 'new.txt'), 'w').close()
+      os.utime(tempdir, (old + 10, old + 10))
+      expected = normalize(scan(ignore, tempdir, '.gitignore'))
+      assert_equals(normalize(scan(ignore, tempdir, '.gitignore', cache=cache)), expected)
+
+      # Different base patterns discard the whole cache.
+      ignore.parse(['*.txt'])
+      expected = normalize(scan(ignore, tempdir, '.gitignore'))
+      assert_equals(normalize(scan(ignore, tempdir, '.gitignore', cache=cache)), expected)
+      assert_equals(cache.hits, 0)
+    finally:
+      if os.path.exists(filename):
+        os.remove(filename)
+  finally:
+    shutil.rmtree(tempdir)
+
+
+def test_file_index():
+  if not sys.platform.startswith('linux'):
+    return  # Requires inotify.
+  tempdir = _make_tree(NESTED_TREE)
+  try:
+    ignore = IgnoreList(tempdir)
+    ignore.parse(['*.pyc'])
+    def expected():
+      return frozenset(os.path.join(root, name)
+                       for root, dirs, files in scan(ignore, tempdir, '.gitignore')
+                       for name in files)
+    def write(name, content=''):
+      path = os.path.join(tempdir, *name.split('/'))
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with open(path, 'w') as fp:
+        fp.write(content)
+    with FileIndex(ignore, tempdir, '.gitignore') as index:
+      assert_equals(index.snapshot(), expected())
+      assert_false(index.poll())
+
+      write('new.txt')
+      write('new.pyc')
+      write('build/x.txt')
+      assert_true(index.poll())
+      assert_equals(index.snapshot(), expected())
+
+      write('new/a/b/c.txt')
+      write('new/a/d.log')
+      write('new/a/.gitignore', '*.txt\n')
+      index.poll()
+      assert_equals(index.snapshot(), expected())
+
+      # Changing an ignore file scans its directory again.
+      write('sub/.gitignore', '*.txt\n')
+      index.poll()
+      assert_equals(index.snapshot(), expected())
+      os.remove(os.path.join(tempdir, 'new', 'a', '.gitignore'))
+      index.poll()
+      assert_equals(index.snapshot(), expected())
+
+      os.rename(os.path.join(tempdir, 'new'), os.path.join(tempdir, 'moved'))
+      shutil.rmtree(os.path.join(tempdir, 'sub'))
+      os.remove(os.path.join(tempdir, 'a.txt'))
+      index.poll()
+      assert_equals(index.snapshot(), expected())
+      write('moved/a/b/e.txt')
+      index.poll()
+      assert_equals(index.snapshot(), expected())
+  finally:
+    shutil.rmtree(tempdir)